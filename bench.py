@@ -0,0 +1,220 @@
+from pathmap import getmap
+from pathmap import profile
+from pathmap import synthetic
+from pathmap import tilestore
+from pathmap import tileserver
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+
+def _timed(iterable, stages, name):
+    """Yield items of iterable, adding the time spent generating them to
+    stages[name]"""
+
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            stages[name] = stages.get(name, 0) + time.perf_counter() - start
+        yield item
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on Linux, bytes on macOS
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def run_case(shape, length_km, options):
+    """Run route of shape and length_km through the whole pipeline, return
+    dict of measurements
+
+    Meant to be run in a fresh process, so that the peak RSS belongs to the
+    case only.
+    """
+
+    stages = {}
+    profiler = profile.enable()
+    with tempfile.TemporaryDirectory() as tdir:
+        gpx_file = os.path.join(tdir, "route.gpx")
+        synthetic.write_gpx(synthetic.synthetic_route(shape, length_km), gpx_file)
+
+        store = tilestore.SqliteTileStore(os.path.join(tdir, "tiles.mbtiles"), max_bytes=None)
+        md = synthetic.SyntheticMapDownloader(url=options["url"], latency=options["latency"],
+                                              tile_store=store, workers=options["workers"])
+        surroundings = dict(radius_pix=options["radius"], simplify_pix=options["simplify"])
+
+        start = time.perf_counter()
+        path = md.gpx2path(gpx_file)
+        stages["gpx"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        tiles = getmap.route_tiles(md, path, **surroundings)
+        md.fetch_tiles(tiles)
+        stages["tiles"] = time.perf_counter() - start
+
+        #render is the time spent in the generator, pdf the rest
+        output = os.path.join(tdir, "route.pdf")
+        start = time.perf_counter()
+        getmap.create_path_pdf(
+            _timed(getmap.path_surroundings(md, path, jobs=options["jobs"], **surroundings), stages, "render"),
+            output, encoding=options["encoding"])
+        stages["pdf"] = time.perf_counter() - start - stages["render"]
+
+        output_bytes = os.path.getsize(output)
+        downloads = md.download_state()
+        md.close()
+
+    return {
+        "name": "{}-{}km".format(shape, length_km),
+        "shape": shape,
+        "length_km": length_km,
+        "points": len(path),
+        "tiles": len(tiles),
+        "tiles_per_s": len(tiles) / stages["tiles"],
+        "stages": stages,
+        "wall": sum(stages.values()),
+        "peak_rss_mb": _peak_rss_mb(),
+        "output_bytes": output_bytes,
+        #finer stages and counters, see pathmap.profile
+        "profile": profiler.report(),
+        #state of the adaptive download limiter at the end
+        "downloads": downloads,
+    }
+
+
+#measurements compared by --compare; True if higher is better
+_COMPARED = {"wall": False, "tiles_per_s": True, "peak_rss_mb": False, "output_bytes": False}
+
+
+def compare(results, baseline, tolerance):
+    """Print comparison of results with baseline results, return list of
+    names of the measurements which got worse by more than tolerance (a
+    fraction)"""
+
+    old_cases = {case["name"]: case for case in baseline["cases"]}
+    regressions = []
+    print("{:20} {:12} {:>12} {:>12} {:>8}".format("case", "measure", "baseline", "now", "change"))
+    for case in results["cases"]:
+        old = old_cases.get(case["name"])
+        if old is None:
+            continue
+        for measure, higher_better in _COMPARED.items():
+            if not old.get(measure):
+                continue
+            change = case[measure] / old[measure] - 1
+            worse = -change if higher_better else change
+            mark = ""
+            if worse > tolerance:
+                mark = " !"
+                regressions.append("{} {}".format(case["name"], measure))
+            print("{:20} {:12} {:12.4g} {:12.4g} {:+7.1%}{}".format(
+                case["name"], measure, old[measure], case[measure], change, mark))
+    return regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description="Measures how fast pathmap creates the pdf for synthetic "
+        "routes, with generated tiles")
+    parser.add_argument("--shapes", default="line,loop,zigzag,wander",
+                        help="Comma separated shapes of the routes (line, "
+                        "loop, zigzag, wander). Default all.")
+    parser.add_argument("--lengths", default="10,50",
+                        help="Comma separated lengths of the routes in km. "
+                        "Default 10,50.")
+    parser.add_argument("--server", action="store_true",
+                        help="Download the tiles over HTTP from a local tile "
+                        "server instead of generating them in place.")
+    parser.add_argument("--latency", default=0, type=float,
+                        help="Delay of every tile in seconds. Default 0.")
+    parser.add_argument("--error-rate", default=0, type=float,
+                        help="Fraction of tile requests the server answers by "
+                        "an error (with --server). Default 0.")
+    parser.add_argument("--workers", default=10, type=int,
+                        help="Number of threads downloading tiles. Default 10.")
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help="Number of processes rendering the map parts. "
+                        "Default 1.")
+    parser.add_argument("-r", "--radius", default=130, type=int,
+                        help="Radius of the covered map area in pixels. "
+                        "Default 130 px.")
+    parser.add_argument("-s", "--simplify", default=None, type=float,
+                        help="Simplify the routes by this many pixels. "
+                        "Default: no simplification.")
+    parser.add_argument("--encoding", default="png",
+                        help="Encoding of the map parts in the pdf. Default png.")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Save the results as json into this file.")
+    parser.add_argument("--compare", default=None,
+                        help="Compare the results with results saved before "
+                        "by -o; exit with status 1 if any got worse.")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="How much worse (as a fraction) a result may be "
+                        "than the compared one. Default 0.1.")
+
+    args = vars(parser.parse_args())
+
+    options = {name: args[name] for name in ("latency", "workers", "jobs", "radius", "simplify", "encoding")}
+    options["url"] = None
+
+    server = None
+    if args["server"]:
+        server = tileserver.TileServer(error_rate=args["error_rate"]).start()
+        options["url"] = server.url
+        #the server delays the responses instead of the downloader
+        server.latency = options["latency"]
+        options["latency"] = 0
+
+    results = {
+        "options": dict(options, server=args["server"], error_rate=args["error_rate"]),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "cases": [],
+    }
+
+    #every case in its own process, so that peak RSS is measured per case
+    context = multiprocessing.get_context("spawn")
+    for shape in args["shapes"].split(","):
+        for length in args["lengths"].split(","):
+            with ProcessPoolExecutor(1, mp_context=context) as pool:
+                case = pool.submit(run_case, shape, float(length), options).result()
+            results["cases"].append(case)
+            stages = case["stages"]
+            print("{}: {} tiles, {:.1f} tiles/s, {:.2f} s (gpx {:.2f}, tiles {:.2f}, render {:.2f}, "
+                  "pdf {:.2f}), peak RSS {:.0f} MB, output {:.0f} kB".format(
+                      case["name"], case["tiles"], case["tiles_per_s"], case["wall"], stages["gpx"],
+                      stages["tiles"], stages["render"], stages["pdf"], case["peak_rss_mb"],
+                      case["output_bytes"] / 1024))
+
+    if server is not None:
+        server.stop()
+
+    if args["output"]:
+        with open(args["output"], "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args["compare"]:
+        with open(args["compare"]) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args["tolerance"])
+        if regressions:
+            print("Got worse: {}".format(", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,68 @@
 from pathmap import getmap
 from pathmap import cykloserver
+from pathmap import tilestore
+from pathmap import asyncfetch
+from pathmap import pdf
+from pathmap import profile
+from pathmap import service
+from pathmap import ratecontrol
+from pathmap import partcache
 import argparse
+import os
+import sys
+
+def gpx_files(names):
+    """Return list of gpx files given by names of files or directories (all
+    .gpx files in them)"""
+
+    files = []
+    for name in names:
+        if os.path.isdir(name):
+            files.extend(sorted(os.path.join(name, f) for f in os.listdir(name)
+                                if f.lower().endswith(".gpx")))
+        else:
+            files.append(name)
+    return files
+
+
+def seed(g, paths, args):
+    """Download the tiles needed for paths into the tile cache of g (only
+    report how many there are with --dry-run)"""
+
+    tiles = []
+    for path in paths:
+        tiles.extend(getmap.route_tiles(g, path, radius_pix=args["radius"], simplify_pix=args["simplify"],
+                                        stable_bites=bool(args["part_cache"])))
+    estimate = getmap.seed_estimate(g, tiles)
+    print("{tiles} tiles needed, {stored} in the cache, {unavailable} missing on the server, "
+          "{missing} to download (about {mb:.1f} MB)".format(mb=estimate["bytes"] / 2**20, **estimate))
+    if estimate["bytes"] > args["cache_size"] * 2**20:
+        print("Warning: the tiles do not fit into the cache (--cache-size {} MB)".format(
+            args["cache_size"]))
+
+    if args["dry_run"]:
+        return
+
+    for done, total in getmap.seed_tiles(g, tiles):
+        print("\rDownloaded {}/{} tiles".format(done, total), end="", file=sys.stderr, flush=True)
+    print(file=sys.stderr)
+
+
+def serve(g, address, workers, pdf_options, surroundings):
+    """Run map service with downloader g at address ([host:]port) until
+    interrupted"""
+
+    host, _, port = address.rpartition(":")
+    s = service.MapService(g, workers=workers, pdf_options=pdf_options, **surroundings)
+    server = s.serve(host or "127.0.0.1", int(port))
+    print("Serving on http://{}:{}/jobs".format(*server.server_address[:2]), file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+    s.close()
+
 
 def main():
 
@@ -16,23 +78,167 @@ def main():
                         help="Color of the path in map image. Default red.")
     parser.add_argument("-o", "--output", default=None,
                         help="Name of the output pdf file. Default "
-                        "<path.gpx>.pdf")
-    parser.add_argument("path.gpx")
+                        "<path.gpx>.pdf. With several gpx files, directory "
+                        "for the pdf files (default: next to the gpx files).")
+    parser.add_argument("-s", "--simplify", default=None, type=float,
+                        help="Simplify the path before drawing, allowing it to "
+                        "deviate by at most this many pixels. Default: no "
+                        "simplification.")
+    parser.add_argument("-j", "--jobs", default=1, type=int,
+                        help="Number of processes rendering the map parts. "
+                        "Default 1.")
+    parser.add_argument("--pdf-backend", default="native", choices=["native", "latex"],
+                        help="How to create the pdf: write it directly "
+                        "(native) or by LaTeX. Default native.")
+    parser.add_argument("--encoding", default="png", choices=list(pdf.ENCODINGS),
+                        help="How the map parts are stored in the pdf: RGB "
+                        "PNG (png), PNG with adaptive palette (png-palette, "
+                        "much smaller) or JPEG (jpeg). Default png.")
+    parser.add_argument("--compress-level", default=6, type=int,
+                        choices=range(10), metavar="{0..9}",
+                        help="PNG compression level. Default 6.")
+    parser.add_argument("--quality", default=85, type=int,
+                        help="JPEG quality (1-95). Default 85.")
+    parser.add_argument("--cache", default=None,
+                        help="File in which downloaded tiles are kept between "
+                        "runs, or an existing directory to keep them as files "
+                        "DIR/provider/zoom/x/y. Default {}".format(tilestore.default_store_path()))
+    parser.add_argument("--cache-size", default=1024, type=int,
+                        help="Maximum size of the tile cache in MB, least "
+                        "recently used tiles get evicted. Default 1024 MB.")
+    parser.add_argument("--cache-ttl", default=30, type=float,
+                        help="Number of days after which cached tiles get "
+                        "downloaded again. Default 30 days.")
+    parser.add_argument("--memory-cache", default=64, type=int,
+                        help="Size of the in-memory cache of decoded tiles "
+                        "in MB. Default 64 MB.")
+    parser.add_argument("--workers", default=10, type=int,
+                        help="Initial number of tiles downloaded at once; it "
+                        "adapts to how fast the server answers and whether it "
+                        "asks to slow down. Default 10.")
+    parser.add_argument("--max-workers", default=32, type=int,
+                        help="Maximum number of tiles downloaded at once. "
+                        "Default 32.")
+    parser.add_argument("--max-rate", default=None, type=float,
+                        help="Maximum number of tile requests per second. "
+                        "Default: no limit.")
+    parser.add_argument("--retries", default=3, type=int,
+                        help="How many times a failed tile download is "
+                        "repeated before giving up. Default 3.")
+    parser.add_argument("--retry-budget", default=100, type=int,
+                        help="How many retries of failed tile downloads are "
+                        "allowed in total (with --serve, renewed whenever "
+                        "no map is being created). Default 100.")
+    parser.add_argument("--blank-failed-tiles", action="store_true",
+                        help="Render tiles which could not be downloaded "
+                        "blank instead of failing.")
+    parser.add_argument("--async-requests", default=0, type=int,
+                        help="Download tiles by asyncio with up to this many "
+                        "requests in flight (requires aiohttp). Default 0: "
+                        "download by --workers threads.")
+    parser.add_argument("--profile", default=None, metavar="REPORT.json",
+                        help="Write time spent in the stages of the run and "
+                        "counters of downloaded bytes, cache hits and retries "
+                        "as json into this file.")
+    parser.add_argument("--part-cache", default=None, metavar="DIR",
+                        help="Directory in which the map parts are kept "
+                        "between runs, so that a map of an edited path "
+                        "re-renders only the parts which have changed.")
+    parser.add_argument("--seed", action="store_true",
+                        help="Only download the tiles the map needs into the "
+                        "cache (skipping those which are there already), so "
+                        "that it can be created later with --offline.")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="With --seed, only print how many tiles (and "
+                        "about how many MB) need to be downloaded.")
+    parser.add_argument("--offline", action="store_true",
+                        help="Do not download anything, use only the tiles in "
+                        "the cache; fail if some are missing.")
+    parser.add_argument("--parallel-routes", default=2, type=int,
+                        help="With several gpx files, number of maps created "
+                        "at once. Default 2.")
+    parser.add_argument("--serve", default=None, metavar="[HOST:]PORT",
+                        help="Run as a service creating maps of gpx files "
+                        "uploaded over HTTP (see pathmap/service.py) instead "
+                        "of processing path.gpx.")
+    parser.add_argument("--service-workers", default=2, type=int,
+                        help="With --serve, number of maps created at once. "
+                        "Default 2.")
+    parser.add_argument("path.gpx", nargs="*",
+                        help="Gpx file with the path, or several of them, or "
+                        "directories with them. Tiles shared by the paths are "
+                        "downloaded only once.")
 
     args = vars(parser.parse_args())
+    if not args["path.gpx"] and not args["serve"]:
+        parser.error("the following arguments are required: path.gpx")
+
+    files = gpx_files(args["path.gpx"])
+    if not files:
+        outputs = []
+    elif len(files) == 1 and not os.path.isdir(args["path.gpx"][0]):
+        outputs = [args["output"] or files[0] + ".pdf"]
+    elif args["output"]:
+        os.makedirs(args["output"], exist_ok=True)
+        outputs = [os.path.join(args["output"], os.path.basename(f) + ".pdf") for f in files]
+    else:
+        outputs = [f + ".pdf" for f in files]
+
+    profiler = None
+    if args["profile"]:
+        profiler = profile.enable()
+
+    if args["cache"] and os.path.isdir(args["cache"]):
+        store = tilestore.DirectoryTileStore(args["cache"], ttl=args["cache_ttl"] * 24 * 3600)
+    else:
+        store = tilestore.SqliteTileStore(args["cache"],
+                                          ttl=args["cache_ttl"] * 24 * 3600,
+                                          max_bytes=args["cache_size"] * 2**20)
+
+    limiter = ratecontrol.AdaptiveLimiter(args["workers"], maximum=max(args["workers"], args["max_workers"]),
+                                          max_rate=args["max_rate"])
+
+    fetch_engine = None
+    if args["async_requests"]:
+        fetch_engine = asyncfetch.AsyncTileFetcher(concurrency=args["async_requests"], limiter=limiter)
+
+    g = cykloserver.CykloserverMapDownloader(tile_store=store,
+            decoded_cache_mb=args["memory_cache"], workers=args["workers"],
+            fetch_engine=fetch_engine, offline=args["offline"], limiter=limiter,
+            retries=args["retries"], retry_budget=args["retry_budget"],
+            blank_failed=args["blank_failed_tiles"])
+
+    #keyword arguments of path_surroundings and create_path_pdf
+    surroundings = dict(radius_pix=args["radius"], path_color=args["color"],
+            simplify_pix=args["simplify"], jobs=args["jobs"])
+    if args["part_cache"]:
+        surroundings["part_cache"] = partcache.PartCache(args["part_cache"], ttl=args["cache_ttl"] * 24 * 3600)
+    pdf_options = dict(backend=args["pdf_backend"], encoding=args["encoding"],
+            compress_level=args["compress_level"], quality=args["quality"])
+
+    #the profile report gets written in every mode, also when interrupted
+    try:
+        if args["serve"]:
+            serve(g, args["serve"], args["service_workers"], pdf_options, surroundings)
+            return
+
+        #segments of a path get mapped separately, not connected
+        paths = [g.gpx2path(f, split=True) for f in files]
 
-    output = args["path.gpx"] + ".pdf"
-    if args["output"]:
-        output = args["output"]
+        if args["seed"]:
+            seed(g, paths, args)
+            return
 
-    radius = int(args["radius"])
+        #one downloader (and session) for all the paths; parts get written to
+        #the pdfs as they are generated
+        getmap.create_path_pdfs(g, paths, outputs, concurrency=args["parallel_routes"],
+                pdf_options=pdf_options, **surroundings)
+    finally:
+        g.close()
+        if profiler is not None:
+            profiler.write_report(args["profile"], decoded_cache=g.decoded_tiles.stats(),
+                                  downloads=g.download_state())
 
-    g = cykloserver.CykloserverMapDownloader()
-    path = g.gpx2path(args["path.gpx"])
-    s = list(getmap.path_surroundings(g, path, radius_pix=args["radius"],
-            path_color=args["color"]))
-    getmap.create_path_pdf(s, output)
-    
 
 if __name__ == "__main__":
     main()
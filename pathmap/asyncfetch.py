@@ -0,0 +1,173 @@
+import asyncio
+import random
+from threading import Thread
+
+from . import profile
+from . ratecontrol import retry_after, check_tile_response, TileDownloadError, TileNotFoundError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class TileFetchError(TileDownloadError):
+    """Raised when a tile could not be downloaded even after retrying"""
+
+
+class AsyncTileFetcher:
+    """Downloads tiles by asyncio over pooled keep-alive connections
+
+    The event loop runs in its own thread, so the fetcher can be used from
+    ordinary (synchronous) code: submit() returns a
+    concurrent.futures.Future, fetch() blocks until the tile is downloaded.
+
+    Requires aiohttp.
+    """
+
+    #HTTP statuses worth retrying
+    retry_statuses = {429, 500, 502, 503, 504}
+
+    def __init__(self, concurrency=100, timeout=10, retries=4, backoff=0.5, max_backoff=10,
+                 limiter=None):
+        """
+        Arguments:
+
+        concurrency: maximum number of requests in flight (and of open
+            connections)
+        timeout: timeout of one request in seconds
+        retries: how many times a failed request gets repeated
+        backoff: the n-th retry waits random time up to backoff * 2**n
+            seconds...
+        max_backoff: ...but at most max_backoff seconds
+        limiter: ratecontrol.AdaptiveLimiter every request has to pass (in
+            addition to concurrency), or None
+        """
+
+        if aiohttp is None:
+            raise ImportError("AsyncTileFetcher requires aiohttp")
+
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+        #the semaphore and the session have to be created inside the loop
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+
+
+    async def _start(self):
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=60)
+        self._session = aiohttp.ClientSession(
+            connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+
+    def _delay(self, attempt):
+        """Return how long to wait before the attempt-th retry ("full
+        jitter" exponential backoff)"""
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+
+    async def _acquire(self):
+        """Wait until self.limiter allows a request"""
+
+        while True:
+            delay = self.limiter.try_acquire()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+
+    async def _fetch(self, url, cookies, headers):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                profile.count("http_retries")
+                await asyncio.sleep(self._delay(attempt - 1))
+
+            if self.limiter is not None:
+                await self._acquire()
+            start = self._loop.time()
+            outcome = "error"
+            wait = None
+            try:
+                async with self._semaphore:
+                    #cookies may change while the request waits for its turn;
+                    #getting them may block (renewing a token), so not in the
+                    #event loop
+                    request_cookies = cookies
+                    if callable(cookies):
+                        request_cookies = await self._loop.run_in_executor(None, cookies)
+                    async with self._session.get(url, cookies=request_cookies, headers=headers) as r:
+                        if r.status in self.retry_statuses:
+                            error = "HTTP status {}".format(r.status)
+                            if r.status in (429, 503):
+                                outcome = "throttled"
+                                wait = retry_after(r.headers.get("Retry-After"))
+                            continue
+                        try:
+                            check_tile_response(url, r.status, r.headers)
+                        except TileNotFoundError:
+                            #not an error of the server
+                            outcome = "ok"
+                            raise
+                        data = await r.read()
+                        outcome = "ok"
+                        return data
+
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = repr(e)
+            finally:
+                if self.limiter is not None:
+                    self.limiter.release(self._loop.time() - start, outcome, wait)
+
+        raise TileFetchError("Downloading {} failed {} times, last error: {}".format(
+            url, self.retries + 1, error))
+
+
+    def submit(self, url, cookies=None, headers=None):
+        """Start downloading url, return concurrent.futures.Future of its
+        content (bytes)
+
+        cookies is a dict, or a function returning the dict right before the
+        request is sent (called in a thread, not in the event loop).
+        """
+
+        return asyncio.run_coroutine_threadsafe(self._fetch(url, cookies, headers), self._loop)
+
+
+    def fetch(self, url, cookies=None, headers=None):
+        """Download url and return its content (bytes)
+
+        Raises TileFetchError if all the attempts fail, and
+        ratecontrol.TileNotFoundError or ratecontrol.BadResponseError (not
+        retried) if the server does not have the tile or answers by
+        something else than an image.
+        """
+
+        return self.submit(url, cookies, headers).result()
+
+
+    def fetch_many(self, urls, cookies=None, headers=None):
+        """Download urls concurrently, return list of their contents"""
+
+        futures = [self.submit(url, cookies, headers) for url in urls]
+        return [f.result() for f in futures]
+
+
+    def close(self):
+        """Close the connections and stop the event loop"""
+
+        if self._loop.is_closed():
+            return
+        asyncio.run_coroutine_threadsafe(self._session.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
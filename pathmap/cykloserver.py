@@ -1,33 +1,55 @@
-from PIL import Image, ImageDraw
 import requests
+import re
 import subprocess
 import time
 from lxml import html
-from lxml import etree
-from concurrent.futures import ThreadPoolExecutor
 import pyproj
-from threading import Lock
+import numpy as np
+from threading import Lock, Thread, Event
 
 from . getmap import MapDownloader
+from . jsworker import JSWorker
+from . ratecontrol import check_tile_response, BadResponseError
+from . tilestore import write_atomic
+from . import profile
+
+
+def _tt_descramble(data):
+    """Python version of cykloserver's javascript function __tt_descramble
+
+    Every three digits of data encode one character.
+    """
+
+    return "".join(chr(int(data[i:i+3])) for i in range(0, len(data) - len(data) % 3, 3))
 
 
 class CykloserverMapDownloader(MapDownloader):
     """Can download maps from cykloserver.cz/cykloatlas"""
 
-    def __init__(self):
+    def __init__(self, **kwargs):
+        """Keyword arguments are passed to MapDownloader"""
+
+        super().__init__(**kwargs)
 
         self.s = requests.Session()
 
         self.xres = 256
         self.yres = 256
 
+        self.provider = "cyklo_256"
+        self.zoom = 13
+
         self.last_token_acquired = 0
 
-        #longitude latitude
-        self.proj_to = pyproj.Proj("+init=EPSG:3857")
+        #the token is valid for token_lifetime seconds; a background thread
+        #renews it renew_margin seconds before it expires, as long as tiles
+        #are being downloaded
+        self.token_lifetime = 60
+        self.renew_margin = 10
+        self._last_download = 0
 
-        #display projection
-        self.proj_from = pyproj.Proj("+init=EPSG:4326")
+        #from longitude latitude to display projection
+        self._transformer = pyproj.Transformer.from_crs("EPSG:4326", "EPSG:3857", always_xy=True)
 
         #beta_x and beta_y for affine transformation of coordinates (after
         #changing projection) yielding the tiles coordinates. Approximated by
@@ -35,7 +57,19 @@ class CykloserverMapDownloader(MapDownloader):
         self.bx = [4.09597540e+03, 2.04431397e-04]
         self.by = [4.09571512e+03, -2.04373254e-04]
 
+
+    _runtime_attributes = MapDownloader._runtime_attributes + [
+        "_renew_lock", "_refresher", "_stop_refresher", "_js"]
+
+    def _init_runtime(self):
+        super()._init_runtime()
+
         self._renew_lock = Lock()
+        self._refresher = None
+        self._stop_refresher = Event()
+
+        self._js = JSWorker()
+
 
     def _get_js_output(self, script):
         """Run script in nodejs and return its output"""
@@ -70,16 +104,62 @@ class CykloserverMapDownloader(MapDownloader):
         }
 
 
+    #assignments of scrambled tokens in the script sent by tagettoken2.php
+    _token_re = re.compile(r"""(__tt_token[mtk])\s*=\s*__tt_descramble\(\s*(['"])(\d*)\2\s*\)""")
+
+    _descramble_js = """
+            function __tt_descramble(data) {
+                    var res = '';
+                    
+                    var pos = 0;
+                    
+                    var chnk = data.substr(pos, 3);
+                    while (chnk.length == 3) {
+                            res+= String.fromCharCode(Number(chnk));
+                            
+                            pos+= 3;
+                            chnk = data.substr(pos, 3);
+                    }
+                    
+                    return res;
+            }"""
+
+
+    def _parse_tokens(self, script):
+        """Return (tokenm, tokent, tokenk) from the script sent by
+        tagettoken2.php
+
+        The tokens get descrambled in Python; only if the script does not
+        look as expected, it is evaluated by the javascript worker.
+        """
+
+        tokens = {name: _tt_descramble(data) for name, _, data in self._token_re.findall(script)}
+        names = ["__tt_tokenm", "__tt_tokent", "__tt_tokenk"]
+        if all(name in tokens for name in names):
+            return tuple(tokens[name] for name in names)
+
+        return tuple(self._js.evaluate("\n".join((self._descramble_js, script)), names))
+
+
     def _renew_token(self):
-        """Prepare requests.Session self.s for subsequent downloading of
-        tiles
+        """Prepare a new requests.Session for subsequent downloading of
+        tiles and replace self.s by it
         """
 
-        if self.s:
-            self.s.close()
-        self.s = requests.Session()
+        with profile.stage("renew_token"):
+            self._acquire_token()
+        profile.count("token_renewals")
+
+
+    def _acquire_token(self):
+        """Go through the authentication of the cykloatlas web page with a
+        new session and replace self.s by it (see _renew_token)"""
+
+        acquired = time.time()
+
+        s = requests.Session()
         url_atlas = 'http://www.cykloserver.cz/cykloatlas/'
-        r_atlas = self.s.get(url_atlas)
+        r_atlas = s.get(url_atlas)
 
         root = html.fromstring(r_atlas.content)
 
@@ -90,46 +170,85 @@ class CykloserverMapDownloader(MapDownloader):
         url = [x for x in root.xpath('.//script') if x.get('src') and 'readauthloader2' in x.get('src')][0].get('src')
         self.atributes = self._url2dict(url)["atributes"]
         
-        self.s.get('http://www.cykloserver.cz/cykloatlas/readautha4b2.php', params=self.atributes)
+        s.get('http://www.cykloserver.cz/cykloatlas/readautha4b2.php', params=self.atributes)
 
         #http://www.cykloserver.cz/cykloatlas/tagetpass2.php sends javascript
         #which needs to be evaluted in order to get password
-        script = self.s.post('http://www.cykloserver.cz/cykloatlas/tagetpass2.php', data=self.atributes).content.decode('utf8')
-        script += "console.log(_tt_pass)"
-        tt_pass = self._get_js_output(script).strip()
+        script = s.post('http://www.cykloserver.cz/cykloatlas/tagetpass2.php', data=self.atributes).content.decode('utf8')
+        tt_pass = self._js.evaluate(script, ["_tt_pass"])[0].strip()
 
         atributes = self.atributes.copy()
         atributes["pass"] = tt_pass
 
         #http://www.cykloserver.cz/cykloatlas/tagettoken2.php sends tokens
-        #which need to be "descrambled". Easiest by evaluating the javascript.
-        script_parts = []
-        script_parts.append("""
-            function __tt_descramble(data) {
-                    var res = '';
-                    
-                    var pos = 0;
-                    
-                    var chnk = data.substr(pos, 3);
-                    while (chnk.length == 3) {
-                            res+= String.fromCharCode(Number(chnk));
-                            
-                            pos+= 3;
-                            chnk = data.substr(pos, 3);
-                    }
-                    
-                    return res;
-            }""")
-        script_parts.append(self.s.post('http://www.cykloserver.cz/cykloatlas/tagettoken2.php', data=atributes).content.decode('utf8'))
-        script_parts.append("""
-                console.log(__tt_tokenm)
-                console.log(__tt_tokent)
-                console.log(__tt_tokenk)
-            """)
-        tt_tokenm, tt_tokent, tt_tokenk = self._get_js_output("\n".join(script_parts)).split()
+        #which need to be "descrambled"
+        script = s.post('http://www.cykloserver.cz/cykloatlas/tagettoken2.php', data=atributes).content.decode('utf8')
+        tt_tokenm, tt_tokent, tt_tokenk = self._parse_tokens(script)
+
+        s.get('http://webtiles.timepress.cz/set_token', params={"token": tt_tokenk}).content.decode('utf8')
+
+        #that's it. We should be ok for next 60 seconds. Threads downloading
+        #with the old session keep it until they finish.
+        self.s = s
+        self.last_token_acquired = acquired
+
+
+    def _refresh_tokens(self):
+        """Body of the thread renewing the token shortly before it expires
+
+        Stops once no tile has been downloaded for token_lifetime seconds
+        (_ensure_token starts it again).
+        """
+
+        while True:
+            renew_at = self.last_token_acquired + self.token_lifetime - self.renew_margin
+            if self._stop_refresher.wait(max(0, renew_at - time.time())):
+                return
+            if time.time() - self._last_download > self.token_lifetime:
+                self._refresher = None
+                return
+
+            with self._renew_lock:
+                try:
+                    self._renew_token()
+                    failed = False
+                except Exception:
+                    failed = True
+
+            #downloading threads renew the token themselves once it expires
+            #(they must not wait for the lock meanwhile); try again a bit
+            #later
+            if failed and self._stop_refresher.wait(self.renew_margin / 2):
+                return
 
-        self.s.get('http://webtiles.timepress.cz/set_token', params={"token": tt_tokenk}).content.decode('utf8')
-        #that's it. We should be ok for next 60 seconds.
+
+    def _ensure_token(self):
+        """Renew the token if it has expired and keep it renewed in the
+        background"""
+
+        self._last_download = time.time()
+
+        if time.time() - self.last_token_acquired > self.token_lifetime:
+            with self._renew_lock:
+                if time.time() - self.last_token_acquired > self.token_lifetime:
+                    self._renew_token()
+
+        if self._refresher is None and not self._stop_refresher.is_set():
+            with self._renew_lock:
+                if self._refresher is None:
+                    self._refresher = Thread(target=self._refresh_tokens, daemon=True)
+                    self._refresher.start()
+
+
+    def close(self):
+        """Stop renewing the token, then as MapDownloader.close"""
+
+        self._stop_refresher.set()
+        refresher = self._refresher
+        if refresher is not None:
+            refresher.join()
+        self._js.close()
+        super().close()
 
 
     def lon_lat_to_tiles(self, lon, lat):
@@ -140,53 +259,56 @@ class CykloserverMapDownloader(MapDownloader):
         coordinates.
         """
 
-        trans_x, trans_y = pyproj.transform(self.proj_from, self.proj_to, lon, lat)
+        trans_x, trans_y = self._transformer.transform(lon, lat)
 
         return (self.bx[0] + self.bx[1] * trans_x, self.by[0] + self.by[1] * trans_y)
 
 
-    def _download_tile(self, x, y, filename):
-        """Downloads a tile whose upper left corner has coordinates x, y
-        
-        Tile gets saved as filename."""
+    def lon_lat_to_tiles_many(self, lons, lats):
+        """Convert arrays of longitudes and latitudes to arrays of x and y
+        tiles coordinates (see lon_lat_to_tiles), all at once"""
 
-        if time.time() - self.last_token_acquired > 60:
-            self._renew_lock.acquire()
-            if time.time() - self.last_token_acquired > 60:
-                self._renew_token()
-            self._renew_lock.release()
-        
-        r = self.s.get('http://webtiles.timepress.cz/cyklo_256/13/{}/{}'.format(x, y))
+        trans_x, trans_y = self._transformer.transform(
+            np.asarray(lons, dtype=np.float64), np.asarray(lats, dtype=np.float64))
 
-        with open(filename, "wb") as fout:
-            fout.write(r.content)
+        return (self.bx[0] + self.bx[1] * trans_x, self.by[0] + self.by[1] * trans_y)
 
 
-    def _tile_filename(self, x, y):
-        return "tile_{}_{}.png".format(x, y)
+    def _tile_url(self, x, y):
+        return 'http://webtiles.timepress.cz/{}/{}/{}/{}'.format(self.provider, self.zoom, x, y)
 
 
-    def get_tile(self, x, y):
-        """Return a tile (PIL.Image) whose upper left corner has coordinates x, y"""
+    def _download_cookies(self):
+        """Return cookies of the tile server (fetch_engine sends them instead
+        of self.s)"""
+
+        self._ensure_token()
+        return {c.name: c.value for c in self.s.cookies if c.domain.endswith("timepress.cz")}
 
-        filename = self._tile_filename(x, y)
-        im = None
-        while True:
-            try:
-                im = Image.open(filename)
 
-            except (IOError, FileNotFoundError):
-                self._download_tile(x, y, filename)
+    def _download_tile(self, x, y, filename=None):
+        """Downloads a tile whose upper left corner has coordinates x, y
+        
+        Returns content of the tile. If filename is given, the tile also gets
+        saved (atomically) as filename. Raises errors of
+        ratecontrol.check_tile_response if the server does not answer by an
+        image."""
 
-            else:
-                return im
+        self._ensure_token()
+        
+        with profile.stage("tile_request"):
+            r = self.s.get(self._tile_url(x, y))
+        check_tile_response("Tile {}, {}".format(x, y), r.status_code, r.headers)
 
+        if filename:
+            #an error page should not get saved as a tile
+            if not self._valid_tile(r.content):
+                raise BadResponseError("Tile {}, {} is not a valid image".format(x, y))
+            #other processes may be reading the file
+            write_atomic(filename, r.content)
 
-    def gpx2path(self, filename):
-        """Return list of (longitude, latitude) pairs stored as a trek in gpx file filename"""
+        return r.content
 
-        with open(filename, "r") as fin:
-            gpx = "".join(fin.readlines()[1:])
-            root = etree.fromstring(gpx)
-            return [(float(e.get('lon')), float(e.get('lat'))) for e in root.getchildren()[0].getchildren()[0].getchildren()]
 
+    def _tile_filename(self, x, y):
+        return "tile_{}_{}.png".format(x, y)
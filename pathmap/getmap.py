@@ -1,19 +1,148 @@
 from PIL import Image, ImageDraw
 from math import floor, sqrt
-from latex import build_pdf
 import tempfile
+import shapely
 from shapely.geometry import LineString, Point
-from shapely import affinity
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, Future
+from collections import deque
+from functools import partial
+import pickle
+import multiprocessing
+import time
+from io import BytesIO
+from threading import Lock
+import numpy as np
+
+from . tilestore import SqliteTileStore
+from . lru import ImageLRU
+from . ratecontrol import AdaptiveLimiter, ThrottledError, TileNotFoundError, BadResponseError, TileDownloadError
+from . import gpx
+from . import profile
+from . pdf import PdfWriter, encode_image, ENCODINGS
+from . partcache import part_key
+
+
+class MissingTileError(Exception):
+    """Raised when an offline MapDownloader needs a tile which is not in its
+    tile store"""
 
 
 class MapDownloader:
     """Base class for map providers with maps consisting of image tiles"""
 
-    def __init__(self):
+    #color of tiles which the server does not have (or which failed, see
+    #blank_failed)
+    blank_color = (255, 255, 255)
+
+    def __init__(self, tile_store=None, decoded_cache_mb=64, workers=10, fetch_engine=None,
+                 offline=False, limiter=None, retries=3, retry_budget=100, missing_ttl=3600,
+                 blank_failed=False, throttled_retries=20):
+        """
+        Arguments:
+
+        tile_store: tilestore.TileStore keeping downloaded tiles between runs;
+            default is tilestore.SqliteTileStore at its default location
+        decoded_cache_mb: size in MB of the in-memory cache of decoded tiles,
+            which spares decoding tiles shared by consecutive parts of a path
+        workers: initial number of tiles downloaded at once
+        fetch_engine: asyncfetch.AsyncTileFetcher downloading tiles from
+            _tile_url() instead of _download_tile() (and instead of the
+            threads), or None
+        offline: never download tiles, raise MissingTileError for tiles
+            which are not in tile_store
+        limiter: ratecontrol.AdaptiveLimiter adapting the number of tiles
+            downloaded at once to the server (and limiting the requests per
+            second), by default one starting at workers and going up to
+            max(workers, 32). fetch_engine should get the same one.
+        retries: how many times a failed download of a tile (an error, an
+            error page or not a valid image) gets repeated before giving up
+            by TileDownloadError; throttled requests do not count
+        retry_budget: how many retries of failed downloads are allowed in
+            total until reset_retry_budget(), downloads failing after that
+            give up at once; throttled requests do not count either (the
+            limiter slows the downloads down instead)
+        missing_ttl: tiles which the server does not have are rendered
+            blank and not requested again for missing_ttl seconds (they
+            get marked in tile_store, so this holds for later runs, other
+            processes and offline too)
+        blank_failed: render tiles which could not be downloaded blank
+            instead of raising TileDownloadError
+        throttled_retries: how many times a throttled download of a tile
+            gets repeated (after the pause of the limiter) before giving up
+            by TileDownloadError, so that a server which keeps throttling
+            does not keep the downloader retrying forever
+        """
+
         self.xres = None
         self.yres = None
 
+        #name of the map and its zoom level, identify tiles in the tile store
+        self.provider = None
+        self.zoom = None
+
+        self.tile_store = tile_store if tile_store is not None else SqliteTileStore()
+        self.decoded_cache_mb = decoded_cache_mb
+
+        self.workers = workers
+        self.fetch_engine = fetch_engine
+        self.limiter = limiter if limiter is not None else AdaptiveLimiter(workers, maximum=max(workers, 32))
+        self.offline = offline
+        self.retries = retries
+        self.retry_budget = retry_budget
+        self.missing_ttl = missing_ttl
+        self.blank_failed = blank_failed
+        self.throttled_retries = throttled_retries
+
+        self._init_runtime()
+
+
+    #attributes created by _init_runtime, which are not pickled
+    _runtime_attributes = ["decoded_tiles", "_executor", "_executor_lock", "_pending", "_pending_lock",
+                           "_missing", "_retries_left"]
+
+    def _init_runtime(self):
+        """Create caches, threads and locks, i. e. the state which is not
+        shared with copies of the downloader in other processes"""
+
+        self.decoded_tiles = ImageLRU(self.decoded_cache_mb * 2**20)
+
+        self._executor = None
+        self._executor_lock = Lock()
+
+        #futures of tiles being downloaded by tile keys (see _claim)
+        self._pending = {}
+        self._pending_lock = Lock()
+
+        #expiration times (as time.time()) of marks of tiles which the server
+        #does not have, by keys; the marks are kept in the tile store too
+        self._missing = {}
+        self._retries_left = self.retry_budget
+
+
+    def __getstate__(self):
+        """Copies of the downloader in other processes share only the tile
+        store (if it is on disk) with it and download without fetch_engine"""
+
+        state = self.__dict__.copy()
+        for name in self._runtime_attributes:
+            del state[name]
+        state["fetch_engine"] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_runtime()
+
+
+    def gpx2path(self, filename, split=False):
+        """Return (longitude, latitude) pairs stored as treks (or routes, if
+        there are no treks) in gpx file filename, as numpy array of shape
+        (n, 2), or with split=True as a list of such arrays, one per trek
+        segment (or route)"""
+
+        return gpx.read_gpx(filename, split=split, prefer_tracks=True)
+
 
     def lon_lat_to_tiles(self, lon, lat):
         """Should convert longitude and latitude to (x, y) tiles coordinates.
@@ -26,12 +155,541 @@ class MapDownloader:
         raise NotImplementedError("Please implement this method")
 
 
-    def get_tile(self, x, y):
-        """Should return a tile (PIL.Image) whose upper left corner has coordinates x, y"""
+    def lon_lat_to_tiles_many(self, lons, lats):
+        """Convert arrays of longitudes and latitudes to arrays (numpy) of x
+        and y tiles coordinates
+
+        Calls lon_lat_to_tiles for every point, subclasses should provide a
+        faster implementation.
+        """
+
+        xys = [self.lon_lat_to_tiles(lon, lat) for lon, lat in zip(lons, lats)]
+        xs = np.array([xy[0] for xy in xys], dtype=np.float64)
+        ys = np.array([xy[1] for xy in xys], dtype=np.float64)
+        return xs, ys
+
+
+    def _download_tile(self, x, y):
+        """Should download a tile whose upper left corner has coordinates x, y
+        and return its content (bytes of an image file)
+
+        Should raise ratecontrol.ThrottledError if the server asks to slow
+        down, ratecontrol.TileNotFoundError if it does not have the tile and
+        ratecontrol.BadResponseError if it answers by an error (see
+        ratecontrol.check_tile_response).
+        """
 
         raise NotImplementedError("Please implement this method")
 
 
+    def _tile_url(self, x, y):
+        """Should return url of a tile whose upper left corner has
+        coordinates x, y (needed only by fetch_engine)"""
+
+        raise NotImplementedError("Please implement this method")
+
+
+    def _download_cookies(self):
+        """Return dict of cookies which fetch_engine should send with a tile
+        request
+
+        Called right before each request, so it may renew authentication.
+        """
+
+        return None
+
+
+    def _tile_key(self, x, y):
+        """Return the key of tile x, y in the tile store"""
+
+        return (self.provider, self.zoom, x, y)
+
+
+    def _decode_tile(self, data):
+        """Return PIL.Image decoded from bytes data, or None if data is not
+        a valid image"""
+
+        with profile.stage("decode"):
+            try:
+                im = Image.open(BytesIO(data))
+                im.load()
+            except IOError:
+                return None
+        return im
+
+
+    def get_tile(self, x, y):
+        """Return a tile (PIL.Image) whose upper left corner has coordinates x, y
+
+        The tile is looked up in the cache of decoded tiles and in the tile
+        store first and downloaded only if it is not there.
+        """
+
+        im = self.decoded_tiles.get(self._tile_key(x, y))
+        if im is None:
+            profile.count("decoded_cache_misses")
+            im = self._load_tile(x, y)
+        else:
+            profile.count("decoded_cache_hits")
+        return im
+
+
+    def _load_tile(self, x, y, data=None):
+        """Decode tile x, y from the tile store (unless its bytes are passed
+        as data) or download it, and put it into the cache of decoded tiles"""
+
+        key = self._tile_key(x, y)
+        if data is None:
+            data = self.tile_store.get(key)
+
+        im = None
+        if data is not None:
+            profile.count("store_hits")
+            im = self._decode_tile(data)
+
+        if im is None:
+            #joins the download if the tile is being downloaded already
+            im = self._fetch_decoded(x, y)
+            if im is None:
+                #blank stand-ins are not cached, the tile may appear (or the
+                #server recover) meanwhile
+                return self.blank_tile()
+
+        self.decoded_tiles.put(key, im)
+        return im
+
+
+    def _fetch_decoded(self, x, y):
+        """Download tile x, y and return it decoded, or None if the server
+        does not have it (or if it failed and self.blank_failed)"""
+
+        try:
+            im = self._decode_tile(self._fetch_tile(x, y))
+            if im is None:
+                raise TileDownloadError("Tile {} cannot be decoded".format(self._tile_key(x, y)))
+            return im
+        except TileNotFoundError:
+            return None
+        except TileDownloadError:
+            if not self.blank_failed:
+                raise
+            profile.count("failed_tiles")
+            return None
+
+
+    def blank_tile(self):
+        """Return a tile (PIL.Image) of self.blank_color standing in for a
+        tile which is missing"""
+
+        return Image.new("RGB", (self.xres, self.yres), self.blank_color)
+
+
+    def _known_missing(self, key):
+        """Return whether the server has said lately (to this downloader or
+        to another one sharing the tile store) that it does not have tile
+        key"""
+
+        until = self._missing.get(key)
+        if until is None:
+            until = self.tile_store.get_missing_many([key]).get(key)
+            if until is None:
+                return False
+            self._missing[key] = until
+        if until <= time.time():
+            self._missing.pop(key, None)
+            return False
+        return True
+
+
+    def _remember_missing(self, key):
+        profile.count("missing_tiles")
+        until = time.time() + self.missing_ttl
+        self._missing[key] = until
+        self.tile_store.put_missing(key, until)
+
+
+    def _stored_and_missing(self, keys):
+        """Return (stored, missing): sets of those of keys which are in the
+        tile store and of those which are known to be missing on the
+        server"""
+
+        stored = self.tile_store.contains_many(keys)
+        missing = self.tile_store.get_missing_many([key for key in keys if key not in stored])
+        self._missing.update(missing)
+        return stored, set(missing)
+
+
+    def _spend_retry(self, key, failures, error):
+        """Account for a failed download of tile key, its failures-th one
+        (not counting throttling)
+
+        Raises TileDownloadError (caused by error) if the tile has been
+        retried self.retries times already, or if the retry budget is used
+        up.
+        """
+
+        if failures > self.retries:
+            raise TileDownloadError("Downloading tile {} failed {} times, last error: {}".format(
+                key, failures, error)) from error
+
+        with self._pending_lock:
+            if self._retries_left <= 0:
+                raise TileDownloadError(
+                    "Downloading tile {} failed and all {} retries allowed have been used, "
+                    "last error: {}".format(key, self.retry_budget, error)) from error
+            self._retries_left -= 1
+        profile.count("retries")
+
+
+    def reset_retry_budget(self):
+        """Allow self.retry_budget retries again"""
+
+        with self._pending_lock:
+            self._retries_left = self.retry_budget
+
+
+    def _valid_tile(self, data):
+        """Return whether bytes data look like a valid image"""
+
+        try:
+            Image.open(BytesIO(data)).verify()
+        except Exception:
+            return False
+        return True
+
+
+    def _claim(self, key):
+        """Return (future, owner): future of bytes of tile key being
+        downloaded, and whether the caller has just registered it
+
+        Only the owner downloads the tile (and passes the future to
+        _resolve), the others wait for the future, so that concurrent
+        requests for a tile share one download.
+        """
+
+        with self._pending_lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future, False
+            future = self._pending[key] = Future()
+            return future, True
+
+
+    def _forget(self, key):
+        with self._pending_lock:
+            self._pending.pop(key, None)
+
+
+    def _resolve(self, key, future, fetch):
+        """Set result of future claimed by _claim to fetch() (or its
+        exception)"""
+
+        try:
+            data = fetch()
+        except BaseException as e:
+            self._forget(key)
+            future.set_exception(e)
+        else:
+            self._forget(key)
+            future.set_result(data)
+
+
+    def _fetch_tile(self, x, y):
+        """Download tile x, y into the tile store and return its bytes
+
+        If another thread downloads the tile already, wait for it instead.
+        """
+
+        key = self._tile_key(x, y)
+        future, owner = self._claim(key)
+        if owner:
+            self._resolve(key, future, lambda: self._download_to_store(x, y))
+        else:
+            profile.count("shared_downloads")
+        return future.result()
+
+
+    def _download_to_store(self, x, y):
+        """Download tile x, y into the tile store and return its bytes,
+        unless another process sharing the tile store has just done so
+
+        Processes exclude each other by the lock of the tile in the store
+        (see tilestore.TileStore.lock), and those which have waited for it
+        find the tile stored.
+        """
+
+        key = self._tile_key(x, y)
+        if self._known_missing(key):
+            raise TileNotFoundError("Tile {} is known to be missing".format(key))
+        if self.offline:
+            raise MissingTileError("Tile {} is not in the tile store and downloading is off".format(key))
+
+        with self.tile_store.lock(key):
+            data = self.tile_store.get(key)
+            if data is not None and self._valid_tile(data):
+                profile.count("store_hits")
+                return data
+            return self._download_retrying(x, y)
+
+
+    def _download_retrying(self, x, y):
+        """Download tile x, y into the tile store, retrying failed downloads
+        (see _spend_retry), and return its bytes
+
+        Raises TileNotFoundError if the server does not have the tile, and
+        TileDownloadError if it has been throttled more than
+        self.throttled_retries times.
+        """
+
+        key = self._tile_key(x, y)
+        failures = 0
+        throttled = 0
+        while True:
+            try:
+                if self.fetch_engine is None:
+                    data = self._download_limited(x, y)
+                else:
+                    data = self._download_by_engine(x, y)
+            except TileNotFoundError:
+                self._remember_missing(key)
+                raise
+            except TileDownloadError:
+                #fetch_engine has retried already
+                raise
+            except ThrottledError as e:
+                #not charged to the retry budget, the limiter pauses the
+                #downloads
+                throttled += 1
+                if throttled > self.throttled_retries:
+                    raise TileDownloadError("Downloading tile {} has been throttled {} times".format(
+                        key, throttled)) from e
+            except Exception as e:
+                failures += 1
+                self._spend_retry(key, failures, e)
+            else:
+                self.tile_store.put(key, data)
+                return data
+
+
+    def _download_limited(self, x, y):
+        """Download tile x, y by _download_tile once self.limiter allows it
+        and return its bytes
+
+        Raises BadResponseError if they are not a valid image, and passes
+        on errors of _download_tile (the limiter slows the following
+        downloads down on them, except TileNotFoundError).
+        """
+
+        self.limiter.acquire()
+        start = time.monotonic()
+        outcome = "error"
+        retry_after = None
+        try:
+            with profile.stage("download"):
+                data = self._download_tile(x, y)
+            profile.count("downloads")
+            profile.count("bytes_downloaded", len(data))
+            if not self._valid_tile(data):
+                raise BadResponseError("Tile {} is not a valid image".format(self._tile_key(x, y)))
+            outcome = "ok"
+            return data
+        except ThrottledError as e:
+            profile.count("throttled")
+            outcome = "throttled"
+            retry_after = e.retry_after
+            raise
+        except TileNotFoundError:
+            #the server is fine
+            outcome = "ok"
+            raise
+        finally:
+            self.limiter.release(time.monotonic() - start, outcome, retry_after)
+
+
+    def _download_by_engine(self, x, y):
+        """Download tile x, y by fetch_engine (which limits its requests
+        itself) and return its bytes; raise BadResponseError if they are
+        not a valid image"""
+
+        with profile.stage("download"):
+            data = self.fetch_engine.fetch(self._tile_url(x, y), cookies=self._download_cookies)
+        profile.count("downloads")
+        profile.count("bytes_downloaded", len(data))
+        if not self._valid_tile(data):
+            raise BadResponseError("Tile {} is not a valid image".format(self._tile_key(x, y)))
+        return data
+
+
+    def download_state(self):
+        """Return dict describing the state of downloading (see
+        ratecontrol.AdaptiveLimiter.state)"""
+
+        state = self.limiter.state()
+        state["pending"] = len(self._pending)
+        return state
+
+
+    def _fetch_tile_async(self, x, y, result=None, failures=0):
+        """Start downloading tile x, y into the tile store by fetch_engine
+
+        Returns concurrent.futures.Future of its bytes. Unlike downloads in
+        threads, the download does not take the lock of the tile in the tile
+        store (which would block the event loop or a thread per request).
+        """
+
+        if result is None:
+            result = Future()
+        key = self._tile_key(x, y)
+
+        def store(f):
+            try:
+                data = f.result()
+                profile.count("downloads")
+                profile.count("bytes_downloaded", len(data))
+                if not self._valid_tile(data):
+                    raise BadResponseError("Tile {} is not a valid image".format(key))
+                self.tile_store.put(key, data)
+            except TileNotFoundError as e:
+                self._remember_missing(key)
+                result.set_exception(e)
+            except BadResponseError as e:
+                try:
+                    self._spend_retry(key, failures + 1, e)
+                except TileDownloadError as error:
+                    result.set_exception(error)
+                else:
+                    self._fetch_tile_async(x, y, result, failures + 1)
+            except Exception as e:
+                result.set_exception(e)
+            else:
+                result.set_result(data)
+
+        future = self.fetch_engine.submit(self._tile_url(x, y), cookies=self._download_cookies)
+        #storing should not block the event loop
+        future.add_done_callback(lambda f: self.executor.submit(store, f))
+        return result
+
+
+    @property
+    def executor(self):
+        """ThreadPoolExecutor used for downloading, with enough threads for the
+        highest number of downloads self.limiter allows"""
+
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max(self.workers, self.limiter.maximum))
+            return self._executor
+
+
+    def _queue_downloads(self, tiles):
+        """Queue downloading of tiles (list of (x, y)) into the tile store,
+        skipping those which are queued already (and all of them when
+        offline)"""
+
+        if self.offline:
+            return
+
+        for x, y in tiles:
+            key = self._tile_key(x, y)
+            if self._known_missing(key):
+                continue
+            future, owner = self._claim(key)
+            if not owner:
+                continue
+
+            if self.fetch_engine is None:
+                task = self.executor.submit(self._resolve, key, future, partial(self._download_to_store, x, y))
+                task.add_done_callback(partial(self._cancelled, key, future))
+            else:
+                self._fetch_tile_async(x, y, future)
+                future.add_done_callback(lambda f, key=key: self._forget(key))
+
+
+    def _cancelled(self, key, future, task):
+        """Cancel future of tile key if its download task has been cancelled
+        (by close()), so that nobody waits for it forever"""
+
+        if task.cancelled():
+            self._forget(key)
+            future.cancel()
+
+
+    def prefetch(self, tiles):
+        """Queue downloading of those tiles (list of (x, y)) which are not in
+        the tile store (nor known to be missing on the server), so that they
+        are ready once get_tile() asks for them
+
+        Tiles get downloaded in the order given.
+        """
+
+        tiles = list(dict.fromkeys(tiles))
+        stored, missing = self._stored_and_missing([self._tile_key(x, y) for x, y in tiles])
+        self._queue_downloads([(x, y) for x, y in tiles
+                               if self._tile_key(x, y) not in stored and self._tile_key(x, y) not in missing])
+
+
+    def fetch_tiles(self, tiles):
+        """Make sure tiles (list of (x, y)) are in the tile store, downloading
+        the missing ones in parallel; block until they are there (except
+        those which the server does not have, and with self.blank_failed
+        those which could not be downloaded)"""
+
+        self.prefetch(tiles)
+        for x, y in tiles:
+            future = self._pending.get(self._tile_key(x, y))
+            if future is not None:
+                try:
+                    future.result()
+                except TileNotFoundError:
+                    pass
+                except TileDownloadError:
+                    if not self.blank_failed:
+                        raise
+                    profile.count("failed_tiles")
+
+
+    def get_tiles(self, tiles, parallel=False):
+        """Return a list of tiles (PIL.Image) for a list of (x, y) coordinates
+        of their upper left corners
+
+        Tiles not in the cache of decoded tiles but present in the tile store
+        are read from the store at once.
+
+        If parallel=True: try to speed up the downloading of missing tiles by
+        downloading them in self.executor (or by self.fetch_engine, if set).
+        Default False.
+        """
+
+        images = [self.decoded_tiles.get(self._tile_key(x, y)) for x, y in tiles]
+        missing = [xy for xy, im in zip(tiles, images) if im is None]
+        profile.count("decoded_cache_hits", len(tiles) - len(missing))
+        profile.count("decoded_cache_misses", len(missing))
+        if not missing:
+            return images
+
+        stored = self.tile_store.get_many([self._tile_key(x, y) for x, y in missing])
+        datas = [stored.get(self._tile_key(x, y)) for x, y in missing]
+
+        if parallel:
+            self._queue_downloads([xy for xy, data in zip(missing, datas) if data is None])
+
+        loaded = iter([self._load_tile(x, y, data) for (x, y), data in zip(missing, datas)])
+        return [im if im is not None else next(loaded) for im in images]
+
+
+    def close(self):
+        """Stop the downloading and close the tile store (and fetch_engine)"""
+
+        if self.fetch_engine is not None:
+            self.fetch_engine.close()
+
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+        self.tile_store.close()
+
+
     def get_rect(self, lon1, lat1, lon2, lat2, parallel=True):
         """Return a PIL.Image of a rectangular map whose upper left and bottom
         right corner correspond to longitude, latitude (lon1, lat1) and (lon2,
@@ -55,52 +713,62 @@ class MapDownloader:
         needed calls to get_tile() asynchronously. Default False.
         """
 
-        big = Image.new("RGB", (int((x2-x1) * self.xres), int((y2-y1) * self.yres)))
+        with profile.stage("get_rect_tiles"):
+            big = Image.new("RGB", (int((x2-x1) * self.xres), int((y2-y1) * self.yres)))
 
-        #rows and columns of tiles containing (x1, y1) and (x2, y2)
-        tiles_x1 = floor(x1)
-        tiles_x2 = floor(x2)
-        tiles_y1 = floor(y1)
-        tiles_y2 = floor(y2)
+            #row and column of tile containing (x1, y1)
+            tiles_x1 = floor(x1)
+            tiles_y1 = floor(y1)
 
-        xdiff_pix = int(self.xres * (x1 - tiles_x1))
-        ydiff_pix = int(self.yres * (y1 - tiles_y1))
+            xdiff_pix = int(self.xres * (x1 - tiles_x1))
+            ydiff_pix = int(self.yres * (y1 - tiles_y1))
 
-        #acquire each tile needed and paste it into big
-        if parallel:
-            tiles_needed = [(x, y) for y in range(tiles_y1, tiles_y2+1) for x in range(tiles_x1, tiles_x2+1)]
-            
-            tpe = ThreadPoolExecutor(10)
-            images = tpe.map(self.get_tile, *zip(*tiles_needed))
+            #acquire each tile needed and paste it into big
+            tiles_needed = rect_tiles(x1, y1, x2, y2)
+            images = self.get_tiles(tiles_needed, parallel=parallel)
             for im, xy in zip(images, tiles_needed):
                 x, y = xy
                 big.paste(im, ((x-tiles_x1) * self.xres - xdiff_pix, (y-tiles_y1) * self.yres - ydiff_pix))
 
-        else:
-            for y in range(tiles_y1, tiles_y2+1):
-                for x in range(tiles_x1, tiles_x2+1):
-                    im = self.get_tile(x, y)
-                    big.paste(im, ((x-tiles_x1) * self.xres - xdiff_pix, (y-tiles_y1) * self.yres - ydiff_pix))
-
         return big
             
 
+def rect_tiles(x1, y1, x2, y2):
+    """Return a list of (x, y) coordinates of tiles needed for a rectangular
+    map whose upper left and bottom right corner have tiles coordinates (x1,
+    y1) and (x2, y2) respectively"""
+
+    return [(x, y) for y in range(floor(y1), floor(y2)+1) for x in range(floor(x1), floor(x2)+1)]
+
+
 def path_surroundings(md, path, *,
                       radius_pix=130,
                       maxwidth_pix=1000,
                       maxheight_pix=800,
                       maxdist_pix=500,
                       path_color=(255, 100, 0),
-                      shorten_by_rotating=True):
+                      shorten_by_rotating=True,
+                      prefetch=True,
+                      simplify_pix=None,
+                      jobs=1,
+                      part_cache=None,
+                      stable_bites=None,
+                      executor=None):
     """Create a generator of map images following a given path
 
+    The path gets split into parts (and their tiles queued for downloading,
+    see prefetch) at once, the images get rendered as the generator is
+    iterated.
+
     Arguments:
 
     md: MapDownloader, should provide get_rect() and get_rect_tiles() methods
-        returning map images and xres, yres properties specifying width and height
-        of a tile
-    path: list of (longitude, latitude) coordinates representing the trip for
-        which map should be generated
+        returning map images, lon_lat_to_tiles_many() and prefetch() methods
+        and xres, yres properties specifying width and height of a tile
+    path: list (or numpy array) of (longitude, latitude) coordinates
+        representing the trip for which map should be generated; or a list
+        of such numpy arrays (e. g. gpx2path(filename, split=True)), segments
+        of the trip which do not get connected
     radius_pix: distance from the path in pixels which should be covered by the
         generated map
     maxwidth_pix: maximum width of one map part in pixels
@@ -114,18 +782,390 @@ def path_surroundings(md, path, *,
         high, but usually not very wide (2 * radius). By rotating it by 90°, we
         can greatly reduce its height and thus maybe reduce the number of pages
         of the pdf file generated later by create_path_pdf. Default True.
+    prefetch: whether to queue downloading of all the tiles the path needs
+        before generating the first image (when this is called), so that
+        downloading overlaps with composing the images. Default True.
+    simplify_pix: if given, the path gets simplified (by Douglas-Peucker
+        algorithm) before it is split into parts, so that it differs from
+        the original path by at most simplify_pix pixels. Saves composing
+        the map from many tiny lines of dense recordings. Default None.
+    jobs: number of processes rendering the images. With jobs > 1, md gets
+        pickled to the processes and they read the tiles from its tile store
+        (which should therefore be on disk, e. g. SqliteTileStore); the
+        images are still generated in the order of the path. Default 1.
+    part_cache: partcache.PartCache keeping the images between runs; images
+        of bites which are there are not rendered again (and their tiles
+        are not downloaded). Default None.
+    stable_bites: whether to cut the path into bites so that their bounds
+        do not move when the path gets edited elsewhere (see
+        _anchor_segments), at the cost of a few more images; this lets
+        part_cache reuse the unchanged bites of an edited path. Default
+        True with part_cache, False otherwise.
+    executor: ProcessPoolExecutor made by render_pool(md, jobs) rendering
+        the images instead of a pool of jobs processes started (and
+        stopped) by this call; it stays running for other paths. Default
+        None.
+    """
+
+    if stable_bites is None:
+        stable_bites = part_cache is not None
+
+    radius = radius_pix / md.xres
+    with profile.stage("split_path"):
+        bites = _path_bites(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix, simplify_pix,
+                            stable_bites)
+
+    render_args = (radius, maxwidth_pix, maxheight_pix, path_color, shorten_by_rotating)
+    keys = [None] * len(bites)
+    cached = [False] * len(bites)
+    if part_cache is not None:
+        keys = [part_key(md, bite, x_range, y_range, *render_args) for bite, x_range, y_range in bites]
+        cached = [part_cache.contains(key) for key in keys]
+
+    #tiles of the bites which get rendered, shared by the prefetch and the
+    #rendering (the corridor of a long bite takes a while to compute)
+    with profile.stage("bite_tiles"):
+        tiles = [None if hit else _bite_tiles(md, bite, radius) for (bite, _, _), hit in zip(bites, cached)]
+
+    if prefetch:
+        with profile.stage("prefetch"):
+            #prefetch() skips the duplicates, keeping order of the path
+            md.prefetch([xy for bite_tiles in tiles if bite_tiles is not None for xy in bite_tiles])
+
+    return _render_bites(md, bites, keys, cached, tiles, render_args, part_cache, jobs, executor)
+
+
+def _render_bites(md, bites, keys, cached, tiles, render_args, part_cache, jobs, executor):
+    """Generate images of bites for path_surroundings, taking the cached
+    ones from part_cache (keys, cached and tiles are lists with an item for
+    every bite, see path_surroundings)"""
+
+    if executor is not None:
+        yield from _render_in_pool(md, executor, jobs, bites, keys, cached, tiles, render_args, part_cache)
+        return
+
+    if jobs <= 1:
+        for (bite, x_range, y_range), key, hit, bite_tiles in zip(bites, keys, cached, tiles):
+            im = _cached_part(part_cache, key, hit)
+            if im is None:
+                with profile.stage("render_bite"):
+                    im = _render_bite(md, bite, x_range, y_range, *render_args, tiles=bite_tiles)
+                _store_part(part_cache, key, im)
+            yield im
+            del im
+        return
+
+    with render_pool(md, jobs) as pool:
+        yield from _render_in_pool(md, pool, jobs, bites, keys, cached, tiles, render_args, part_cache)
+
+
+def render_pool(md, jobs):
+    """Return ProcessPoolExecutor with jobs processes rendering images of
+    md for path_surroundings (see its executor argument)
+
+    md gets pickled to the processes now, they read the tiles from its tile
+    store (which should therefore be on disk, e. g. SqliteTileStore).
+    """
+
+    return ProcessPoolExecutor(jobs, mp_context=_worker_context(), initializer=_init_render_worker,
+                               initargs=(pickle.dumps(md),))
+
+
+def _render_in_pool(md, pool, jobs, bites, keys, cached, tiles, render_args, part_cache):
+    """Generate images of bites rendered by pool (of render_pool), in their
+    order, keeping at most about 2 * jobs of them in memory"""
+
+    rendered = deque()
+    for (bite, x_range, y_range), key, hit, bite_tiles in zip(bites, keys, cached, tiles):
+        im = _cached_part(part_cache, key, hit)
+        if im is not None:
+            future = Future()
+            future.set_result(im)
+            rendered.append((future, None))
+            del im
+        else:
+            #workers get the tiles from the tile store
+            with profile.stage("fetch_bite_tiles"):
+                md.fetch_tiles(bite_tiles)
+            rendered.append((pool.submit(_render_bite_in_worker, bite, x_range, y_range, *render_args,
+                                         tiles=bite_tiles), key))
+
+        #do not keep too many finished images in memory
+        if len(rendered) >= 2 * max(jobs, 1):
+            yield _rendered_result(part_cache, *rendered.popleft())
+
+    while rendered:
+        yield _rendered_result(part_cache, *rendered.popleft())
+
+
+def _rendered_result(part_cache, future, key):
+    """Wait for future of a bite rendered by a worker process (the stages
+    inside the workers are not profiled) and store it as part key of
+    part_cache (unless key is None)"""
+
+    with profile.stage("render_bite_wait"):
+        im = future.result()
+    _store_part(part_cache, key, im)
+    return im
+
+
+def _cached_part(part_cache, key, hit):
+    """Return image of part key from part_cache if it has been there (hit)
+    when the bites were planned, else None"""
+
+    if part_cache is None:
+        return None
+    im = part_cache.get(key) if hit else None
+    profile.count("part_cache_hits" if im is not None else "part_cache_misses")
+    return im
+
+
+def _store_part(part_cache, key, im):
+    if part_cache is not None and key is not None:
+        with profile.stage("part_cache_put"):
+            part_cache.put(key, im)
+
+
+def create_path_pdfs(md, paths, filenames, *, concurrency=2, pdf_options=None, **options):
+    """Create a pdf file for every path, as
+    create_path_pdf(path_surroundings(md, path, **options), filename, **pdf_options)
+    does, downloading each tile shared by several paths only once
+
+    Tiles of the paths get queued for downloading in the order of the paths
+    (path_surroundings queues them as it gets called), while concurrency
+    paths at a time are rendered by threads.
+
+    Arguments:
+
+    md: MapDownloader
+    paths: list of paths, see path_surroundings
+    filenames: list of names of the pdf files, one for every path
+    concurrency: number of paths rendered at once
+    pdf_options: dict of keyword arguments of create_path_pdf
+    options: keyword arguments of path_surroundings
+    """
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        futures = [executor.submit(create_path_pdf, path_surroundings(md, path, **options), filename,
+                                   **(pdf_options or {}))
+                   for path, filename in zip(paths, filenames)]
+        for future in futures:
+            future.result()
+
+
+def route_tiles(md, path, *,
+                radius_pix=130,
+                maxwidth_pix=1000,
+                maxheight_pix=800,
+                maxdist_pix=500,
+                simplify_pix=None,
+                stable_bites=False):
+    """Return a list of (x, y) tiles which path_surroundings needs for path
+    (with the same arguments), without duplicates, in the order of the path
+
+    See path_surroundings for the arguments.
+    """
+
+    radius = radius_pix / md.xres
+    tiles = []
+    for bite, _, _ in _path_bites(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix, simplify_pix,
+                                  stable_bites):
+        tiles.extend(_bite_tiles(md, bite, radius))
+    return list(dict.fromkeys(tiles))
+
+
+def seed_estimate(md, tiles, default_tile_bytes=20*1024):
+    """Return how many of tiles (list of (x, y)) are missing in the tile
+    store of md and how many bytes downloading them should take
+
+    The size of a tile is estimated as the average size of the stored
+    tiles of md's provider and zoom (default_tile_bytes if there are none).
+
+    Returns dict with keys "tiles", "stored", "unavailable" (known to be
+    missing on the server, not downloaded), "missing" and "bytes".
+    """
+
+    tiles = list(dict.fromkeys(tiles))
+    stored, unavailable = md._stored_and_missing([md._tile_key(x, y) for x, y in tiles])
+    average = md.tile_store.average_size(md.provider, md.zoom) or default_tile_bytes
+    missing = len(tiles) - len(stored) - len(unavailable)
+    return {"tiles": len(tiles), "stored": len(stored), "unavailable": len(unavailable), "missing": missing,
+            "bytes": int(missing * average)}
+
+
+def seed_tiles(md, tiles, batch=100):
+    """Download those of tiles (list of (x, y)) which are not in the tile
+    store of md
+
+    Yields (done, total) numbers of missing tiles after every batch of
+    them is stored. Tiles
+    get stored as they come, so interrupted seeding continues where it
+    stopped when run again. Tiles which the server does not have are
+    marked in the store, so they are skipped too (until md.missing_ttl
+    passes).
+    """
+
+    tiles = list(dict.fromkeys(tiles))
+    stored, unavailable = md._stored_and_missing([md._tile_key(x, y) for x, y in tiles])
+    missing = [(x, y) for x, y in tiles
+               if md._tile_key(x, y) not in stored and md._tile_key(x, y) not in unavailable]
+
+    #downloading continues while the batches are waited for
+    md.prefetch(missing)
+    yield 0, len(missing)
+    for i in range(0, len(missing), batch):
+        md.fetch_tiles(missing[i:i + batch])
+        yield min(i + batch, len(missing)), len(missing)
+
+
+#spacing of the grid of _anchor_segments, in multiples of the bigger of the
+#size limits of a part
+_ANCHOR_SPACING = 4
+
+def _path_parts(path):
+    """Return path (see path_surroundings) as a list of numpy arrays of
+    shape (n, 2), its separate segments"""
+
+    if isinstance(path, list) and path and np.ndim(path[0]) == 2:
+        return [np.asarray(part, dtype=np.float64).reshape(-1, 2) for part in path]
+    return [np.asarray(path, dtype=np.float64).reshape(-1, 2)]
+
+
+def _path_bites(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix, simplify_pix,
+                stable_bites=False):
+    """Project path (longitudes and latitudes, or a list of its separate
+    segments, see path_surroundings) to tiles coordinates, simplify it and
+    split it into bites, see _split_path
+
+    No bite connects two separate segments. With stable_bites, every
+    segment gets cut at anchors first (see _anchor_segments) and the pieces
+    get simplified and split separately.
+    """
+
+    bites = []
+    for part in _path_parts(path):
+        bites.extend(_part_bites(md, part, radius, maxwidth_pix, maxheight_pix, maxdist_pix, simplify_pix,
+                                 stable_bites))
+    return bites
+
+
+def _part_bites(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix, simplify_pix, stable_bites):
+    """Return bites of path, one separate segment (numpy array), see
+    _path_bites"""
+
+    xs, ys = md.lon_lat_to_tiles_many(path[:, 0], path[:, 1])
+    path = list(zip(xs.tolist(), ys.tolist()))
+
+    if not stable_bites:
+        if simplify_pix:
+            path = simplify_path(path, simplify_pix / md.xres)
+        return _split_path(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix)
+
+    #anchors are found among the original points, simplification (which
+    #may change points far from an edit) could move them
+    bites = []
+    for segment in _anchor_segments(md, path, _ANCHOR_SPACING * max(maxwidth_pix, maxheight_pix)):
+        if simplify_pix:
+            segment = simplify_path(segment, simplify_pix / md.xres)
+        bites.extend(_split_path(md, segment, radius, maxwidth_pix, maxheight_pix, maxdist_pix))
+    return bites
+
+
+def _anchor_segments(md, path, spacing_pix):
+    """Split path (list of (x, y) tiles coordinates) at anchors, points where
+    it enters another cell of a grid of spacing_pix pixels, at least
+    spacing_pix / 2 pixels (along the path) after the previous anchor
+
+    Whether a point is an anchor depends only on the path since the previous
+    anchor, so an edit of the path moves only the anchors up to the first
+    one after the edit, and the bites of the other segments stay the same.
+    Consecutive segments share their anchor.
+    """
+
+    if not path:
+        return []
+
+    def cell(p):
+        return (floor(p[0] * md.xres / spacing_pix), floor(p[1] * md.yres / spacing_pix))
+
+    segments = []
+    segment = [path[0]]
+    length = 0.0
+    last_cell = cell(path[0])
+    for p in path[1:]:
+        length += sqrt(((p[0] - segment[-1][0]) * md.xres) ** 2 + ((p[1] - segment[-1][1]) * md.yres) ** 2)
+        segment.append(p)
+        p_cell = cell(p)
+        if p_cell != last_cell and length >= spacing_pix / 2:
+            segments.append(segment)
+            segment = [p]
+            length = 0.0
+        last_cell = p_cell
+
+    if len(segment) > 1 or not segments:
+        segments.append(segment)
+    return segments
+
+
+def _worker_context():
+    """Return multiprocessing context for the render workers
+
+    Forked workers would inherit SQLite connections of the tile store
+    together with the state of their locks, which SQLite does not survive.
+    """
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+#MapDownloader used by _render_bite_in_worker
+_worker_md = None
+
+def _init_render_worker(md_pickle):
+    global _worker_md
+    _worker_md = pickle.loads(md_pickle)
+
+
+def _render_bite_in_worker(*args, **kwargs):
+    return _render_bite(_worker_md, *args, **kwargs)
+
+
+def simplify_path(path, tolerance):
+    """Return path (list of (x, y)) simplified by Douglas-Peucker algorithm, so
+    that it differs from the original path by at most tolerance
+
+    The first and the last point are always kept.
+    """
+
+    if len(path) < 3:
+        return path
+    return list(LineString(path).simplify(tolerance, preserve_topology=False).coords)
+
+
+def _split_path(md, path, radius, maxwidth_pix, maxheight_pix, maxdist_pix):
+    """Split path into bites, parts of the map which are not bigger than the
+    limits
+
+    Arguments:
+
+    md: MapDownloader
+    path: list of (x, y) tiles coordinates
+    radius: distance from the path (in tiles) covered by the map
+    maxwidth_pix, maxheight_pix, maxdist_pix: see path_surroundings
+
+    Returns list of (bite, x_range, y_range), where bite is a list of (x, y)
+    tiles coordinates and x_range, y_range are the bounds of its map in tiles
+    coordinates.
     """
 
     def len_pix(ran):
         return int((ran[1] - ran[0]) * md.xres)
     def dist_pix(p, q):
         return sqrt(((p[0] - q[0]) * md.xres) ** 2 + ((p[1] - q[1]) * md.xres) ** 2)
-    def draw_circle(draw, S, r, fill=1):
-        draw.ellipse((S[0] - r, S[1] - r, S[0] + r, S[1] + r), fill)
-        
-    radius = radius_pix / md.xres
 
-    path = [md.lon_lat_to_tiles(lon, lat) for lon, lat in reversed(path)]
+    bites = []
+    path = list(reversed(path))
     while path:
         
         #part of the map which is not bigger than the limits
@@ -162,49 +1202,108 @@ def path_surroundings(md, path, *,
                 x_range = x_range2
                 y_range = y_range2
 
-        white = (255, 255, 255)
-        big = Image.new("RGBA", (len_pix(x_range), len_pix(y_range)), color=white)
+        bites.append((bite, x_range, y_range))
 
-        last = bite[0]
-        #for each line (last--p) in bite get map of its surroundings (max
-        #distance of radius) and copy it to big
-        for p in bite[1:]:
+    return bites
+
+
+def corridor_tiles(points, radius):
+    """Return a list of (x, y) coordinates of tiles which intersect the
+    corridor -- area within radius from the path points (tiles coordinates)
+
+    Tiles are listed in the order in which the path reaches them. Tiles of
+    the bounding rectangle which lie entirely outside the corridor are left
+    out.
+    """
 
-            #get bounds of map covering this line
-            x1, _, _, x2 = sorted([last[0] - radius, last[0] + radius, p[0] - radius, p[0] + radius])
-            y1, _, _, y2 = sorted([last[1] - radius, last[1] + radius, p[1] - radius, p[1] + radius])
+    if len(points) == 1:
+        points = [points[0], points[0]]
 
-            #get the map rectangle for this line
-            im = md.get_rect_tiles(x1, y1, x2, y2, parallel=True)
+    tiles = {}
+    for last, p in zip(points, points[1:]):
+        #candidates: tiles of the rectangle covering line last--p and its
+        #surroundings
+        x1, _, _, x2 = sorted([last[0] - radius, last[0] + radius, p[0] - radius, p[0] + radius])
+        y1, _, _, y2 = sorted([last[1] - radius, last[1] + radius, p[1] - radius, p[1] + radius])
+        candidates = np.array(rect_tiles(x1, y1, x2, y2), dtype=np.float64)
 
-            #we would like to copy only surroundings, not the whole rectangle
-            #so we create a mask -- black and white image of the same size.
-            #area which is white in the mask gets copied
-            mask = Image.new("1", im.size)
-            draw = ImageDraw.Draw(mask)
+        surroundings = LineString([last, p]).buffer(radius)
+        boxes = shapely.box(candidates[:, 0], candidates[:, 1], candidates[:, 0] + 1, candidates[:, 1] + 1)
+        for x, y in candidates[shapely.intersects(surroundings, boxes)].astype(int).tolist():
+            tiles[(x, y)] = None
 
-            #convert coordinates of last and p from tiles to pixels with origin
-            #in upper left corner of im
-            last_pix = [(last[0] - x1) * md.xres, (last[1] - y1) * md.yres]
-            p_pix = [(p[0] - x1) * md.xres, (p[1] - y1) * md.yres]
+    return list(tiles)
+
+
+def _bite_tiles(md, bite, radius):
+    """Return a list of (x, y) coordinates of tiles needed for the map of
+    bite"""
+
+    #the mask of the covered area gets drawn with pixel precision
+    return corridor_tiles(bite, radius + 1 / md.xres)
+
+
+def _render_bite(md, bite, x_range, y_range, radius,
+                 maxwidth_pix, maxheight_pix, path_color, shorten_by_rotating, tiles=None):
+    """Return the map image (PIL.Image) of one bite
+
+    See _split_path and path_surroundings for the meaning of the arguments;
+    tiles are those of _bite_tiles(md, bite, radius) if already known.
+    """
+
+    def len_pix(ran):
+        return int((ran[1] - ran[0]) * md.xres)
+    def draw_circle(draw, S, r, fill=1):
+        draw.ellipse((S[0] - r, S[1] - r, S[0] + r, S[1] + r), fill)
+
+    white = (255, 255, 255)
+    big = Image.new("RGBA", (len_pix(x_range), len_pix(y_range)), color=white)
+
+    #we would like to copy only surroundings of the path (max distance of
+    #radius), not the whole rectangle, so we create a mask of the whole bite
+    #-- black and white image of the same size. Area which is white in the
+    #mask gets copied
+    with profile.stage("mask"):
+        mask = Image.new("1", big.size)
+        draw = ImageDraw.Draw(mask)
+
+        #for each line (last--p) in bite draw very thick line and circles at
+        #the end points (note (x_range[0], y_range[0]) are the tiles
+        #coordinates of the upper left corner of big); a bite of a single
+        #point (such as a gpx segment of one point) gets just its circle
+        last = bite[0]
+        if len(bite) == 1:
+            draw_circle(draw, [(last[0] - x_range[0]) * md.xres, (last[1] - y_range[0]) * md.yres],
+                        radius * md.xres)
+        for p in bite[1:]:
+            last_pix = [(last[0] - x_range[0]) * md.xres, (last[1] - y_range[0]) * md.yres]
+            p_pix = [(p[0] - x_range[0]) * md.xres, (p[1] - y_range[0]) * md.yres]
 
-            #draw very thick line and circles at the end points
             draw.line((last_pix[0], last_pix[1], p_pix[0], p_pix[1]), width=int(2*radius*md.xres), fill=1)
             draw_circle(draw, last_pix, radius * md.xres)
             draw_circle(draw, p_pix, radius * md.xres)
 
-            #mask is ready
-            del draw
-
-            #paste the surroundings to the right place in the big image (note
-            #(x_range[0], y_range[0]) are the tiles coordinates of the upper
-            #left corner of big)
-            big.paste(im, (int((x1 - x_range[0]) * md.xres), int((y1 - y_range[0]) * md.yres)), mask=mask)
-
             last = p
 
-        if path_color:
-            #draw path to map
+        #mask is ready
+        del draw
+
+    #paste each tile needed to the right place in the big image, through the
+    #corresponding part of the mask (tiles outside the mask are not needed)
+    if tiles is None:
+        tiles = _bite_tiles(md, bite, radius)
+    with profile.stage("get_tiles"):
+        images = md.get_tiles(tiles, parallel=True)
+    with profile.stage("paste"):
+        for (x, y), im in zip(tiles, images):
+            left = floor((x - x_range[0]) * md.xres)
+            top = floor((y - y_range[0]) * md.yres)
+            big.paste(im, (left, top), mask=mask.crop((left, top, left + im.width, top + im.height)))
+    del images
+
+    if path_color:
+        #draw path to map
+        with profile.stage("draw_path"):
             draw = ImageDraw.Draw(big)
             last = bite[0]
             for p in bite[1:]:
@@ -214,130 +1313,172 @@ def path_surroundings(md, path, *,
                 last = p
             del draw
 
-        if not shorten_by_rotating:
-            yield big
-        else:
-            #attempt to lower the height of the image by rotating the
-            #surroundings and cropping
-            
-            surroundings = LineString(bite).buffer(radius)
+    if not shorten_by_rotating:
+        return big
 
-            angle = _best_angle(surroundings, maxwidth_pix/md.xres, maxheight_pix/md.yres)
-            big = big.rotate(angle, resample=Image.BICUBIC, expand=True)
-            
-            #rotating will usually make the image bigger (new area gets filled
-            #with alpha=0)
-            #it needs to be cropped to include the surroundings only
-            big = _crop_after_rotation(big, angle, md.xres, md.yres, surroundings)
-        
-            #the cropped area will usually contain some of the alpha=0
-            #we remove it by pasting to new white image (alpha specifies mask,
-            #alpha=0 does not get #copied)
-            big2 = Image.new("RGBA", big.size, "white")
-            big2.paste(big, mask=big)
-            yield big2
+    #attempt to lower the height of the image by rotating the
+    #surroundings and cropping
+    
+    with profile.stage("rotate"):
+        surroundings = (LineString(bite) if len(bite) > 1 else Point(bite[0])).buffer(radius)
+
+        angle = _best_angle(surroundings, maxwidth_pix/md.xres, maxheight_pix/md.yres)
 
+        #rotate and crop to the surroundings by a single transformation; area
+        #which was not in big gets filled with white
+        return _rotate_and_crop(big, angle, md.xres, md.yres, surroundings, x_range[0], y_range[0])
 
-def _best_angle(surroundings, maxwidth, maxheight):
+
+def _best_angle(surroundings, maxwidth, maxheight, step=0.25):
     """Find the angle by which surroundings should be rotated.
     
     Try to minimalize surroundings' height while keeping its width
     under maxwidth. Also prefer smaller rotations over bigger ones.
 
+    All the angles from -90° to 90° (by step) are tried at once: the
+    bounding box of rotated surroundings is computed from the vertices of
+    its convex hull only.
+
     Arguments:
 
     surroundings: shapely.geometry.polygon.Polygon
     maxwidth: maximum allowed width of the surroundings bounding box
     maxheight: maximum allowed height of the surroundings bounding box
+    step: difference between two tried angles, in degrees
 
     Returns:
     
     angle in degrees (counterclockwise)
     """
-    
-    minheight = maxheight
+
+    hull = np.asarray(surroundings.convex_hull.exterior.coords)
+    hull = hull - hull.mean(axis=0)
+
+    angles = np.arange(-90, 90, step)
+    radians = np.radians(angles)[:, None]
+
+    #coordinates of the hull vertices rotated by each of the angles (one row
+    #per angle)
+    xs = hull[:, 0] * np.cos(radians) - hull[:, 1] * np.sin(radians)
+    ys = hull[:, 0] * np.sin(radians) + hull[:, 1] * np.cos(radians)
+    widths = xs.max(axis=1) - xs.min(axis=1)
+    heights = ys.max(axis=1) - ys.min(axis=1)
+
+    penalties = heights + np.abs(angles) / 100
+    penalties[widths >= maxwidth] = np.inf
+
     best = 0
-    lowest_penalty = 1000
-    for angle in range(-90, 90, 5):
-        x1, y1, x2, y2 = affinity.rotate(surroundings, angle).bounds
-        height = y2 - y1
-        width = x2 - x1
-        if width < maxwidth:
-            penalty = height + abs(angle) / 100
-            if penalty < lowest_penalty:
-                lowest_penalty = penalty
-                minheight = height
-                best = angle
+    i = np.argmin(penalties)
+    if penalties[i] < 1000:
+        best = angles[i]
 
     #maps and shapely differ in the directions of their y-axes
-    return -best
+    return -float(best)
             
 
-def _crop_after_rotation(im, angle, xres, yres, surroundings):
-    """Crop image to the bounding box of bite's surroundings.
+def _rotate_and_crop(im, angle, xres, yres, surroundings, x0, y0):
+    """Rotate image around its center and crop it to the bounding box of
+    rotated bite's surroundings, in one affine transformation.
 
     Arguments:
 
-    im: PIL.Image, rotated map part
-    angle: by which the map has been rotated, in degrees (counterclockwise)
+    im: PIL.Image, map part
+    angle: by which the map should be rotated, in degrees (counterclockwise)
     xres: width of one tile in pixels
     yres: height of one tile in pixels
-    surroundings: shapely.geometry.polygon.Polygon
+    surroundings: shapely.geometry.polygon.Polygon (tiles coordinates)
+    x0, y0: tiles coordinates of the upper left corner of im
     """
 
-    #before rotation
-    x1, y1, x2, y2 = surroundings.bounds
-    old_bb_upper_left = Point(x1, y1)
-    old_bb_upper_right = Point(x2, y1)
-    old_bb_bottom_left = Point(x1, y2)
-    old_bb_center = ((x1+x2)/2, (y1+y2)/2)
-
-    #shapely y-axis goes upwards
-    shapely_angle = -angle
-
-    #after rotation
-    x1, y1, x2, y2 = affinity.rotate(surroundings, shapely_angle, origin=old_bb_center).bounds
-    crop_upper_left = Point(x1, y1)
-    crop_width = x2 - x1
-    crop_height = y2 - y1
-
-    #points where old bounding box of surroundings (i.e. the old image) touches
-    #its bounding box after rotation
-    tl = None #touch at the left side of the new bounding box
-    tt = None #touch at the top side of the new bounding box
-    if angle > 0:
-        tl = affinity.rotate(old_bb_upper_left, shapely_angle, origin=old_bb_center)
-        tt = affinity.rotate(old_bb_upper_right, shapely_angle, origin=old_bb_center)
-    else:
-        tl = affinity.rotate(old_bb_bottom_left, shapely_angle, origin=old_bb_center)
-        tt = affinity.rotate(old_bb_upper_left, shapely_angle, origin=old_bb_center)
-
-    #upper left corner of ther new bounding box
-    new_bb_upper_left = Point(tl.x, tt.y)
-
-    #from these we get b: upper left corner of the crop area relative to new_bb_upper_left
-    b = (crop_upper_left.x - new_bb_upper_left.x, crop_upper_left.y - new_bb_upper_left.y)
-
-    #crop rectangle in pixels relative to new_bb_upper_left
-    crop_box = [int(x) for x in [
-        b[0] * xres,
-        b[1] * yres,
-        (b[0] + crop_width) * xres,
-        (b[1] + crop_height) * yres
-    ]]
-    cropped = im.crop(box=crop_box)
-    cropped.load()
-    return cropped
-
-
-def create_path_pdf(parts, filename):
+    cos = np.cos(np.radians(angle))
+    sin = np.sin(np.radians(angle))
+
+    #vertices of the surroundings in pixels relative to the center of im
+    hull = np.asarray(surroundings.convex_hull.exterior.coords)
+    dx = (hull[:, 0] - x0) * xres - im.width / 2
+    dy = (hull[:, 1] - y0) * yres - im.height / 2
+
+    #...after rotation (counterclockwise on the screen, y-axis goes down)
+    rx = cos * dx + sin * dy
+    ry = -sin * dx + cos * dy
+    left, top = rx.min(), ry.min()
+    size = (int(np.ceil(rx.max() - left)), int(np.ceil(ry.max() - top)))
+
+    #pixel (u, v) of the result is (left + u, top + v) after rotation, which
+    #is rotated back to get the pixel of im
+    data = (
+        cos, -sin, im.width / 2 + cos * left - sin * top,
+        sin, cos, im.height / 2 + sin * left + cos * top,
+    )
+    return im.transform(size, Image.AFFINE, data, resample=Image.BICUBIC, fillcolor="white")
+
+
+def _encode_parts(parts, workers, **encoding):
+    """Yield parts (PIL.Image) encoded by pdf.encode_image with keyword
+    arguments encoding, in the same order
+
+    Parts get encoded by workers threads while the following ones are
+    being generated; at most 2*workers encoded parts are kept in memory.
+    """
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = deque()
+        for im in parts:
+            results.append(executor.submit(_encode_part, im, encoding))
+            del im
+            if len(results) >= 2 * workers:
+                yield results.popleft().result()
+
+        while results:
+            yield results.popleft().result()
+
+
+def _encode_part(im, encoding):
+    with profile.stage("encode"):
+        return encode_image(im, **encoding)
+
+
+def create_path_pdf(parts, filename, backend="native", encoding="png",
+                    compress_level=6, quality=85, encode_workers=2):
     """Create a pdf file filename with images in parts.
 
+    Images are written to the file (or to temporary files for LaTeX) as
+    they come, so parts may be a generator (such as path_surroundings) and
+    only a few images need to be kept in memory.
+
     Arguments:
     
-    parts: list of Image.PIL
+    parts: iterable of Image.PIL
     filename: str, name of the resulting file
+    backend: "native" writes the pdf directly (see pdf.PdfWriter), "latex"
+        builds it by LaTeX (requires latex module and a TeX installation).
+        Default "native".
+    encoding: how the images are stored, "png" (default), "png-palette"
+        (PNG with adaptive palette, much smaller for maps) or "jpeg", see
+        pdf.encode_image
+    compress_level: PNG compression level 0-9, default 6
+    quality: JPEG quality 1-95, default 85
+    encode_workers: number of threads encoding the images while the
+        following ones are being rendered. Default 2.
     """
+
+    if backend not in ("native", "latex"):
+        raise ValueError("Unknown pdf backend {}".format(backend))
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown image encoding {}".format(encoding))
+
+    encoded = _encode_parts(parts, encode_workers, encoding=encoding,
+                            compress_level=compress_level, quality=quality)
+
+    if backend == "native":
+        with PdfWriter(filename) as pdf:
+            for data in encoded:
+                with profile.stage("write_pdf"):
+                    pdf.add_image(data)
+        return
+
+    from latex import build_pdf
+
     header = r"""
         \documentclass[a4paper]{article}
         \usepackage[top=1.5cm, bottom=1.5cm, left=0.5cm, right=0.5cm]{geometry}
@@ -348,19 +1489,22 @@ def create_path_pdf(parts, filename):
 
     tdir = tempfile.TemporaryDirectory()
 
+    extension = "jpg" if encoding == "jpeg" else "png"
     fnames = []
-    for i, im in enumerate(parts):
-        fname = "{}/{}.png".format(tdir.name, i)
+    for i, data in enumerate(encoded):
+        fname = "{}/{}.{}".format(tdir.name, i, extension)
         fnames.append(fname)
-        im.save(fname)
+        with open(fname, "wb") as f:
+            f.write(data)
         
-    images = "\n\n".join('\includegraphics[scale=0.5]{' + fname + '}' for fname in fnames)
+    images = "\n\n".join(r'\includegraphics[scale=0.5]{' + fname + '}' for fname in fnames)
 
     footer = r"""
         \end{document}
     """
 
-    pdf = build_pdf("".join((header, images, footer)))
-    pdf.save_to(filename)
+    with profile.stage("latex"):
+        pdf = build_pdf("".join((header, images, footer)))
+        pdf.save_to(filename)
     
     tdir.cleanup()
@@ -0,0 +1,73 @@
+from array import array
+from lxml import etree
+import numpy as np
+
+
+def _iter_points(filename, point_tags, part_tags):
+    """Parse gpx file filename incrementally
+
+    Yields (longitude, latitude) of elements point_tags and the tag name at
+    the end of every element part_tags. Parsed elements get released, so memory
+    does not grow with the size of the file.
+    """
+
+    for _, e in etree.iterparse(filename, events=("end",)):
+        tag = e.tag.rpartition("}")[2]
+        if tag in point_tags:
+            yield float(e.get("lon")), float(e.get("lat"))
+        elif tag in part_tags:
+            yield tag
+
+        #every element (also waypoints, metadata or extensions when they
+        #are not read) is released once it ends, its children already are
+        e.clear()
+        parent = e.getparent()
+        if parent is not None:
+            while e.getprevious() is not None:
+                del parent[0]
+
+
+def _to_arrays(points, split, prefer=None):
+    coords = array("d")
+    #(tag, start, end) of the non-empty parts, start and end are indices in
+    #coords
+    parts = []
+    start = 0
+    for p in points:
+        if isinstance(p, str):
+            if len(coords) > start:
+                parts.append((p, start, len(coords)))
+            start = len(coords)
+        else:
+            coords.extend(p)
+
+    path = np.frombuffer(coords, dtype=np.float64).reshape(-1, 2)
+    if prefer is not None and any(tag == prefer for tag, _, _ in parts):
+        parts = [part for part in parts if part[0] == prefer]
+        if not split:
+            return np.concatenate([path[start // 2:end // 2] for _, start, end in parts])
+    if not split:
+        return path
+    return [path[start // 2:end // 2] for _, start, end in parts]
+
+
+def read_gpx(filename, split=False, prefer_tracks=False):
+    """Return (longitude, latitude) points of all tracks (all their
+    segments) and routes in gpx file filename
+
+    Returns a numpy array of shape (n, 2), or with split=True a list of such
+    arrays, one per track segment or route (in the order of the file);
+    empty segments and routes are left out. With prefer_tracks, routes are
+    left out if the file has a track (a route is usually the plan of the
+    track recorded along it).
+    """
+
+    return _to_arrays(_iter_points(filename, ["trkpt", "rtept"], ["trkseg", "rte"]), split,
+                      "trkseg" if prefer_tracks else None)
+
+
+def read_gpx_waypoints(filename):
+    """Return (longitude, latitude) points of waypoints in gpx file filename
+    as a numpy array of shape (n, 2)"""
+
+    return _to_arrays(_iter_points(filename, ["wpt"], []), False)
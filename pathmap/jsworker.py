@@ -0,0 +1,93 @@
+import json
+import shutil
+import subprocess
+from threading import Lock
+
+
+class JSError(Exception):
+    """Raised when a script evaluated by JSWorker fails"""
+
+
+#reads requests {"script": ..., "names": [...]} line by line from stdin, runs
+#each script in a fresh context and answers {"values": [...]} with string
+#values of the global variables names (null if undefined) or {"error": ...}
+_DRIVER = r"""
+const vm = require('vm');
+const readline = require('readline');
+
+readline.createInterface({input: process.stdin}).on('line', (line) => {
+    let res;
+    try {
+        const req = JSON.parse(line);
+        const ctx = vm.createContext({});
+        vm.runInContext(req.script, ctx, {timeout: 10000});
+        res = {values: req.names.map((name) => vm.runInContext(
+            'typeof ' + name + ' === "undefined" ? null : String(' + name + ')', ctx))};
+    } catch (e) {
+        res = {error: String(e)};
+    }
+    process.stdout.write(JSON.stringify(res) + '\n');
+});
+"""
+
+
+class JSWorker:
+    """Persistent nodejs process evaluating scripts
+
+    Spares spawning nodejs for every script. Each script runs in its own
+    context (without access to require, process etc.).
+    """
+
+    def __init__(self, executable=None):
+        """
+        Arguments:
+
+        executable: nodejs binary, by default nodejs or node found in PATH
+        """
+
+        self.executable = executable or shutil.which("nodejs") or shutil.which("node") or "nodejs"
+        self._process = None
+        self._lock = Lock()
+
+
+    def _start(self):
+        self._process = subprocess.Popen(
+            [self.executable, "-e", _DRIVER],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True, encoding="utf8")
+
+
+    def evaluate(self, script, names):
+        """Run script and return list of values (str, or None if undefined) of
+        its global variables names
+
+        Raises JSError if the script fails.
+        """
+
+        request = json.dumps({"script": script, "names": list(names)}) + "\n"
+        with self._lock:
+            if self._process is None or self._process.poll() is not None:
+                self._start()
+
+            try:
+                self._process.stdin.write(request)
+                self._process.stdin.flush()
+                line = self._process.stdout.readline()
+            except BrokenPipeError:
+                line = ""
+
+            if not line:
+                self._process = None
+                raise JSError("nodejs worker died")
+
+        response = json.loads(line)
+        if "error" in response:
+            raise JSError(response["error"])
+        return response["values"]
+
+
+    def close(self):
+        with self._lock:
+            if self._process is not None:
+                self._process.stdin.close()
+                self._process.wait()
+                self._process = None
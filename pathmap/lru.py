@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+def image_bytes(im):
+    """Return approximate number of bytes taken by the pixels of PIL.Image im"""
+
+    return im.width * im.height * len(im.getbands())
+
+
+class ImageLRU:
+    """Memory bounded cache of decoded images, least recently used images get
+    evicted first
+
+    Counts hits and misses of get().
+    """
+
+    def __init__(self, max_bytes):
+        """
+        Arguments:
+
+        max_bytes: maximum number of bytes taken by the cached images (as
+            computed by image_bytes)
+        """
+
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+
+        self._images = OrderedDict()
+        self._lock = Lock()
+
+
+    def get(self, key):
+        """Return the image cached as key, or None"""
+
+        with self._lock:
+            im = self._images.get(key)
+            if im is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._images.move_to_end(key)
+            return im
+
+
+    def put(self, key, im):
+        """Cache PIL.Image im as key"""
+
+        size = image_bytes(im)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._images.pop(key, None)
+            if old is not None:
+                self.size -= image_bytes(old)
+
+            self._images[key] = im
+            self.size += size
+
+            while self.size > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.size -= image_bytes(evicted)
+
+
+    def __len__(self):
+        return len(self._images)
+
+
+    def stats(self):
+        """Return a dict with hits, misses, number of images and their size"""
+
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "images": len(self._images),
+                "bytes": self.size,
+            }
@@ -0,0 +1,117 @@
+import hashlib
+import os
+import time
+from io import BytesIO
+import numpy as np
+from PIL import Image
+
+from . tilestore import write_atomic
+
+
+#version of the rendering, part of every key; should be increased whenever
+#_render_bite starts to draw the parts differently
+RENDER_VERSION = 1
+
+
+def part_key(md, bite, x_range, y_range, radius, maxwidth_pix, maxheight_pix, path_color,
+             shorten_by_rotating):
+    """Return the key (hex string) of the map part of bite rendered with
+    the given arguments (see getmap._render_bite) by md
+
+    The key is a hash of the tiles coordinates of the bite points, of the
+    arguments and of the map (provider, zoom and tile size), so parts of
+    unchanged bites of an edited path get the same keys.
+    """
+
+    h = hashlib.sha256()
+    h.update(repr((RENDER_VERSION, md.provider, md.zoom, md.xres, md.yres,
+                   [float(c) for c in x_range], [float(c) for c in y_range], float(radius),
+                   maxwidth_pix, maxheight_pix,
+                   tuple(path_color) if path_color else None,
+                   bool(shorten_by_rotating))).encode("utf8"))
+    h.update(np.asarray(bite, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+class PartCache:
+    """Keeps rendered map parts (see getmap.path_surroundings) as PNG files
+    in a directory, so that re-rendering an edited path renders only the
+    changed parts
+
+    Files are written atomically (see tilestore.write_atomic), so several
+    processes can share the directory. Parts older than ttl seconds are
+    treated as not stored (the tiles they show may have changed meanwhile)
+    and get deleted.
+    """
+
+    def __init__(self, directory, ttl=30*24*3600, compress_level=1):
+        """
+        Arguments:
+
+        directory: the directory (created if it does not exist)
+        ttl: parts older than ttl seconds are treated as not stored; None
+            means they never expire
+        compress_level: PNG compression level of the files
+        """
+
+        self.directory = directory
+        self.ttl = ttl
+        self.compress_level = compress_level
+        os.makedirs(directory, exist_ok=True)
+        self.prune()
+
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+
+    def _expired(self, mtime):
+        return self.ttl is not None and mtime < time.time() - self.ttl
+
+
+    def contains(self, key):
+        """Return whether part key is stored and not expired"""
+
+        try:
+            return not self._expired(os.path.getmtime(self._filename(key)))
+        except FileNotFoundError:
+            return False
+
+
+    def get(self, key):
+        """Return part key (PIL.Image), or None if it is not stored"""
+
+        try:
+            with open(self._filename(key), "rb") as f:
+                if self._expired(os.fstat(f.fileno()).st_mtime):
+                    return None
+                im = Image.open(BytesIO(f.read()))
+                im.load()
+        except IOError:
+            return None
+        return im
+
+
+    def put(self, key, im):
+        """Store part key (PIL.Image)"""
+
+        out = BytesIO()
+        im.save(out, "PNG", compress_level=self.compress_level)
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_atomic(filename, out.getvalue())
+
+
+    def prune(self):
+        """Delete expired parts"""
+
+        if self.ttl is None:
+            return
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                try:
+                    if name.endswith(".png") and self._expired(os.path.getmtime(filename)):
+                        os.remove(filename)
+                except FileNotFoundError:
+                    pass
@@ -0,0 +1,332 @@
+from io import BytesIO
+import struct
+import zlib
+from PIL import Image
+
+
+def cm(x):
+    """Convert centimeters to points (1/72 in)"""
+
+    return x * 72 / 2.54
+
+
+#A4 width and height in points
+A4 = (cm(21), cm(29.7))
+
+
+class PdfImage:
+    """Encoded image ready to be embedded into pdf without decoding
+
+    Attributes width and height (in pixels), stream (bytes) and entries
+    (dict of the image XObject, without /Length).
+    """
+
+    def __init__(self, width, height, stream, entries):
+        self.width = width
+        self.height = height
+        self.stream = stream
+        self.entries = entries
+
+
+def _png_image(data):
+    """Return PdfImage embedding PNG data (bytes) as they are, or None if
+    the PNG cannot be embedded that way (alpha channel, interlacing, 16 bits)"""
+
+    if data[:8] != b"\x89PNG\r\n\x1a\n":
+        return None
+
+    idat = []
+    palette = None
+    pos = 8
+    while pos < len(data):
+        length, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        chunk = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+
+        if kind == b"IHDR":
+            width, height, bits, color_type, _, _, interlace = struct.unpack(">IIBBBBB", chunk)
+        elif kind == b"PLTE":
+            palette = chunk
+        elif kind == b"IDAT":
+            idat.append(chunk)
+        elif kind == b"IEND":
+            break
+
+    colors = {0: 1, 2: 3, 3: 1}.get(color_type)
+    if colors is None or interlace or bits == 16:
+        return None
+
+    if color_type == 0:
+        colorspace = "/DeviceGray"
+    elif color_type == 2:
+        colorspace = "/DeviceRGB"
+    else:
+        colorspace = "[/Indexed /DeviceRGB {} <{}>]".format(len(palette) // 3 - 1, palette.hex())
+
+    return PdfImage(width, height, b"".join(idat), {
+        "Filter": "/FlateDecode",
+        "ColorSpace": colorspace,
+        "BitsPerComponent": bits,
+        "DecodeParms": "<< /Predictor 15 /Colors {} /BitsPerComponent {} /Columns {} >>".format(
+            colors, bits, width),
+    })
+
+
+def _jpeg_image(data):
+    """Return PdfImage embedding JPEG data (bytes) as they are, or None if it
+    is not a JPEG"""
+
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    im = Image.open(BytesIO(data))
+    colorspace = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}.get(im.mode)
+    if colorspace is None:
+        return None
+
+    entries = {"Filter": "/DCTDecode", "ColorSpace": colorspace, "BitsPerComponent": 8}
+    if im.mode == "CMYK":
+        #Adobe JPEGs store inverted CMYK
+        entries["Decode"] = "[1 0 1 0 1 0 1 0]"
+    return PdfImage(im.width, im.height, data, entries)
+
+
+def _flatten(im):
+    """Return PIL.Image im without alpha channel (composed onto white)"""
+
+    if im.mode == "P":
+        im = im.convert("RGBA")
+    if im.mode not in ("RGBA", "LA"):
+        return im
+
+    alpha = im.getchannel("A")
+    base = "RGB" if im.mode == "RGBA" else "L"
+    if alpha.getextrema() == (255, 255):
+        return im.convert(base)
+    flat = Image.new(base, im.size, "white")
+    flat.paste(im.convert(base), mask=alpha)
+    return flat
+
+
+def pdf_image(image):
+    """Return PdfImage of image, which is either PIL.Image or bytes of a PNG
+    or JPEG file
+
+    PNG (without alpha) and JPEG files are embedded as they are; other
+    images get encoded as PNG first.
+    """
+
+    if isinstance(image, bytes):
+        embedded = _png_image(image) or _jpeg_image(image)
+        if embedded:
+            return embedded
+        image = Image.open(BytesIO(image))
+
+    im = _flatten(image)
+    if im.mode not in ("1", "L", "P", "RGB"):
+        im = im.convert("RGB")
+    out = BytesIO()
+    im.save(out, "PNG")
+    return _png_image(out.getvalue())
+
+
+#ways of encoding images, see encode_image
+ENCODINGS = ("png", "png-palette", "jpeg")
+
+
+def encode_image(image, encoding="png", compress_level=6, quality=85, colors=256):
+    """Return bytes of PIL.Image image encoded as a file
+    
+    The alpha channel gets composed onto white first.
+
+    Arguments:
+
+    image: PIL.Image
+    encoding: "png" (RGB or grayscale PNG), "png-palette" (PNG with an
+        adaptive palette, exact if the image has at most colors colors) or
+        "jpeg"
+    compress_level: zlib compression level of PNG, 0 to 9
+    quality: quality of JPEG, 1 to 95
+    colors: maximum size of the palette of "png-palette"
+    """
+
+    if encoding not in ENCODINGS:
+        raise ValueError("Unknown image encoding {}".format(encoding))
+
+    im = _flatten(image)
+    if im.mode not in ("1", "L", "RGB"):
+        im = im.convert("RGB")
+
+    out = BytesIO()
+    if encoding == "jpeg":
+        im.save(out, "JPEG", quality=quality)
+    else:
+        if encoding == "png-palette" and im.mode == "RGB":
+            #map tiles have few colors, which the octree keeps exactly (and
+            #the palette should not be longer than needed)
+            used = im.getcolors(colors)
+            im = im.quantize(len(used) if used else colors, method=Image.Quantize.FASTOCTREE,
+                             dither=Image.Dither.NONE)
+        im.save(out, "PNG", compress_level=compress_level)
+    return out.getvalue()
+
+
+class PdfWriter:
+    """Writes images into a pdf file, one below another, page after page
+
+    The layout follows the LaTeX article used by create_path_pdf before:
+    images are scaled so that one pixel takes scale points, indented by
+    indent points and separated by skip points. Pages are numbered.
+
+    Everything but the small page tree gets written to the file as soon as
+    an image is added.
+    """
+
+    def __init__(self, filename, page_size=A4, top=cm(1.5), bottom=cm(1.5), left=cm(0.5),
+                 scale=0.5, indent=15, skip=1, footskip=30):
+        """
+        Arguments:
+
+        filename: name of the pdf file
+        page_size: (width, height) in points
+        top, bottom, left: margins in points
+        scale: size of one pixel of an image in points
+        indent: indentation of the images in points
+        skip: vertical space between two images in points
+        footskip: distance of the page number below the text area in points
+        """
+
+        self.page_size = page_size
+        self.top = top
+        self.bottom = bottom
+        self.left = left
+        self.scale = scale
+        self.indent = indent
+        self.skip = skip
+        self.footskip = footskip
+
+        self._f = open(filename, "wb")
+        self._offsets = {}
+        self._objects = 0
+        self._page_ids = []
+
+        #images of the current page: (object number, x, y, width, height)
+        self._placed = []
+        self._y = None
+
+        self._f.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+        #catalog and page tree are written at the end
+        self._catalog_id = self._new_object()
+        self._pages_id = self._new_object()
+        self._font_id = self._write_object("<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+
+
+    def _new_object(self):
+        self._objects += 1
+        return self._objects
+
+
+    def _write_object(self, body, stream=None, oid=None):
+        """Write object (body is its dict or other value, as str) with
+        optional stream (bytes) and return its number"""
+
+        if oid is None:
+            oid = self._new_object()
+        self._offsets[oid] = self._f.tell()
+
+        self._f.write("{} 0 obj\n".format(oid).encode("ascii"))
+        self._f.write(body.encode("ascii"))
+        if stream is not None:
+            self._f.write(b"\nstream\n")
+            self._f.write(stream)
+            self._f.write(b"\nendstream")
+        self._f.write(b"\nendobj\n")
+        return oid
+
+
+    def _finish_page(self):
+        """Write the current page (if it has any images)"""
+
+        if not self._placed:
+            return
+
+        number = len(self._page_ids) + 1
+        commands = []
+        xobjects = []
+        for i, (oid, x, y, w, h) in enumerate(self._placed):
+            commands.append("q {:.3f} 0 0 {:.3f} {:.3f} {:.3f} cm /Im{} Do Q".format(w, h, x, y, i))
+            xobjects.append("/Im{} {} 0 R".format(i, oid))
+        commands.append("BT /F1 10 Tf {:.3f} {:.3f} Td ({}) Tj ET".format(
+            self.page_size[0] / 2 - 2.8 * len(str(number)), self.bottom - self.footskip, number))
+
+        content = zlib.compress("\n".join(commands).encode("ascii"))
+        content_id = self._write_object("<< /Length {} /Filter /FlateDecode >>".format(len(content)), content)
+
+        self._page_ids.append(self._write_object(
+            "<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {:.3f} {:.3f}] "
+            "/Resources << /XObject << {} >> /Font << /F1 {} 0 R >> >> /Contents {} 0 R >>".format(
+                self._pages_id, self.page_size[0], self.page_size[1], " ".join(xobjects),
+                self._font_id, content_id)))
+
+        self._placed = []
+        self._y = None
+
+
+    def add_image(self, image):
+        """Add image (PIL.Image or bytes of PNG or JPEG file) below the
+        previous one, on a new page if it does not fit"""
+
+        image = pdf_image(image)
+        entries = " ".join("/{} {}".format(k, v) for k, v in image.entries.items())
+        oid = self._write_object(
+            "<< /Type /XObject /Subtype /Image /Width {} /Height {} {} /Length {} >>".format(
+                image.width, image.height, entries, len(image.stream)),
+            image.stream)
+
+        w = image.width * self.scale
+        h = image.height * self.scale
+        if self._y is not None and self._y - self.skip - h < self.bottom:
+            self._finish_page()
+
+        if self._y is None:
+            self._y = self.page_size[1] - self.top
+        else:
+            self._y -= self.skip
+
+        self._y -= h
+        self._placed.append((oid, self.left + self.indent, self._y, w, h))
+
+
+    def close(self):
+        """Write the rest of the file and close it"""
+
+        self._finish_page()
+        if not self._page_ids:
+            #empty document still needs a page
+            content_id = self._write_object("<< /Length 0 >>", b"")
+            self._page_ids.append(self._write_object(
+                "<< /Type /Page /Parent {} 0 R /MediaBox [0 0 {:.3f} {:.3f}] /Contents {} 0 R >>".format(
+                    self._pages_id, self.page_size[0], self.page_size[1], content_id)))
+
+        self._write_object("<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(oid) for oid in self._page_ids), len(self._page_ids)),
+            oid=self._pages_id)
+        self._write_object("<< /Type /Catalog /Pages {} 0 R >>".format(self._pages_id),
+                           oid=self._catalog_id)
+
+        xref = self._f.tell()
+        self._f.write("xref\n0 {}\n0000000000 65535 f \n".format(self._objects + 1).encode("ascii"))
+        for oid in range(1, self._objects + 1):
+            self._f.write("{:010d} 00000 n \n".format(self._offsets[oid]).encode("ascii"))
+        self._f.write("trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+            self._objects + 1, self._catalog_id, xref).encode("ascii"))
+        self._f.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
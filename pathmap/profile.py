@@ -0,0 +1,127 @@
+from contextlib import contextmanager, nullcontext
+import json
+import time
+from threading import Lock
+
+
+class Profiler:
+    """Collects time spent in stages of map creation and counters of events
+    (bytes downloaded, cache hits, retries...)
+
+    Stages may run in several threads at once; their times are summed.
+    Listeners (see add_listener) get every event as it happens.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+
+        #stage name: {"calls": ..., "seconds": ..., "max": ...}
+        self.stages = {}
+        #counter name: value
+        self.counters = {}
+
+        self._listeners = []
+        self._lock = Lock()
+
+
+    def add_listener(self, listener):
+        """Call listener(kind, name, value) on every event: kind is "stage"
+        (value is its duration in seconds) or "count" (value is the
+        increment)"""
+
+        self._listeners.append(listener)
+
+
+    def record_stage(self, name, seconds):
+        """Record that stage name took seconds"""
+
+        with self._lock:
+            stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0, "max": 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+        for listener in self._listeners:
+            listener("stage", name, seconds)
+
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager recording the time spent in it as stage name"""
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+
+
+    def count(self, name, n=1):
+        """Add n to counter name"""
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        for listener in self._listeners:
+            listener("count", name, n)
+
+
+    def report(self):
+        """Return dict with the wall time since the profiler was created, the
+        stages and the counters"""
+
+        with self._lock:
+            return {
+                "wall": time.perf_counter() - self.started,
+                "stages": {name: dict(stats) for name, stats in self.stages.items()},
+                "counters": dict(self.counters),
+            }
+
+
+    def write_report(self, filename, **extra):
+        """Write report() (updated by extra items) as json into filename"""
+
+        report = self.report()
+        report.update(extra)
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+#Profiler collecting the events of this process, None if not profiling
+_profiler = None
+
+
+def enable(profiler=None):
+    """Start collecting the events by profiler (a new Profiler by default)
+    and return it"""
+
+    global _profiler
+    _profiler = profiler if profiler is not None else Profiler()
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def current():
+    """Return the enabled Profiler, or None"""
+
+    return _profiler
+
+
+def stage(name):
+    """Context manager timing stage name (doing nothing unless profiling is
+    enabled)"""
+
+    profiler = _profiler
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
+
+
+def count(name, n=1):
+    """Add n to counter name (if profiling is enabled)"""
+
+    profiler = _profiler
+    if profiler is not None:
+        profiler.count(name, n)
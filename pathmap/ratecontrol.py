@@ -0,0 +1,239 @@
+import time
+from threading import Condition
+
+
+class ThrottledError(Exception):
+    """Raised by MapDownloader._download_tile when the server asks to slow
+    down (HTTP 429 or 503)"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        #seconds the server asked to wait (Retry-After), or None
+        self.retry_after = retry_after
+
+
+class TileNotFoundError(Exception):
+    """Raised by MapDownloader._download_tile when the server does not have
+    the tile (HTTP 404 or 410), such as beyond the edge of the map"""
+
+
+class BadResponseError(Exception):
+    """Raised by MapDownloader._download_tile when the server answers by an
+    error or by something else than a tile image (such as an error page)"""
+
+
+class TileDownloadError(Exception):
+    """Raised when a tile could not be downloaded even after retrying"""
+
+
+def check_tile_response(what, status, headers):
+    """Raise ThrottledError, TileNotFoundError or BadResponseError unless
+    HTTP response with status and headers (case-insensitive mapping) to the
+    request of what (tile or url, for messages) carries a tile image
+
+    Content-Type has to be an image (or application/octet-stream, sent by
+    some servers for anything), if present.
+    """
+
+    if status in (429, 503):
+        raise ThrottledError("{}: HTTP status {}".format(what, status),
+                             retry_after(headers.get("Retry-After")))
+    if status in (404, 410):
+        raise TileNotFoundError("{}: HTTP status {}".format(what, status))
+    if status != 200:
+        raise BadResponseError("{}: HTTP status {}".format(what, status))
+
+    content_type = headers.get("Content-Type", "").split(";")[0].strip().lower()
+    if content_type and not (content_type.startswith("image/") or content_type == "application/octet-stream"):
+        raise BadResponseError("{}: Content-Type {} is not an image".format(what, content_type))
+
+
+def retry_after(value):
+    """Return seconds in Retry-After header value, or None if it is missing
+    or not a number of seconds"""
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class AdaptiveLimiter:
+    """Limits the number of requests in flight and the number of requests
+    per second
+
+    The limit of requests in flight adapts to the server AIMD-style: it grows
+    by about one per round of successful requests as long as their latency
+    stays below latency_factor times the lowest latency seen, and it gets
+    multiplied by decrease when the latency grows above that, a request
+    fails or the server throttles. Throttling also pauses all requests for
+    a while (as long as the server asks, or an exponentially growing time).
+
+    Every request has to call acquire() (or try_acquire() until it returns
+    0) before it is sent and release() once it is done.
+    """
+
+    def __init__(self, initial=10, minimum=1, maximum=64, max_rate=None,
+                 decrease=0.5, latency_factor=2.0, max_pause=30):
+        """
+        Arguments:
+
+        initial: initial limit of requests in flight
+        minimum, maximum: bounds of the limit
+        max_rate: maximum number of requests per second, None for no limit
+        decrease: the limit gets multiplied by decrease on congestion
+        latency_factor: latency higher than latency_factor times the lowest
+            one means congestion
+        max_pause: maximum pause after throttling, in seconds
+        """
+
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_rate = max_rate
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.max_pause = max_pause
+        self._init_state()
+
+
+    def _init_state(self):
+        self._condition = Condition()
+
+        self.limit = float(max(self.minimum, min(self.maximum, self.initial)))
+        self.in_flight = 0
+
+        #smoothed latency and its lowest value (slowly following the
+        #smoothed one, so that it adapts to a slower server)
+        self.latency = None
+        self.base_latency = None
+
+        #token bucket of max_rate
+        self._tokens = 1.0
+        self._refilled = time.monotonic()
+
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._pause = 0.0
+
+        self.successes = 0
+        self.errors = 0
+        self.throttled = 0
+
+
+    def __getstate__(self):
+        """Copies in other processes start from the initial state"""
+
+        return {name: getattr(self, name) for name in (
+            "initial", "minimum", "maximum", "max_rate", "decrease", "latency_factor", "max_pause")}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+
+    def try_acquire(self):
+        """Take a slot for a request and return 0, or return how many seconds
+        to wait before trying again"""
+
+        with self._condition:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.in_flight >= int(self.limit):
+                #release() wakes acquire() earlier
+                return 0.05
+
+            if self.max_rate:
+                self._tokens = min(max(1.0, self.max_rate),
+                                   self._tokens + (now - self._refilled) * self.max_rate)
+                self._refilled = now
+                if self._tokens < 1:
+                    return (1 - self._tokens) / self.max_rate
+                self._tokens -= 1
+
+            self.in_flight += 1
+            return 0
+
+
+    def acquire(self):
+        """Wait for a slot for a request"""
+
+        while True:
+            delay = self.try_acquire()
+            if not delay:
+                return
+            with self._condition:
+                self._condition.wait(delay)
+
+
+    def release(self, latency, outcome="ok", retry_after=None):
+        """Give back the slot of a request which took latency seconds
+
+        outcome is "ok", "error" (failed request or invalid response) or
+        "throttled" (the server asked to slow down, for retry_after seconds
+        if it said so).
+        """
+
+        with self._condition:
+            now = time.monotonic()
+            self.in_flight -= 1
+
+            if outcome == "ok":
+                self.successes += 1
+                self._pause = 0.0
+                self._observe(latency)
+                if self.latency <= self.latency_factor * self.base_latency:
+                    #additive increase: about +1 per round of requests
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                else:
+                    self._decrease(now)
+            elif outcome == "throttled":
+                self.throttled += 1
+                self._decrease(now)
+                #requests sent before the pause started do not prolong it
+                if now >= self._paused_until:
+                    self._pause = min(self.max_pause, max(0.5, 2 * self._pause))
+                pause = retry_after if retry_after is not None else self._pause
+                self._paused_until = max(self._paused_until, now + min(self.max_pause, pause))
+            else:
+                self.errors += 1
+                self._decrease(now)
+
+            self._condition.notify_all()
+
+
+    def _observe(self, latency):
+        if self.latency is None:
+            self.latency = self.base_latency = latency
+            return
+        self.latency += 0.2 * (latency - self.latency)
+        self.base_latency = min(self.latency, self.base_latency + 0.01 * (self.latency - self.base_latency))
+
+
+    def _decrease(self, now):
+        """Multiplicative decrease, at most once per round trip (requests
+        of one round usually see the same congestion)"""
+
+        if now - self._last_decrease < (self.latency or 0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+    def state(self):
+        """Return dict describing the current state of the limiter"""
+
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                "max_rate": self.max_rate,
+                "latency": self.latency,
+                "base_latency": self.base_latency,
+                "paused": max(0.0, self._paused_until - time.monotonic()),
+                "successes": self.successes,
+                "errors": self.errors,
+                "throttled": self.throttled,
+            }
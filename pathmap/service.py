@@ -0,0 +1,341 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict, deque
+from io import BytesIO
+from threading import Thread, Condition, Lock, Event
+from urllib.parse import urlsplit, parse_qs
+from PIL import ImageColor
+import json
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+from . import gpx
+from . getmap import path_surroundings, create_path_pdf, render_pool
+
+
+class FairQueue:
+    """Queue of items of several clients, which get them in turns
+
+    A client queueing many items does not delay items of the others by more
+    than one item each.
+    """
+
+    def __init__(self):
+        #client: deque of its items, in the order the clients get their turns
+        self._queues = OrderedDict()
+        self._condition = Condition()
+        self._closed = False
+
+
+    def put(self, client, item):
+        with self._condition:
+            self._queues.setdefault(client, deque()).append(item)
+            self._condition.notify()
+
+
+    def get(self):
+        """Return the next item (waiting for it), None once the queue is
+        closed"""
+
+        with self._condition:
+            while not self._queues and not self._closed:
+                self._condition.wait()
+            if not self._queues:
+                return None
+
+            client, items = self._queues.popitem(last=False)
+            item = items.popleft()
+            if items:
+                #the client's turn is over
+                self._queues[client] = items
+            return item
+
+
+    def __len__(self):
+        with self._condition:
+            return sum(len(items) for items in self._queues.values())
+
+
+    def close(self):
+        """Make get() return None once the queue is empty"""
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class Job:
+    """Request for a map of one gpx file"""
+
+    def __init__(self, client, data, options):
+        self.id = uuid.uuid4().hex
+        self.client = client
+        #content of the gpx file (dropped once the job is done)
+        self.data = data
+        #keyword arguments of path_surroundings
+        self.options = options
+
+        #"queued", "running", "done" or "failed"
+        self.status = "queued"
+        self.error = None
+        #name of the pdf file once done
+        self.filename = None
+
+        self.created = time.time()
+        self.finished = None
+        self.done = Event()
+
+
+    def info(self):
+        """Return dict describing the job (for json)"""
+
+        return {"id": self.id, "status": self.status, "error": self.error,
+                "created": self.created, "finished": self.finished}
+
+
+class MapService:
+    """Creates maps of gpx files for several clients by one MapDownloader
+
+    The downloader (with its session, tile store and cache of decoded tiles)
+    stays the same for all the jobs, which are rendered by workers threads,
+    taken from the clients in turns (see FairQueue). With option jobs > 1,
+    the images are rendered by a pool of processes shared by all the jobs,
+    which also stays running.
+    """
+
+    def __init__(self, md, workers=2, keep=3600, pdf_options=None, **options):
+        """
+        Arguments:
+
+        md: MapDownloader
+        workers: number of jobs rendered at once
+        keep: how many seconds finished jobs (and their pdfs) are kept
+        pdf_options: dict of keyword arguments of create_path_pdf
+        options: default keyword arguments of path_surroundings
+        """
+
+        self.md = md
+        self.keep = keep
+        self.pdf_options = pdf_options or {}
+        self.options = options
+
+        self.jobs = {}
+        self._jobs_lock = Lock()
+        #number of jobs being rendered
+        self._running = 0
+        self._queue = FairQueue()
+        self._directory = tempfile.mkdtemp(prefix="pathmap-")
+
+        #render processes started once, not for every job
+        self._render_pool = None
+        if options.get("jobs", 1) > 1:
+            self._render_pool = render_pool(md, options["jobs"])
+
+        self._workers = [Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+
+
+    def submit(self, client, data, **options):
+        """Queue map of gpx file with content data (bytes) for client,
+        created with keyword arguments options of path_surroundings (on top
+        of the default ones); return the Job"""
+
+        self._expire()
+        job = Job(client, data, dict(self.options, **options))
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+        self._queue.put(client, job)
+        return job
+
+
+    def get(self, job_id):
+        """Return Job job_id, or None if there is no such job"""
+
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+
+    def _expire(self):
+        """Forget jobs finished more than keep seconds ago"""
+
+        now = time.time()
+        with self._jobs_lock:
+            expired = [job for job in self.jobs.values()
+                       if job.finished is not None and now - job.finished > self.keep]
+            for job in expired:
+                del self.jobs[job.id]
+
+        for job in expired:
+            if job.filename is not None and os.path.exists(job.filename):
+                os.remove(job.filename)
+
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._run(job)
+
+
+    def _run(self, job):
+        job.status = "running"
+        with self._jobs_lock:
+            #a long running service should not use up the retries for good;
+            #the jobs running at once share the retry budget, so it gets
+            #renewed only when no other job is drawing from it
+            if not self._running:
+                self.md.reset_retry_budget()
+            self._running += 1
+        try:
+            path = gpx.read_gpx(BytesIO(job.data), split=True, prefer_tracks=True)
+            if not path:
+                raise ValueError("The gpx file has no track or route points")
+
+            filename = os.path.join(self._directory, job.id + ".pdf")
+            parts = path_surroundings(self.md, path, executor=self._render_pool, **job.options)
+            create_path_pdf(parts, filename, **self.pdf_options)
+            job.filename = filename
+            job.status = "done"
+        except Exception as e:
+            job.error = "{}: {}".format(type(e).__name__, e)
+            job.status = "failed"
+        finally:
+            with self._jobs_lock:
+                self._running -= 1
+            job.data = None
+            job.finished = time.time()
+            job.done.set()
+
+
+    def serve(self, host="127.0.0.1", port=8080):
+        """Return ThreadingHTTPServer (not yet serving) of the service, see
+        ServiceHandler"""
+
+        server = ThreadingHTTPServer((host, port), ServiceHandler)
+        server.daemon_threads = True
+        server.service = self
+        return server
+
+
+    def close(self):
+        """Finish the queued jobs, stop the workers and delete the pdfs"""
+
+        self._queue.close()
+        for worker in self._workers:
+            worker.join()
+        if self._render_pool is not None:
+            self._render_pool.shutdown()
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+def _job_options(query):
+    """Return keyword arguments of path_surroundings given by query (dict
+    from parse_qs) of a job request; raise ValueError if they are wrong"""
+
+    options = {}
+    if "radius" in query:
+        options["radius_pix"] = int(query["radius"][0])
+        if not 0 < options["radius_pix"] <= 1000:
+            raise ValueError("radius should be between 1 and 1000")
+    if "color" in query:
+        options["path_color"] = ImageColor.getrgb(query["color"][0])
+    if "simplify" in query:
+        options["simplify_pix"] = float(query["simplify"][0])
+    return options
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """HTTP interface of MapService (server.service)
+
+    POST /jobs with a gpx file as the body queues a map of it. Query
+    parameters radius, color and simplify correspond to the command line
+    options of main.py. With wait=1 the response is the pdf (once it is
+    ready), otherwise 202 with json describing the job (see Job.info) and
+    its url in Location header.
+
+    GET /jobs/<id> returns json describing the job, GET /jobs/<id>/pdf its
+    pdf once the job is done.
+
+    Clients are told apart by X-Client-Id header, or by their address.
+    """
+
+    #maximum size of an uploaded gpx file
+    max_upload = 64 * 2**20
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path.rstrip("/") != "/jobs":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        length = int(self.headers.get("Content-Length", 0))
+        if length > self.max_upload:
+            self._send_json(413, {"error": "The gpx file is too big"})
+            return
+        data = self.rfile.read(length)
+
+        query = parse_qs(url.query)
+        try:
+            options = _job_options(query)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        client = self.headers.get("X-Client-Id") or self.client_address[0]
+        job = self.server.service.submit(client, data, **options)
+
+        if query.get("wait", ["0"])[0] in ("1", "true", "yes"):
+            job.done.wait()
+            self._send_result(job)
+        else:
+            self._send_json(202, job.info(), {"Location": "/jobs/{}".format(job.id)})
+
+
+    def do_GET(self):
+        parts = urlsplit(self.path).path.strip("/").split("/")
+        job = None
+        if len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.server.service.get(parts[1])
+
+        if job is None or (len(parts) == 3 and parts[2] != "pdf"):
+            self._send_json(404, {"error": "Not found"})
+        elif len(parts) == 2:
+            self._send_json(200, job.info())
+        else:
+            self._send_result(job)
+
+
+    def _send_result(self, job):
+        if job.status == "failed":
+            self._send_json(422, job.info())
+            return
+        if job.status != "done":
+            self._send_json(409, job.info())
+            return
+
+        try:
+            with open(job.filename, "rb") as f:
+                data = f.read()
+        except OSError:
+            #expired meanwhile
+            self._send_json(404, {"error": "Not found"})
+            return
+        self._send(200, data, "application/pdf")
+
+
+    def _send_json(self, status, obj, headers=None):
+        self._send(status, json.dumps(obj).encode("utf8"), "application/json", headers)
+
+
+    def _send(self, status, data, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
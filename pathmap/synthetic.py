@@ -0,0 +1,167 @@
+from io import BytesIO
+from math import pi, log, tan, cos, radians
+import random
+import time
+import numpy as np
+import requests
+from PIL import Image, ImageDraw
+
+from . getmap import MapDownloader
+from . ratecontrol import check_tile_response
+
+
+#colors of the synthetic map: background, forests, water, roads
+_COLORS = [(242, 239, 233), (200, 225, 190), (170, 210, 240), (255, 255, 255), (250, 200, 120)]
+
+#spacing of the road grid in pixels
+_ROAD_SPACING = 97
+
+
+def synthetic_tile(x, y, size=256):
+    """Return bytes of a PNG map tile x, y generated from its coordinates
+
+    The same coordinates always give the same tile. Tiles have a few flat
+    colors like real map tiles, and a grid of roads continuing from one
+    tile to the next.
+    """
+
+    rnd = random.Random(x * 1000003 + y)
+    im = Image.new("RGB", (size, size), _COLORS[0])
+    draw = ImageDraw.Draw(im)
+
+    for _ in range(rnd.randrange(4)):
+        cx, cy, r = rnd.randrange(size), rnd.randrange(size), rnd.randrange(10, size // 2)
+        draw.ellipse((cx - r, cy - r, cx + r, cy + r), fill=_COLORS[rnd.choice((1, 1, 2))])
+
+    for i, color in ((0, _COLORS[3]), (1, _COLORS[4])):
+        spacing = _ROAD_SPACING * (1 + 2 * i)
+        for p in range(-(x * size) % spacing, size, spacing):
+            draw.line((p, 0, p, size), fill=color, width=3 + 2 * i)
+        for p in range(-(y * size) % spacing, size, spacing):
+            draw.line((0, p, size, p), fill=color, width=3 + 2 * i)
+
+    out = BytesIO()
+    im.save(out, "PNG")
+    return out.getvalue()
+
+
+class SyntheticMapDownloader(MapDownloader):
+    """Map with generated tiles (see synthetic_tile) in the projection of
+    OpenStreetMap-like maps (Web Mercator)
+
+    Tiles are generated locally, optionally after waiting latency seconds,
+    or downloaded from url (such as tileserver.TileServer).
+    """
+
+    def __init__(self, url=None, latency=0, zoom=13, **kwargs):
+        """
+        Arguments:
+
+        url: base url of a server with tiles at url/x/y, or None to generate
+            the tiles
+        latency: how long generating of a tile takes (in seconds)
+        zoom: zoom level of the map
+        kwargs: see MapDownloader
+        """
+
+        self.url = url
+        self.latency = latency
+        super().__init__(**kwargs)
+
+        self.xres = 256
+        self.yres = 256
+        self.provider = "synthetic"
+        self.zoom = zoom
+
+
+    _runtime_attributes = MapDownloader._runtime_attributes + ["s"]
+
+    def _init_runtime(self):
+        super()._init_runtime()
+        self.s = requests.Session()
+
+
+    def lon_lat_to_tiles(self, lon, lat):
+        n = 2**self.zoom
+        lat = radians(lat)
+        return (lon + 180) / 360 * n, (1 - log(tan(lat) + 1 / cos(lat)) / pi) / 2 * n
+
+
+    def lon_lat_to_tiles_many(self, lons, lats):
+        n = 2**self.zoom
+        lats = np.radians(np.asarray(lats, dtype=np.float64))
+        xs = (np.asarray(lons, dtype=np.float64) + 180) / 360 * n
+        ys = (1 - np.log(np.tan(lats) + 1 / np.cos(lats)) / pi) / 2 * n
+        return xs, ys
+
+
+    def _tile_url(self, x, y):
+        return "{}/{}/{}".format(self.url, x, y)
+
+
+    def _download_tile(self, x, y):
+        if self.url is not None:
+            r = self.s.get(self._tile_url(x, y))
+            check_tile_response("Tile {}, {}".format(x, y), r.status_code, r.headers)
+            return r.content
+
+        if self.latency:
+            time.sleep(self.latency)
+        return synthetic_tile(x, y, self.xres)
+
+
+def synthetic_route(shape, length_km, start=(13.45, 48.57), seed=0):
+    """Return (longitude, latitude) points (numpy array of shape (n, 2)) of
+    a route of given shape and length, with a point every 20 m or so
+
+    Arguments:
+
+    shape: "line" (heading north-east), "loop" (a circle returning to the
+        start), "zigzag" (north with regular turns east and west) or
+        "wander" (random walk)
+    length_km: length of the route in kilometres
+    start: (longitude, latitude) of the first point
+    seed: seed of the random walk
+    """
+
+    step_km = 0.02
+    n = max(2, int(length_km / step_km) + 1)
+    t = np.arange(n) * step_km
+
+    if shape == "line":
+        east, north = t / 2**0.5, t / 2**0.5
+    elif shape == "loop":
+        r = length_km / (2 * pi)
+        phi = t / r
+        east, north = r * np.sin(phi), r * (1 - np.cos(phi))
+    elif shape == "zigzag":
+        #legs of 5 km at 45° turning every 5 km
+        leg = 5
+        phase = (t % (2 * leg)) / leg
+        east = np.where(phase < 1, phase, 2 - phase) * leg / 2**0.5
+        north = t / 2**0.5
+    elif shape == "wander":
+        rnd = np.random.default_rng(seed)
+        heading = np.cumsum(rnd.normal(0, 0.15, n))
+        east = np.concatenate([[0], np.cumsum(np.sin(heading[1:]) * step_km)])
+        north = np.concatenate([[0], np.cumsum(np.cos(heading[1:]) * step_km)])
+    else:
+        raise ValueError("Unknown route shape {}".format(shape))
+
+    lon0, lat0 = start
+    lats = lat0 + north / 111.32
+    lons = lon0 + east / (111.32 * cos(radians(lat0)))
+    return np.column_stack([lons, lats])
+
+
+def write_gpx(points, filename):
+    """Write (longitude, latitude) points as a single track into gpx file
+    filename"""
+
+    with open(filename, "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="pathmap" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                '<trk><trkseg>\n')
+        for lon, lat in points:
+            f.write('<trkpt lat="{:.7f}" lon="{:.7f}"></trkpt>\n'.format(lat, lon))
+        f.write('</trkseg></trk>\n</gpx>\n')
@@ -0,0 +1,90 @@
+import unittest
+import threading
+from io import BytesIO
+from PIL import Image
+from .. import asyncfetch
+from .. asyncfetch import AsyncTileFetcher, TileFetchError
+from .. tilestore import MemoryTileStore
+from .. tileserver import TileServer
+from . test_getmap import FakeMapDownloader
+
+
+def colored_tile(x, y):
+    """16x16 tile colored by its coordinates, as by FakeMapDownloader"""
+
+    out = BytesIO()
+    Image.new("RGB", (16, 16), (x % 256, y % 256, 0)).save(out, "PNG")
+    return out.getvalue()
+
+
+class HTTPMapDownloader(FakeMapDownloader):
+
+    def __init__(self, url, **kwargs):
+        super().__init__(**kwargs)
+        self.url = url
+
+    def _tile_url(self, x, y):
+        return "{}/{}/{}".format(self.url, x, y)
+
+
+@unittest.skipIf(asyncfetch.aiohttp is None, "aiohttp is not installed")
+class TestAsyncTileFetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TileServer(colored_tile).start()
+        self.url = self.server.url
+        self.fetcher = AsyncTileFetcher(concurrency=8, backoff=0.01)
+
+    def tearDown(self):
+        self.fetcher.close()
+        self.server.stop()
+
+    def test_fetch_many(self):
+        """Tiles should be downloaded in the order of urls"""
+
+        urls = ["{}/{}/{}".format(self.url, x, 7) for x in range(20)]
+        for x, data in enumerate(self.fetcher.fetch_many(urls)):
+            self.assertEqual(Image.open(BytesIO(data)).getpixel((0, 0)), (x, 7, 0))
+
+    def test_cookies_off_loop(self):
+        """Cookie functions (which may block) should not run in the event
+        loop"""
+
+        threads = []
+        def cookies():
+            threads.append(threading.current_thread())
+            return {"a": "b"}
+
+        self.fetcher.fetch_many(["{}/{}/{}".format(self.url, x, 7) for x in range(3)], cookies=cookies)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(self.fetcher._thread, threads)
+
+    def test_retry(self):
+        """Failed requests should be retried"""
+
+        self.server.failures = 2
+        data = self.fetcher.fetch("{}/1/2".format(self.url))
+        self.assertEqual(Image.open(BytesIO(data)).getpixel((0, 0)), (1, 2, 0))
+        self.assertEqual(self.server.requests[(1, 2)], 3)
+
+    def test_retries_exhausted(self):
+        """TileFetchError should be raised once retries are exhausted"""
+
+        self.server.failures = 100
+        with self.assertRaises(TileFetchError):
+            self.fetcher.fetch("{}/1/2".format(self.url))
+        self.assertEqual(self.server.requests[(1, 2)], self.fetcher.retries + 1)
+
+    def test_map_downloader(self):
+        """MapDownloader should download tiles by its fetch_engine"""
+
+        md = HTTPMapDownloader(self.url, tile_store=MemoryTileStore(), fetch_engine=self.fetcher)
+        im = md.get_rect_tiles(2.5, 3, 4.5, 4, parallel=True)
+        self.assertEqual(im.getpixel((31, 15)), (4, 3, 0))
+        self.assertEqual(md.get_tile(8, 9).getpixel((0, 0)), (8, 9, 0))
+        self.assertEqual(md.downloaded, [])
+        self.assertEqual(len(md.tile_store.tiles), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,16 @@
 import unittest
 import tempfile
+import time
 from PIL import Image
-from .. cykloserver import CykloserverMapDownloader
+from .. cykloserver import CykloserverMapDownloader, _tt_descramble
+from .. tilestore import MemoryTileStore
 
 
 class TestCykloserver(unittest.TestCase):
     
     @classmethod
     def setUpClass(cls):
-        cls.c = CykloserverMapDownloader()
+        cls.c = CykloserverMapDownloader(tile_store=MemoryTileStore())
 
     def test__get_js_output_known_values(self):
         """_get_js_output should give known output for known input"""
@@ -31,6 +33,89 @@ class TestCykloserver(unittest.TestCase):
             self.assertEqual(self.c._get_js_output(inp).strip(), out)
 
 
+    def test__tt_descramble_known_values(self):
+        """_tt_descramble should give the same output as its javascript
+        version"""
+
+        for data in ["", "0970980", "072101108108111", "04905005112"]:
+            script = self.c._descramble_js + "console.log(__tt_descramble('{}'))".format(data)
+            self.assertEqual(_tt_descramble(data), self.c._get_js_output(script)[:-1])
+
+
+    def test__parse_tokens(self):
+        """_parse_tokens should descramble tokens with or without the help of
+        nodejs"""
+
+        native = """
+            var __tt_tokenm = __tt_descramble('097098');
+            var __tt_tokent = __tt_descramble("049050051");
+            var __tt_tokenk = __tt_descramble('120');
+        """
+        self.assertEqual(self.c._parse_tokens(native), ("ab", "123", "x"))
+
+        evaluated = """
+            var __tt_tokenm = 'a' + 'b';
+            var __tt_tokent = __tt_descramble('049050051');
+            var __tt_tokenk = __tt_descramble('1' + '20');
+        """
+        self.assertEqual(self.c._parse_tokens(evaluated), ("ab", "123", "x"))
+
+
+    def test__ensure_token_background(self):
+        """Token should be renewed in the background while tiles are being
+        downloaded, and not after that"""
+
+        c = CykloserverMapDownloader(tile_store=MemoryTileStore())
+        c.token_lifetime = 0.4
+        c.renew_margin = 0.2
+        renewals = []
+        def renew():
+            renewals.append(time.time())
+            c.last_token_acquired = time.time()
+        c._renew_token = renew
+
+        try:
+            for i in range(8):
+                c._ensure_token()
+                time.sleep(0.1)
+            #the first renewal is synchronous, the others background
+            self.assertGreaterEqual(len(renewals), 3)
+            self.assertTrue(time.time() - c.last_token_acquired < c.token_lifetime)
+
+            time.sleep(3 * c.token_lifetime)
+            count = len(renewals)
+            time.sleep(2 * c.token_lifetime)
+            self.assertEqual(len(renewals), count)
+        finally:
+            c.close()
+
+
+    def test__ensure_token_failed_renewal(self):
+        """Background thread should not hold the renewal lock while it waits
+        to try a failed renewal again"""
+
+        c = CykloserverMapDownloader(tile_store=MemoryTileStore())
+        c.token_lifetime = 0.4
+        c.renew_margin = 0.2
+        renewals = []
+        def renew():
+            renewals.append(time.time())
+            if len(renewals) > 1:
+                raise IOError("renewal failed")
+            c.last_token_acquired = time.time()
+        c._renew_token = renew
+
+        try:
+            c._ensure_token()
+            #the background renewal fails at 0.2 s and waits 0.1 s
+            time.sleep(0.25)
+            self.assertEqual(len(renewals), 2)
+            self.assertTrue(c._renew_lock.acquire(timeout=0.02))
+            c._renew_lock.release()
+        finally:
+            c.close()
+
+
     def test__url2dict_known_values(self):
         """_url2dict should give known output for known input"""
 
@@ -115,6 +200,20 @@ class TestCykloserver(unittest.TestCase):
             self.assertAlmostEqual(y, tc[1], delta=0.01)
 
 
+    def test_lon_lat_to_tiles_many(self):
+        """should return the same coords as lon_lat_to_tiles"""
+
+        lons = [17.44593229, 14.32647425, 14.23841180]
+        lats = [49.32475974, 50.09219194, 48.89340921]
+
+        xs, ys = self.c.lon_lat_to_tiles_many(lons, lats)
+        self.assertEqual(xs.shape, (3,))
+        for lon, lat, x, y in zip(lons, lats, xs, ys):
+            x2, y2 = self.c.lon_lat_to_tiles(lon, lat)
+            self.assertAlmostEqual(x, x2, places=9)
+            self.assertAlmostEqual(y, y2, places=9)
+
+
     def test__download_tile_known(self):
         """Downloaded tiles should be the same as known tiles"""
 
@@ -164,7 +263,7 @@ class TestCykloserver(unittest.TestCase):
         ]]
 
         for gpx, path in zip(gpxes, paths):
-            self.assertEqual(self.c.gpx2path(gpx), path)
+            self.assertEqual([tuple(p) for p in self.c.gpx2path(gpx)], path)
             
 
 
@@ -1,8 +1,557 @@
 import unittest
-from .. getmap import MapDownloader
+import tempfile
+import weakref
+import time
+from threading import Thread
+import numpy as np
+from io import BytesIO
+from PIL import Image
+from shapely.geometry import LineString, Point
+from shapely.geometry import box
+from shapely import affinity
+from .. getmap import MapDownloader, path_surroundings, simplify_path, corridor_tiles, rect_tiles, _best_angle
+from .. getmap import _rotate_and_crop, create_path_pdf, route_tiles
+from .. getmap import seed_estimate, seed_tiles, MissingTileError, create_path_pdfs
+from .. tilestore import MemoryTileStore, SqliteTileStore
+from .. ratecontrol import TileNotFoundError, TileDownloadError
+from .. partcache import PartCache
+from .. getmap import _path_bites
+from .. import profile
+from .. import getmap
+
+
+class FakeMapDownloader(MapDownloader):
+    """Generates 16x16 tiles colored by their coordinates"""
+
+    def __init__(self, tile_store=None, **kwargs):
+        super().__init__(tile_store if tile_store is not None else MemoryTileStore(), **kwargs)
+        self.xres = 16
+        self.yres = 16
+        self.provider = "fake"
+        self.zoom = 1
+        self.downloaded = []
+
+    def lon_lat_to_tiles(self, lon, lat):
+        return (lon, lat)
+
+    def _download_tile(self, x, y):
+        self.downloaded.append((x, y))
+        out = BytesIO()
+        Image.new("RGB", (self.xres, self.yres), (x % 256, y % 256, 0)).save(out, "PNG")
+        return out.getvalue()
+
 
 class TestGetmap(unittest.TestCase):
-    pass
+
+    def test_get_tile_stores(self):
+        """Downloaded tiles should be stored and not downloaded again"""
+
+        store = MemoryTileStore()
+        md = FakeMapDownloader(store)
+        im = md.get_tile(3, 4)
+        self.assertEqual(im.getpixel((0, 0)), (3, 4, 0))
+        self.assertIn(("fake", 1, 3, 4), store.tiles)
+
+        md2 = FakeMapDownloader(store)
+        self.assertEqual(md2.get_tile(3, 4).getpixel((5, 5)), (3, 4, 0))
+        self.assertEqual(md2.downloaded, [])
+
+    def test_get_rect_tiles(self):
+        """Rectangle should be composed of the right tiles"""
+
+        for parallel in (False, True):
+            md = FakeMapDownloader()
+            im = md.get_rect_tiles(2.5, 3, 4.5, 4, parallel=parallel)
+            self.assertEqual(im.size, (32, 16))
+            self.assertEqual(im.getpixel((0, 0)), (2, 3, 0))
+            self.assertEqual(im.getpixel((10, 10)), (3, 3, 0))
+            self.assertEqual(im.getpixel((31, 15)), (4, 3, 0))
+            self.assertEqual(sorted(md.downloaded), [(2, 3), (2, 4), (3, 3), (3, 4), (4, 3), (4, 4)])
+
+    def test_decoded_tiles_reused(self):
+        """Overlapping rectangles should reuse decoded tiles"""
+
+        md = FakeMapDownloader()
+        md.get_rect_tiles(2.5, 3, 4.5, 3.5, parallel=True)
+        self.assertEqual(md.decoded_tiles.hits, 0)
+        md.get_rect_tiles(3.5, 3, 5.5, 3.5)
+        self.assertEqual(md.decoded_tiles.hits, 2)
+        self.assertEqual(len(md.downloaded), 4)
+
+    def test_prefetch(self):
+        """Prefetched tiles should get stored once, in the given order"""
+
+        md = FakeMapDownloader()
+        md.workers = 1
+        md.prefetch([(1, 1), (2, 1), (1, 1), (3, 1)])
+        md.executor.shutdown(wait=True)
+        self.assertEqual(md.downloaded, [(1, 1), (2, 1), (3, 1)])
+        self.assertEqual(len(md.tile_store.tiles), 3)
+
+    def test_single_flight(self):
+        """Concurrent requests for a tile should share one download"""
+
+        md = FakeMapDownloader()
+        download = md._download_tile
+        def slow_download(x, y):
+            time.sleep(0.1)
+            return download(x, y)
+        md._download_tile = slow_download
+
+        threads = [Thread(target=md.get_tile, args=(1, 2)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        md.prefetch([(1, 2), (3, 4)])
+        md.fetch_tiles([(1, 2), (3, 4)])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(md.downloaded), [(1, 2), (3, 4)])
+        self.assertEqual(md._pending, {})
+
+    def test_shared_store_lock(self):
+        """A downloader waiting for the lock of a tile held by another one
+        (as if in another process) should find the tile stored"""
+
+        with tempfile.TemporaryDirectory() as tdir:
+            path = "{}/tiles.mbtiles".format(tdir)
+            md1 = FakeMapDownloader(SqliteTileStore(path))
+            md2 = FakeMapDownloader(SqliteTileStore(path))
+
+            key = md1._tile_key(5, 6)
+            with md1.tile_store.lock(key):
+                thread = Thread(target=md2.get_tile, args=(5, 6))
+                thread.start()
+                time.sleep(0.1)
+                md1._download_retrying(5, 6)
+            thread.join()
+
+            self.assertEqual(md1.downloaded, [(5, 6)])
+            self.assertEqual(md2.downloaded, [])
+            self.assertEqual(md2.get_tile(5, 6).getpixel((0, 0)), (5, 6, 0))
+            md1.close()
+            md2.close()
+
+    def test_missing_tiles(self):
+        """Tiles which the server does not have should be blank and not
+        requested again until missing_ttl passes"""
+
+        md = FakeMapDownloader(missing_ttl=0.2)
+        download = md._download_tile
+        def download_or_missing(x, y):
+            if x == 3:
+                md.downloaded.append((x, y))
+                raise TileNotFoundError("no tile")
+            return download(x, y)
+        md._download_tile = download_or_missing
+
+        im = md.get_rect_tiles(2.5, 3, 4.5, 4, parallel=True)
+        self.assertEqual(im.getpixel((10, 10)), md.blank_color)
+        self.assertEqual(im.getpixel((31, 15)), (4, 3, 0))
+        md.fetch_tiles([(3, 3), (3, 4)])
+        self.assertEqual(md.get_tile(3, 3).getpixel((0, 0)), md.blank_color)
+        self.assertEqual(md.downloaded.count((3, 3)), 1)
+
+        #the server has got the tile meanwhile
+        time.sleep(0.2)
+        md._download_tile = download
+        self.assertEqual(md.get_tile(3, 3).getpixel((0, 0)), (3, 3, 0))
+        self.assertEqual(md.get_rect_tiles(2.5, 3, 4.5, 4).getpixel((10, 10)), (3, 3, 0))
+
+    def test_retry_budget(self):
+        """Broken tiles should be retried a limited number of times, then
+        fail or be blank"""
+
+        md = FakeMapDownloader(retries=2, retry_budget=3)
+        def broken(x, y):
+            md.downloaded.append((x, y))
+            return b"<html>error</html>"
+        md._download_tile = broken
+
+        with self.assertRaises(TileDownloadError):
+            md.get_tile(1, 1)
+        self.assertEqual(md.downloaded, [(1, 1)] * 3)
+
+        #one retry left in the budget
+        md.blank_failed = True
+        self.assertEqual(md.get_tile(2, 1).getpixel((0, 0)), md.blank_color)
+        self.assertEqual(md.downloaded.count((2, 1)), 2)
+        md.get_tile(3, 1)
+        self.assertEqual(md.downloaded.count((3, 1)), 1)
+
+        md.reset_retry_budget()
+        md.get_tile(4, 1)
+        self.assertEqual(md.downloaded.count((4, 1)), 3)
+
+    def test_path_surroundings(self):
+        """Parts should respect the size limits and cover the path"""
+
+        md = FakeMapDownloader()
+        path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+        for rotate in (False, True):
+            parts = list(path_surroundings(md, path, radius_pix=4, maxwidth_pix=40, maxheight_pix=30,
+                                           maxdist_pix=20, path_color=(255, 0, 0),
+                                           shorten_by_rotating=rotate))
+            self.assertGreater(len(parts), 1)
+            for im in parts:
+                self.assertLessEqual(im.width, 40 + 2)
+                self.assertLessEqual(im.height, 30 + 2)
+                self.assertIn((255, 0, 0, 255), [c for _, c in im.getcolors(10000)])
+        md.close()
+
+    def test_path_surroundings_jobs(self):
+        """Parts rendered by several processes should be the same and in the
+        same order"""
+
+        with tempfile.TemporaryDirectory() as tdir:
+            md = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)))
+            path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+            options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+
+            parts = list(path_surroundings(md, path, jobs=2, **options))
+            expected = list(path_surroundings(md, path, **options))
+            self.assertGreater(len(parts), 4)
+            self.assertEqual([im.tobytes() for im in parts], [im.tobytes() for im in expected])
+            md.close()
+
+    def test_stable_bites(self):
+        """An edit of the path should change only the bites near it"""
+
+        md = FakeMapDownloader()
+        path = [(10 + i / 8, 20 + (i % 7) / 10) for i in range(400)]
+        #a detour in the middle
+        x0, y0 = path[200]
+        detour = [(x0, y0 + i / 8) for i in range(12)] + [(x0, y0 + 1.5 - i / 8) for i in range(12)]
+        edited = path[:200] + detour + path[200:]
+        options = (4 / md.xres, 40, 30, 20, None)
+
+        common = {}
+        for stable in (False, True):
+            bites = _path_bites(md, path, *options, stable_bites=stable)
+            edited_bites = _path_bites(md, edited, *options, stable_bites=stable)
+            common[stable] = len([b for b in edited_bites if b in bites])
+        self.assertEqual(bites[-1], edited_bites[-1])
+        self.assertGreater(common[True], len(bites) * 3 / 4)
+        self.assertGreater(common[True], common[False])
+
+        #the bites cover the path
+        self.assertEqual(bites[0][0][0], path[0])
+        self.assertEqual(bites[-1][0][-1], path[-1])
+
+    def test_path_segments(self):
+        """Separate segments of a path should not be connected"""
+
+        md = FakeMapDownloader()
+        first = np.array([(10 + i / 8, 20) for i in range(20)])
+        second = np.array([(20 + i / 8, 30) for i in range(20)])
+        options = (4 / md.xres, 40, 30, 20, None)
+
+        bites = _path_bites(md, [first, second], *options)
+        self.assertEqual(bites, _path_bites(md, first, *options) + _path_bites(md, second, *options))
+        self.assertNotEqual(bites, _path_bites(md, np.concatenate([first, second]), *options))
+
+    def test_single_point_segment(self):
+        """A segment of a single point should be mapped around the point"""
+
+        md = FakeMapDownloader()
+        for rotate in (True, False):
+            parts = list(path_surroundings(md, [np.array([(5.5, 5.5)]), np.array([(8, 5), (9, 5)])],
+                                           radius_pix=4, shorten_by_rotating=rotate))
+            self.assertEqual(len(parts), 2)
+            self.assertEqual(parts[0].size, (8, 8))
+            self.assertEqual(parts[0].getpixel((4, 4)), (5, 5, 0, 255))
+
+    def test_part_cache(self):
+        """Parts of unchanged bites should be taken from the part cache"""
+
+        path = [(10 + i / 8, 20 + (i % 7) / 10) for i in range(200)]
+        edited = list(path)
+        edited[100:105] = [(x, y + 0.5) for x, y in path[100:105]]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+
+        with tempfile.TemporaryDirectory() as tdir:
+            cache = PartCache(tdir)
+            md = FakeMapDownloader()
+            parts = [im.tobytes() for im in path_surroundings(md, path, part_cache=cache, **options)]
+            self.assertEqual(parts, [im.tobytes() for im in path_surroundings(
+                md, path, stable_bites=True, **options)])
+
+            #everything is cached, no tiles are needed
+            md = FakeMapDownloader()
+            self.assertEqual([im.tobytes() for im in path_surroundings(md, path, part_cache=cache, **options)],
+                             parts)
+            self.assertEqual(md.downloaded, [])
+
+            md = FakeMapDownloader()
+            profiler = profile.enable()
+            try:
+                edited_parts = list(path_surroundings(md, edited, part_cache=cache, jobs=2, **options))
+            finally:
+                profile.disable()
+            counters = profiler.report()["counters"]
+            self.assertGreater(counters["part_cache_hits"], len(edited_parts) / 2)
+            self.assertGreater(counters["part_cache_misses"], 0)
+            self.assertEqual([im.tobytes() for im in edited_parts], [im.tobytes() for im in path_surroundings(
+                FakeMapDownloader(), edited, stable_bites=True, **options)])
+
+    def test_route_tiles(self):
+        """route_tiles should list the tiles path_surroundings needs"""
+
+        md = FakeMapDownloader()
+        path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+        tiles = route_tiles(md, path, **options)
+        self.assertEqual(len(tiles), len(set(tiles)))
+
+        list(path_surroundings(md, path, **options))
+        self.assertEqual(sorted(md.downloaded), sorted(tiles))
+
+    def test_seed(self):
+        """Seeding should download the missing tiles only, so that the map can
+        be created offline"""
+
+        store = MemoryTileStore()
+        md = FakeMapDownloader(store)
+        path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+        tiles = route_tiles(md, path, **options)
+        md.get_tile(*tiles[0])
+
+        estimate = seed_estimate(md, tiles)
+        self.assertEqual(estimate["tiles"], len(tiles))
+        self.assertEqual(estimate["missing"], len(tiles) - 1)
+        self.assertEqual(estimate["bytes"], int((len(tiles) - 1) * len(store.tiles[("fake", 1) + tiles[0]])))
+
+        progress = list(seed_tiles(md, tiles, batch=4))
+        self.assertEqual(progress[0], (0, len(tiles) - 1))
+        self.assertEqual(progress[-1], (len(tiles) - 1, len(tiles) - 1))
+        self.assertEqual(sorted(md.downloaded), sorted(tiles))
+        self.assertEqual(seed_estimate(md, tiles)["missing"], 0)
+
+        offline = FakeMapDownloader(store, offline=True)
+        self.assertEqual(len(list(path_surroundings(offline, path, **options))),
+                         len(list(path_surroundings(md, path, **options))))
+        self.assertEqual(offline.downloaded, [])
+        with self.assertRaises(MissingTileError):
+            offline.get_tile(1000, 1000)
+
+    def test_seed_missing(self):
+        """Tiles which the server does not have should be marked in the tile
+        store, so that later runs (offline ones too) do not ask for them"""
+
+        path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+
+        with tempfile.TemporaryDirectory() as tdir:
+            md = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)))
+            tiles = route_tiles(md, path, **options)
+            download = md._download_tile
+            def download_or_missing(x, y):
+                if (x, y) == tiles[3]:
+                    raise TileNotFoundError("no tile")
+                return download(x, y)
+            md._download_tile = download_or_missing
+            list(seed_tiles(md, tiles))
+            md.close()
+
+            md = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)))
+            estimate = seed_estimate(md, tiles)
+            self.assertEqual((estimate["unavailable"], estimate["missing"]), (1, 0))
+            list(seed_tiles(md, tiles))
+            self.assertEqual(md.downloaded, [])
+            md.close()
+
+            offline = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)), offline=True)
+            self.assertEqual(offline.get_tile(*tiles[3]).getpixel((0, 0)), offline.blank_color)
+            self.assertGreater(len(list(path_surroundings(offline, path, **options))), 1)
+            offline.close()
+
+    def test_create_path_pdfs(self):
+        """Tiles shared by paths should be downloaded once and every path
+        should get its own pdf"""
+
+        paths = [[(10 + i / 4, 20 + i / 8) for i in range(40)],
+                 [(10 + i / 4, 20 + i / 6) for i in range(30)],
+                 [(20 - i / 4, 25) for i in range(30)]]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+
+        md = FakeMapDownloader()
+        with tempfile.TemporaryDirectory() as tdir:
+            names = ["{}/{}.pdf".format(tdir, i) for i in range(len(paths))]
+            create_path_pdfs(md, paths, names, concurrency=2, **options)
+            self.assertEqual(len(md.downloaded), len(set(md.downloaded)))
+
+            for path, name in zip(paths, names):
+                create_path_pdf(path_surroundings(FakeMapDownloader(), path, **options), tdir + "/single.pdf")
+                with open(name, "rb") as f, open(tdir + "/single.pdf", "rb") as single:
+                    self.assertEqual(f.read(), single.read())
+
+    def test_bite_tiles_once(self):
+        """Tiles of every bite should be computed once for the prefetch and
+        the rendering"""
+
+        paths = [[(10 + i / 4, 20 + i / 8) for i in range(40)], [(20 - i / 4, 25) for i in range(30)]]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+        bites = [len(_path_bites(FakeMapDownloader(), path, 4 / 16, 40, 30, 20, None)) for path in paths]
+
+        calls = []
+        bite_tiles = getmap._bite_tiles
+        def counting_bite_tiles(*args):
+            calls.append(args)
+            return bite_tiles(*args)
+        getmap._bite_tiles = counting_bite_tiles
+        try:
+            with tempfile.TemporaryDirectory() as tdir:
+                create_path_pdfs(FakeMapDownloader(), paths, ["{}/{}.pdf".format(tdir, i) for i in range(2)],
+                                 **options)
+                self.assertEqual(len(calls), sum(bites))
+                del calls[:]
+                md = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)))
+                list(path_surroundings(md, paths[0], jobs=2, **options))
+                self.assertEqual(len(calls), bites[0])
+                md.close()
+        finally:
+            getmap._bite_tiles = bite_tiles
+
+    def test_create_path_pdfs_part_cache(self):
+        """With part_cache, every path should prefetch the tiles of its
+        uncached bites"""
+
+        paths = [[(10 + i / 4, 20 + i / 8) for i in range(40)], [(20 - i / 4, 25) for i in range(30)]]
+        options = dict(radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+
+        md = FakeMapDownloader()
+        prefetched = []
+        prefetch = md.prefetch
+        def counting_prefetch(tiles):
+            prefetched.append(list(tiles))
+            prefetch(tiles)
+        md.prefetch = counting_prefetch
+
+        with tempfile.TemporaryDirectory() as tdir:
+            names = ["{}/{}.pdf".format(tdir, i) for i in range(len(paths))]
+            create_path_pdfs(md, paths, names, part_cache=PartCache(tdir + "/parts"), **options)
+        self.assertEqual(len(prefetched), 2)
+        self.assertEqual(sorted(set(t for tiles in prefetched for t in tiles)), sorted(set(md.downloaded)))
+
+    def test_path_surroundings_corridor(self):
+        """Map should cover the surroundings of the path only"""
+
+        md = FakeMapDownloader()
+        path = [(10.5, 20.5), (11.5, 21.5), (12.5, 21.5)]
+        im, = path_surroundings(md, path, radius_pix=4, maxwidth_pix=100, maxheight_pix=100,
+                                path_color=None, shorten_by_rotating=False)
+        self.assertEqual(im.size, (40, 24))
+
+        #(x, y) in pixels of im, expected color
+        known = [
+            ((4, 4), (10, 20, 0, 255)),
+            ((20, 20), (11, 21, 0, 255)),
+            ((38, 21), (12, 21, 0, 255)),
+            ((1, 22), (255, 255, 255, 255)),
+            ((38, 1), (255, 255, 255, 255)),
+        ]
+        for xy, color in known:
+            self.assertEqual(im.getpixel(xy), color)
+
+        #each tile should be decoded once
+        self.assertEqual(md.decoded_tiles.misses, len(md.downloaded))
+
+    def test_corridor_tiles(self):
+        """Exactly the tiles intersecting the corridor should be returned"""
+
+        path = [(0.5, 0.5), (10.5, 10.5), (10.5, 15.5)]
+        tiles = corridor_tiles(path, 0.6)
+        corridor = LineString(path).buffer(0.6)
+
+        self.assertIn((0, 0), tiles[:4])
+        self.assertEqual(tiles[-1], (10, 16))
+        self.assertEqual(len(tiles), len(set(tiles)))
+        for x, y in rect_tiles(-1, -1, 12, 17):
+            self.assertEqual((x, y) in tiles, corridor.intersects(box(x, y, x + 1, y + 1)))
+        self.assertLess(len(tiles), len(rect_tiles(-0.1, -0.1, 11.1, 16.1)) / 2)
+
+    def test__best_angle(self):
+        """_best_angle should agree with rotating the whole polygon"""
+
+        def brute_force(surroundings, maxwidth, step):
+            best = 0
+            lowest_penalty = 1000
+            for angle in np.arange(-90, 90, step):
+                x1, y1, x2, y2 = affinity.rotate(surroundings, angle).bounds
+                if x2 - x1 < maxwidth and y2 - y1 + abs(angle) / 100 < lowest_penalty:
+                    lowest_penalty = y2 - y1 + abs(angle) / 100
+                    best = angle
+            return -best
+
+        paths = [
+            [(4000, 3000), (4001, 3002)],
+            [(4000, 3000), (4000.2, 3003), (4001, 3003.5)],
+            [(4000, 3000), (4003, 3000.1)],
+        ]
+        for path in paths:
+            surroundings = LineString(path).buffer(0.5)
+            for maxwidth in (4, 10):
+                self.assertAlmostEqual(_best_angle(surroundings, maxwidth, 3, step=5),
+                                       brute_force(surroundings, maxwidth, 5))
+
+                #finer step should not give higher parts
+                coarse = affinity.rotate(surroundings, -brute_force(surroundings, maxwidth, 5)).bounds
+                fine = affinity.rotate(surroundings, -_best_angle(surroundings, maxwidth, 3)).bounds
+                self.assertLessEqual(fine[3] - fine[1], coarse[3] - coarse[1] + 0.01)
+
+    def test__rotate_and_crop(self):
+        """Result should be the rotated surroundings, white outside the image"""
+
+        #horizontal strip 4x2 tiles of 10 px, left half black, right half red
+        im = Image.new("RGBA", (40, 20), (255, 0, 0, 255))
+        im.paste((0, 0, 0, 255), (0, 0, 20, 20))
+        surroundings = LineString([(1, 1), (3, 1)]).buffer(1)
+
+        same = _rotate_and_crop(im, 0, 10, 10, surroundings, 0, 0)
+        self.assertEqual(same.size, (40, 20))
+        self.assertEqual(same.getpixel((5, 10)), (0, 0, 0, 255))
+        self.assertEqual(same.getpixel((35, 10)), (255, 0, 0, 255))
+
+        #counterclockwise: the right half goes up
+        rotated = _rotate_and_crop(im, 90, 10, 10, surroundings, 0, 0)
+        self.assertEqual(rotated.size, (20, 40))
+        self.assertEqual(rotated.getpixel((10, 5)), (255, 0, 0, 255))
+        self.assertEqual(rotated.getpixel((10, 35)), (0, 0, 0, 255))
+
+        #corners of the bounding box lie outside of the image
+        diagonal = _rotate_and_crop(im, 45, 10, 10, surroundings, 0, 0)
+        self.assertEqual(diagonal.getpixel((0, 0)), (255, 255, 255, 255))
+
+    def test_create_path_pdf_streaming(self):
+        """Images should be released as soon as they are written"""
+
+        alive = []
+        def parts():
+            for i in range(10):
+                im = Image.new("RGB", (200, 100), (i, 0, 0))
+                alive.append(weakref.ref(im))
+                yield im
+                del im
+                #only the images waiting for encoding may still be referenced
+                self.assertLessEqual(sum(ref() is not None for ref in alive), 3)
+
+        with tempfile.TemporaryDirectory() as tdir:
+            create_path_pdf(parts(), "{}/out.pdf".format(tdir), encode_workers=1)
+        self.assertEqual(len(alive), 10)
+
+    def test_simplify_path(self):
+        """Simplified path should keep endpoints and stay within tolerance"""
+
+        path = [(i / 100, (i % 2) / 1000) for i in range(101)]
+        simple = simplify_path(path, 0.01)
+        self.assertEqual(simple, [path[0], path[-1]])
+
+        path = [(i / 10, (i // 10) % 2) for i in range(100)]
+        simple = simplify_path(path, 0.01)
+        self.assertLess(len(simple), len(path))
+        line = LineString(simple)
+        for p in path:
+            self.assertLessEqual(line.distance(Point(p)), 0.01)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,124 @@
+import unittest
+import tempfile
+from .. gpx import read_gpx, read_gpx_waypoints, _iter_points
+
+
+GPX = """<?xml version="1.0" encoding="UTF-8" ?>
+<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1">
+    <wpt lat="5.0" lon="6.0"><name>a</name></wpt>
+    <trk>
+        <name>day 1</name>
+        <trkseg>
+            <trkpt lat="1.0" lon="2.0"><ele>100</ele></trkpt>
+            <trkpt lat="1.5" lon="2.5"/>
+        </trkseg>
+        <trkseg>
+            <trkpt lat="3.0" lon="4.0"/>
+        </trkseg>
+    </trk>
+    <trk>
+        <trkseg>
+            <trkpt lat="7.0" lon="8.0"/>
+        </trkseg>
+    </trk>
+    <rte>
+        <rtept lat="9.0" lon="10.0"/>
+        <rtept lat="11.0" lon="12.0"/>
+    </rte>
+    <wpt lat="13.0" lon="14.0"/>
+</gpx>
+"""
+
+
+class TestGpx(unittest.TestCase):
+
+    def setUp(self):
+        self.f = tempfile.NamedTemporaryFile(suffix=".gpx")
+        self.f.write(GPX.encode("utf8"))
+        self.f.flush()
+
+    def tearDown(self):
+        self.f.close()
+
+    def test_read_gpx(self):
+        """All track segments and routes should be read"""
+
+        path = read_gpx(self.f.name)
+        self.assertEqual(path.shape, (6, 2))
+        self.assertTrue(path.flags["C_CONTIGUOUS"])
+        self.assertEqual(path.tolist(), [[2, 1], [2.5, 1.5], [4, 3], [8, 7], [10, 9], [12, 11]])
+
+    def test_read_gpx_split(self):
+        """Points should be split per segment, also segments of a single
+        point (path_surroundings maps the area around them)"""
+
+        parts = read_gpx(self.f.name, split=True)
+        self.assertEqual([p.tolist() for p in parts], [
+            [[2, 1], [2.5, 1.5]],
+            [[4, 3]],
+            [[8, 7]],
+            [[10, 9], [12, 11]],
+        ])
+
+    def test_read_gpx_prefer_tracks(self):
+        """Routes should be left out only if there are tracks"""
+
+        self.assertEqual(read_gpx(self.f.name, prefer_tracks=True).tolist(), [[2, 1], [2.5, 1.5], [4, 3], [8, 7]])
+        self.assertEqual(len(read_gpx(self.f.name, split=True, prefer_tracks=True)), 3)
+
+        with tempfile.NamedTemporaryFile(suffix=".gpx") as f:
+            f.write(b'<gpx><rte><rtept lat="1" lon="2"/></rte><trk><trkseg/></trk></gpx>')
+            f.flush()
+            self.assertEqual(read_gpx(f.name, prefer_tracks=True).tolist(), [[2, 1]])
+
+
+    def test_read_gpx_split_empty(self):
+        """Empty segments should be left out wherever they are"""
+
+        with tempfile.NamedTemporaryFile(suffix=".gpx") as f:
+            f.write(b'<gpx><trk><trkseg/><trkseg><trkpt lat="1" lon="2"/></trkseg><trkseg/></trk>'
+                    b'<rte/><trk><trkseg><trkpt lat="3" lon="4"/></trkseg></trk></gpx>')
+            f.flush()
+            self.assertEqual([p.tolist() for p in read_gpx(f.name, split=True)], [[[2, 1]], [[4, 3]]])
+
+            f.seek(0)
+            f.truncate()
+            f.write(b'<gpx><trk><trkseg/></trk></gpx>')
+            f.flush()
+            self.assertEqual(read_gpx(f.name, split=True), [])
+
+
+    def test_read_gpx_waypoints(self):
+        """Waypoints should be read"""
+
+        self.assertEqual(read_gpx_waypoints(self.f.name).tolist(), [[6, 5], [14, 13]])
+
+    def test_released(self):
+        """Parsed elements should be released, also those which are not read"""
+
+        with tempfile.NamedTemporaryFile(suffix=".gpx") as f:
+            f.write(b'<?xml version="1.0"?><!-- c --><gpx><metadata><name>n</name></metadata>'
+                    b'<wpt lat="0" lon="0"/><trk><trkseg><trkpt lat="1" lon="2"><extensions><a/></extensions>'
+                    b'</trkpt></trkseg></trk></gpx>')
+            f.flush()
+            points = _iter_points(f.name, ["trkpt"], [])
+            self.assertEqual(next(points), (2, 1))
+            #only the point, its ancestors and their last (emptied) children
+            #are left
+            root = points.gi_frame.f_locals["e"].getroottree().getroot()
+            self.assertEqual([e.tag for e in root.iter()], ["gpx", "wpt", "trk", "trkseg", "trkpt", "extensions"])
+            self.assertEqual(len(root[1][0][0][0]), 0)
+            self.assertEqual(list(points), [])
+
+
+    def test_no_namespace(self):
+        """Files without namespace should be read too"""
+
+        with tempfile.NamedTemporaryFile(suffix=".gpx") as f:
+            f.write(b'<gpx><trk><trkseg><trkpt lat="1" lon="2"/></trkseg></trk></gpx>')
+            f.flush()
+            self.assertEqual(read_gpx(f.name).tolist(), [[2, 1]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+from .. jsworker import JSWorker, JSError
+
+
+class TestJSWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.js = JSWorker()
+
+    def tearDown(self):
+        self.js.close()
+
+    def test_evaluate_known_values(self):
+        """evaluate should give known values of variables for known scripts"""
+
+        known = [
+            ("var a = 1 + 2;", ["a"], ["3"]),
+            ("var a = 'x'; b = [1, 2];", ["a", "b", "c"], ["x", "1,2", None]),
+            ("""
+                n = 1;
+                for (i = 0; i < 10; i++) {
+                    n += 1;
+                }
+            """, ["n"], ["11"]),
+        ]
+
+        for script, names, values in known:
+            self.assertEqual(self.js.evaluate(script, names), values)
+
+    def test_persistent(self):
+        """Scripts should be run by one process, each in its own context"""
+
+        self.js.evaluate("var a = 1;", ["a"])
+        pid = self.js._process.pid
+        self.assertEqual(self.js.evaluate("", ["a"]), [None])
+        self.assertEqual(self.js._process.pid, pid)
+
+    def test_error(self):
+        """JSError should be raised by failing scripts, worker should survive"""
+
+        with self.assertRaises(JSError):
+            self.js.evaluate("throw new Error('x')", [])
+        with self.assertRaises(JSError):
+            self.js.evaluate("require('fs')", [])
+        self.assertEqual(self.js.evaluate("var a = 2;", ["a"]), ["2"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from PIL import Image
+from .. lru import ImageLRU
+
+
+class TestImageLRU(unittest.TestCase):
+
+    def test_hits_misses(self):
+        """get() should count hits and misses"""
+
+        lru = ImageLRU(10000)
+        im = Image.new("RGB", (10, 10))
+        self.assertIsNone(lru.get("a"))
+        lru.put("a", im)
+        self.assertIs(lru.get("a"), im)
+        self.assertEqual(lru.stats(), {"hits": 1, "misses": 1, "images": 1, "bytes": 300})
+
+    def test_eviction(self):
+        """Least recently used images should be evicted to keep the limit"""
+
+        lru = ImageLRU(1000)
+        for key in "abc":
+            lru.put(key, Image.new("RGB", (10, 10)))
+        lru.get("a")
+        lru.put("d", Image.new("RGB", (10, 10)))
+
+        self.assertEqual(len(lru), 3)
+        self.assertLessEqual(lru.size, 1000)
+        self.assertIsNone(lru.get("b"))
+        self.assertIsNotNone(lru.get("a"))
+
+    def test_too_big(self):
+        """Images bigger than the whole cache should not be cached"""
+
+        lru = ImageLRU(100)
+        lru.put("a", Image.new("RGB", (10, 10)))
+        self.assertEqual(len(lru), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
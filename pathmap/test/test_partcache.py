@@ -0,0 +1,49 @@
+import unittest
+import tempfile
+import os
+from PIL import Image
+from .. partcache import PartCache, part_key
+from . test_getmap import FakeMapDownloader
+
+
+class TestPartCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_put_get(self):
+        """Stored parts should be returned, expired ones pruned"""
+
+        cache = PartCache(self.tdir.name, ttl=100)
+        im = Image.new("RGB", (30, 20), (1, 2, 3))
+        cache.put("abcd", im)
+        self.assertTrue(cache.contains("abcd"))
+        self.assertFalse(cache.contains("abce"))
+        self.assertEqual(cache.get("abcd").tobytes(), im.tobytes())
+        self.assertIsNone(cache.get("abce"))
+
+        filename = os.path.join(self.tdir.name, "ab", "abcd.png")
+        os.utime(filename, (0, 0))
+        self.assertIsNone(cache.get("abcd"))
+        PartCache(self.tdir.name, ttl=100)
+        self.assertFalse(os.path.exists(filename))
+
+    def test_part_key(self):
+        """Keys should differ whenever the part would look different"""
+
+        md = FakeMapDownloader()
+        args = ([(1.0, 2.0), (1.5, 2.5)], [0.5, 2.0], [1.5, 3.0], 0.5, 100, 80, (255, 0, 0), True)
+        key = part_key(md, *args)
+        self.assertEqual(part_key(md, *args), key)
+        self.assertNotEqual(part_key(md, [(1.0, 2.0), (1.5, 2.25)], *args[1:]), key)
+        self.assertNotEqual(part_key(md, *args[:6], (0, 0, 255), True), key)
+        self.assertNotEqual(part_key(md, *args[:7], False), key)
+        md.zoom = 2
+        self.assertNotEqual(part_key(md, *args), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
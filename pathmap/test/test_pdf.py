@@ -0,0 +1,102 @@
+import unittest
+import tempfile
+import re
+import zlib
+from io import BytesIO
+from PIL import Image
+from .. pdf import PdfWriter, pdf_image, encode_image, A4, cm
+
+
+class TestPdf(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.fname = "{}/out.pdf".format(self.tdir.name)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_pdf_image_png_as_is(self):
+        """PNG without alpha should be embedded without re-encoding"""
+
+        for mode in ("RGB", "P", "L"):
+            out = BytesIO()
+            Image.new(mode, (30, 20)).save(out, "PNG")
+            image = pdf_image(out.getvalue())
+            self.assertEqual((image.width, image.height), (30, 20))
+            self.assertIn(image.stream, out.getvalue())
+
+    def test_pdf_image_jpeg_as_is(self):
+        """JPEG should be embedded without re-encoding"""
+
+        out = BytesIO()
+        Image.new("RGB", (30, 20), "red").save(out, "JPEG")
+        image = pdf_image(out.getvalue())
+        self.assertEqual(image.stream, out.getvalue())
+        self.assertEqual(image.entries["Filter"], "/DCTDecode")
+
+    def test_pdf_image_alpha(self):
+        """Alpha should be flattened onto white"""
+
+        im = Image.new("RGBA", (2, 1), (0, 0, 0, 0))
+        im.putpixel((1, 0), (10, 20, 30, 255))
+        image = pdf_image(im)
+        self.assertEqual(image.entries["ColorSpace"], "/DeviceRGB")
+        #each row starts with the filter type byte
+        self.assertEqual(zlib.decompress(image.stream)[1:], bytes([255, 255, 255, 10, 20, 30]))
+
+    def test_encode_image(self):
+        """Encodings should keep the image (exactly for palette of few colors)
+        and be embeddable as they are"""
+
+        im = Image.new("RGBA", (40, 30), (200, 100, 0, 255))
+        im.paste((10, 20, 30, 255), (0, 0, 20, 30))
+
+        rgb = encode_image(im, "png", compress_level=1)
+        palette = encode_image(im, "png-palette", compress_level=9)
+        self.assertEqual(Image.open(BytesIO(rgb)).mode, "RGB")
+        self.assertEqual(Image.open(BytesIO(palette)).mode, "P")
+        self.assertEqual(Image.open(BytesIO(palette)).convert("RGB").tobytes(), im.convert("RGB").tobytes())
+        self.assertLess(len(palette), len(rgb))
+
+        jpeg = encode_image(im, "jpeg", quality=50)
+        self.assertEqual(Image.open(BytesIO(jpeg)).format, "JPEG")
+
+        for data in (rgb, palette, jpeg):
+            self.assertIn(pdf_image(data).stream, data)
+
+        with self.assertRaises(ValueError):
+            encode_image(im, "gif")
+
+    def test_writer(self):
+        """Images should be placed one below another, on new page when they
+        do not fit, and the cross-reference table should be right"""
+
+        heights = [700, 700, 500, 200]
+        with PdfWriter(self.fname) as pdf:
+            for h in heights:
+                pdf.add_image(Image.new("RGBA", (1000, h), "white"))
+
+        with open(self.fname, "rb") as f:
+            data = f.read()
+
+        self.assertTrue(data.startswith(b"%PDF-1.4"))
+        self.assertEqual(len(re.findall(rb"/Type /Page ", data)), 2)
+        self.assertIn(b"/Count 2", data)
+
+        xref = int(re.search(rb"startxref\n(\d+)", data).group(1))
+        entries = re.findall(rb"(\d{10}) 00000 n", data[xref:])
+        for oid, offset in enumerate(entries, 1):
+            self.assertTrue(data[int(offset):].startswith("{} 0 obj".format(oid).encode("ascii")))
+
+        #placement on the first page: 350 points high images, scale 0.5
+        contents = [zlib.decompress(m) for m in re.findall(
+            rb"/Filter /FlateDecode >>\nstream\n(.*?)\nendstream", data, re.S)]
+        first = contents[0].decode("ascii")
+        top = A4[1] - cm(1.5)
+        self.assertIn("500.000 0 0 350.000 {:.3f} {:.3f} cm".format(cm(0.5) + 15, top - 350), first)
+        self.assertIn("500.000 0 0 350.000 {:.3f} {:.3f} cm".format(cm(0.5) + 15, top - 701), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,63 @@
+import unittest
+import tempfile
+import json
+from .. import profile
+from .. profile import Profiler
+from .. getmap import path_surroundings, create_path_pdf
+from . test_getmap import FakeMapDownloader
+
+
+class TestProfile(unittest.TestCase):
+
+    def tearDown(self):
+        profile.disable()
+
+    def test_profiler(self):
+        """Stages and counters should be summed and passed to listeners"""
+
+        profiler = Profiler()
+        events = []
+        profiler.add_listener(lambda *event: events.append(event))
+
+        for _ in range(3):
+            with profiler.stage("a"):
+                pass
+        profiler.count("b")
+        profiler.count("b", 10)
+
+        report = profiler.report()
+        self.assertEqual(report["stages"]["a"]["calls"], 3)
+        self.assertLessEqual(report["stages"]["a"]["max"], report["stages"]["a"]["seconds"])
+        self.assertEqual(report["counters"], {"b": 11})
+        self.assertEqual([event[:2] for event in events], [("stage", "a")] * 3 + [("count", "b")] * 2)
+
+    def test_disabled(self):
+        """Nothing should be recorded unless profiling is enabled"""
+
+        self.assertIsNone(profile.current())
+        with profile.stage("a"):
+            profile.count("b")
+
+    def test_pipeline(self):
+        """Stages of the pipeline and downloads should be recorded"""
+
+        profiler = profile.enable()
+        md = FakeMapDownloader()
+        path = [(10 + i / 4, 20 + i / 8) for i in range(40)]
+        parts = path_surroundings(md, path, radius_pix=4, maxwidth_pix=40, maxheight_pix=30, maxdist_pix=20)
+        with tempfile.TemporaryDirectory() as tdir:
+            create_path_pdf(parts, "{}/out.pdf".format(tdir))
+            profiler.write_report("{}/report.json".format(tdir), tiles=len(md.downloaded))
+            with open("{}/report.json".format(tdir)) as f:
+                report = json.load(f)
+
+        for name in ("render_bite", "mask", "get_tiles", "paste", "rotate", "decode", "download",
+                     "encode", "write_pdf"):
+            self.assertIn(name, report["stages"])
+        self.assertEqual(report["counters"]["downloads"], report["tiles"])
+        self.assertGreater(report["counters"]["bytes_downloaded"], 0)
+        self.assertGreater(report["counters"]["decoded_cache_hits"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
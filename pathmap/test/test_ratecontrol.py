@@ -0,0 +1,104 @@
+import unittest
+import time
+import pickle
+from .. ratecontrol import AdaptiveLimiter, retry_after, check_tile_response
+from .. ratecontrol import ThrottledError, TileNotFoundError, BadResponseError
+from .. synthetic import SyntheticMapDownloader
+from .. tilestore import MemoryTileStore
+from .. tileserver import TileServer
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def test_increase_decrease(self):
+        """Limit should grow by successes and halve on errors and
+        throttling"""
+
+        limiter = AdaptiveLimiter(initial=4, maximum=8)
+        for _ in range(4):
+            self.assertEqual(limiter.try_acquire(), 0)
+        self.assertGreater(limiter.try_acquire(), 0)
+
+        for _ in range(4):
+            limiter.release(0.01)
+        self.assertEqual(limiter.state()["limit"], 4)
+        for _ in range(40):
+            limiter.acquire()
+            limiter.release(0.01)
+        self.assertEqual(limiter.state()["limit"], 8)
+
+        limiter.acquire()
+        limiter.release(0.01, "error")
+        self.assertEqual(limiter.state()["limit"], 4)
+
+        limiter._last_decrease = 0
+        limiter.acquire()
+        limiter.release(0.01, "throttled", retry_after=0.2)
+        state = limiter.state()
+        self.assertEqual(state["limit"], 2)
+        self.assertGreater(state["paused"], 0.1)
+        self.assertGreater(limiter.try_acquire(), 0.1)
+        self.assertEqual((state["errors"], state["throttled"]), (1, 1))
+
+    def test_latency(self):
+        """Growing latency should lower the limit"""
+
+        limiter = AdaptiveLimiter(initial=8)
+        limiter.acquire()
+        limiter.release(0.01)
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release(0.1)
+        self.assertLess(limiter.state()["limit"], 8)
+
+    def test_max_rate(self):
+        """Requests per second should be limited"""
+
+        limiter = AdaptiveLimiter(initial=100, max_rate=50)
+        start = time.monotonic()
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(0.001)
+        self.assertGreater(time.monotonic() - start, 0.3)
+
+    def test_pickle(self):
+        limiter = pickle.loads(pickle.dumps(AdaptiveLimiter(initial=3, max_rate=5)))
+        self.assertEqual((limiter.state()["limit"], limiter.max_rate), (3, 5))
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after("2"), 2)
+        self.assertIsNone(retry_after(None))
+        self.assertIsNone(retry_after("Wed, 21 Oct 2015 07:28:00 GMT"))
+
+    def test_check_tile_response(self):
+        """Errors and responses which are not images should be told apart"""
+
+        check_tile_response("t", 200, {"Content-Type": "image/png"})
+        check_tile_response("t", 200, {})
+        with self.assertRaises(ThrottledError) as cm:
+            check_tile_response("t", 429, {"Retry-After": "3"})
+        self.assertEqual(cm.exception.retry_after, 3)
+        with self.assertRaises(TileNotFoundError):
+            check_tile_response("t", 404, {})
+        with self.assertRaises(BadResponseError):
+            check_tile_response("t", 500, {})
+        with self.assertRaises(BadResponseError):
+            check_tile_response("t", 200, {"Content-Type": "text/html; charset=utf-8"})
+
+    def test_throttling_server(self):
+        """Tiles should be downloaded despite throttling, which should slow
+        the downloads down"""
+
+        with TileServer(error_rate=0.2, error_status=429, seed=1) as server:
+            md = SyntheticMapDownloader(url=server.url, tile_store=MemoryTileStore(),
+                                        limiter=AdaptiveLimiter(initial=8, max_pause=0.2))
+            md.fetch_tiles([(x, y) for x in range(8) for y in range(4)])
+            state = md.download_state()
+            self.assertEqual(state["successes"], 32)
+            self.assertEqual(state["throttled"], server.errors)
+            self.assertGreater(server.errors, 0)
+            md.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+import unittest
+import json
+import time
+import tempfile
+from threading import Thread, Event
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from .. service import FairQueue, MapService
+from .. tilestore import SqliteTileStore
+from . test_getmap import FakeMapDownloader
+
+
+GPX = b"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>
+<trkpt lat="20.5" lon="10.5"></trkpt>
+<trkpt lat="21.5" lon="11.5"></trkpt>
+<trkpt lat="21.5" lon="12.5"></trkpt>
+</trkseg></trk></gpx>
+"""
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def test_turns(self):
+        """Clients should get their items in turns"""
+
+        queue = FairQueue()
+        for item in ("a1", "a2", "a3"):
+            queue.put("a", item)
+        queue.put("b", "b1")
+        self.assertEqual(queue.get(), "a1")
+        queue.put("c", "c1")
+        self.assertEqual(len(queue), 4)
+        self.assertEqual([queue.get() for _ in range(4)], ["b1", "a2", "c1", "a3"])
+
+        queue.close()
+        self.assertIsNone(queue.get())
+
+
+class TestMapService(unittest.TestCase):
+
+    def setUp(self):
+        self.md = FakeMapDownloader()
+        self.service = MapService(self.md, workers=2, radius_pix=4, maxwidth_pix=100, maxheight_pix=100)
+        self.server = self.service.serve(port=0)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.service.close()
+
+    def post(self, query="", data=GPX):
+        return urlopen(Request(self.url + "/jobs" + query, data=data, method="POST"))
+
+    def test_wait(self):
+        """With wait=1 the pdf should be returned right away"""
+
+        with self.post("?wait=1&radius=5&color=blue") as r:
+            self.assertEqual(r.headers["Content-Type"], "application/pdf")
+            self.assertTrue(r.read().startswith(b"%PDF"))
+
+    def test_poll(self):
+        """Job should be polled until it is done, then its pdf downloaded;
+        tiles should be downloaded once for both jobs"""
+
+        ids = []
+        for _ in range(2):
+            with self.post() as r:
+                self.assertEqual(r.status, 202)
+                info = json.load(r)
+                self.assertEqual(r.headers["Location"], "/jobs/" + info["id"])
+                ids.append(info["id"])
+
+        for job_id in ids:
+            for _ in range(100):
+                with urlopen(self.url + "/jobs/" + job_id) as r:
+                    if json.load(r)["status"] == "done":
+                        break
+                time.sleep(0.05)
+            with urlopen(self.url + "/jobs/{}/pdf".format(job_id)) as r:
+                self.assertTrue(r.read().startswith(b"%PDF"))
+
+        self.assertEqual(len(self.md.downloaded), len(set(self.md.downloaded)))
+
+    def test_errors(self):
+        """Wrong requests and gpx files should be reported"""
+
+        with self.assertRaises(HTTPError) as cm:
+            self.post("?radius=abc")
+        self.assertEqual(cm.exception.code, 400)
+
+        with self.assertRaises(HTTPError) as cm:
+            self.post("?wait=1", data=b"<gpx>")
+        self.assertEqual(cm.exception.code, 422)
+        self.assertEqual(json.load(cm.exception)["status"], "failed")
+
+        with self.assertRaises(HTTPError) as cm:
+            urlopen(self.url + "/jobs/nonexistent")
+        self.assertEqual(cm.exception.code, 404)
+
+
+
+class TestMapServiceJobs(unittest.TestCase):
+
+    def test_render_pool(self):
+        """Jobs should be rendered by the same processes"""
+
+        with tempfile.TemporaryDirectory() as tdir:
+            md = FakeMapDownloader(SqliteTileStore("{}/tiles.mbtiles".format(tdir)))
+            service = MapService(md, workers=1, jobs=2, radius_pix=4, maxwidth_pix=40, maxheight_pix=30)
+            try:
+                pids = []
+                for _ in range(2):
+                    job = service.submit("a", GPX)
+                    job.done.wait()
+                    self.assertEqual(job.status, "done", job.error)
+                    pids.append(set(service._render_pool._processes))
+                #the processes of the first job are still there
+                self.assertGreater(len(pids[0]), 0)
+                self.assertLessEqual(pids[0], pids[1])
+            finally:
+                service.close()
+                md.close()
+
+    def test_retry_budget(self):
+        """Retry budget should be renewed only when no other job is running"""
+
+        md = FakeMapDownloader()
+        resets = []
+        reset_retry_budget = md.reset_retry_budget
+        def counting_reset():
+            resets.append(time.time())
+            reset_retry_budget()
+        md.reset_retry_budget = counting_reset
+
+        started = Event()
+        release = Event()
+        download_tile = md._download_tile
+        def blocking_download(x, y):
+            started.set()
+            release.wait(5)
+            return download_tile(x, y)
+        md._download_tile = blocking_download
+
+        service = MapService(md, workers=2, radius_pix=4, maxwidth_pix=100, maxheight_pix=100)
+        try:
+            first = service.submit("a", GPX)
+            self.assertTrue(started.wait(5))
+            second = service.submit("b", GPX)
+            for _ in range(100):
+                if service._running == 2:
+                    break
+                time.sleep(0.01)
+            release.set()
+            for job in (first, second):
+                job.done.wait()
+                self.assertEqual(job.status, "done", job.error)
+            self.assertEqual(len(resets), 1)
+
+            third = service.submit("a", GPX)
+            third.done.wait()
+            self.assertEqual(len(resets), 2)
+        finally:
+            service.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import unittest
+import tempfile
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from .. synthetic import synthetic_tile, synthetic_route, write_gpx, SyntheticMapDownloader
+from .. gpx import read_gpx
+from .. tilestore import MemoryTileStore, SqliteTileStore
+from .. getmap import path_surroundings
+from .. tileserver import TileServer
+from .. ratecontrol import AdaptiveLimiter, TileDownloadError
+
+
+class TestSynthetic(unittest.TestCase):
+
+    def test_synthetic_tile(self):
+        """Tiles should be deterministic, different and have few colors"""
+
+        self.assertEqual(synthetic_tile(4492, 2804), synthetic_tile(4492, 2804))
+        self.assertNotEqual(synthetic_tile(4492, 2804), synthetic_tile(4493, 2804))
+
+        im = Image.open(BytesIO(synthetic_tile(4492, 2804)))
+        self.assertEqual(im.size, (256, 256))
+        self.assertLessEqual(len(im.getcolors(256)), 10)
+
+    def test_synthetic_route(self):
+        """Routes should have about the requested length"""
+
+        md = SyntheticMapDownloader(tile_store=MemoryTileStore())
+        for shape in ("line", "loop", "zigzag", "wander"):
+            route = synthetic_route(shape, 10)
+            xs, ys = md.lon_lat_to_tiles_many(route[:, 0], route[:, 1])
+
+            #one tile at zoom 13 is 40075 km / 2**13 * cos(latitude) long
+            tile_km = 40075 / 2**13 * np.cos(np.radians(route[0, 1]))
+            length = np.hypot(np.diff(xs), np.diff(ys)).sum() * tile_km
+            self.assertAlmostEqual(length, 10, delta=0.2, msg=shape)
+
+        loop = synthetic_route("loop", 10)
+        self.assertLess(np.abs(loop[0] - loop[-1]).max(), 1e-3)
+
+        with self.assertRaises(ValueError):
+            synthetic_route("square", 10)
+
+    def test_write_gpx(self):
+        """Written route should be read back"""
+
+        route = synthetic_route("wander", 1)
+        with tempfile.TemporaryDirectory() as tdir:
+            write_gpx(route, "{}/route.gpx".format(tdir))
+            np.testing.assert_allclose(read_gpx("{}/route.gpx".format(tdir)), route, atol=1e-7)
+
+    def test_projection(self):
+        """Both projections should agree and match Web Mercator"""
+
+        md = SyntheticMapDownloader(tile_store=MemoryTileStore())
+        x, y = md.lon_lat_to_tiles(13.4, 48.6)
+        xs, ys = md.lon_lat_to_tiles_many([13.4], [48.6])
+        self.assertAlmostEqual(x, xs[0])
+        self.assertAlmostEqual(y, ys[0])
+        self.assertEqual((int(x), int(y)), (4400, 2827))
+
+    def test_tile_server(self):
+        """Tiles should be downloaded from the server, despite its errors"""
+
+        with TileServer(latency=0.01, failures=1, error_status=500) as server:
+            md = SyntheticMapDownloader(url=server.url, tile_store=MemoryTileStore())
+            self.assertEqual(md.get_tile(5, 6).tobytes(), Image.open(BytesIO(synthetic_tile(5, 6))).tobytes())
+            md.fetch_tiles([(x, 7) for x in range(10)])
+            self.assertEqual(server.requests[(5, 6)], 2)
+            self.assertEqual(server.total_requests, 22)
+            self.assertEqual(server.errors, 11)
+            md.close()
+
+    def test_throttling_not_budgeted(self):
+        """Throttled requests should not use up the retry budget"""
+
+        with TileServer(error_rate=0.3, error_status=429) as server:
+            md = SyntheticMapDownloader(url=server.url, tile_store=MemoryTileStore(), retry_budget=2,
+                                        limiter=AdaptiveLimiter(10, max_pause=0.01))
+            md.fetch_tiles([(x, 7) for x in range(40)])
+            self.assertGreater(server.errors, 2)
+            self.assertEqual(len(md.tile_store.tiles), 40)
+            md.close()
+
+    def test_throttling_limited(self):
+        """A server which keeps throttling should not be retried forever"""
+
+        with TileServer(error_rate=1, error_status=503) as server:
+            md = SyntheticMapDownloader(url=server.url, tile_store=MemoryTileStore(), retries=3, retry_budget=5,
+                                        throttled_retries=4, limiter=AdaptiveLimiter(10, max_pause=0.01))
+            with self.assertRaises(TileDownloadError):
+                md.fetch_tiles([(5, 6)])
+            self.assertEqual(server.requests[(5, 6)], 5)
+
+            md.blank_failed = True
+            self.assertEqual(md.get_tile(5, 7).getpixel((0, 0)), md.blank_color)
+            self.assertEqual(server.requests[(5, 7)], 5)
+            md.close()
+
+    def test_blank_failed_jobs(self):
+        """Failed tiles should be rendered blank by worker processes too"""
+
+        with TileServer(error_rate=1, error_status=500) as server, tempfile.TemporaryDirectory() as tdir:
+            md = SyntheticMapDownloader(url=server.url, tile_store=SqliteTileStore("{}/tiles.mbtiles".format(tdir)),
+                                        retries=0, blank_failed=True)
+            path = [(13.4 + i / 200, 48.6) for i in range(20)]
+            options = dict(radius_pix=20, maxwidth_pix=200, maxheight_pix=150, path_color=None)
+            for jobs in (1, 2):
+                parts = list(path_surroundings(md, path, jobs=jobs, **options))
+                self.assertGreater(len(parts), 1)
+                for im in parts:
+                    self.assertEqual([color[:3] for _, color in im.getcolors()], [md.blank_color])
+            md.close()
+
+    def test_tile_server_missing(self):
+        """Tiles missing on the server should be requested once and blank"""
+
+        with TileServer(missing=[(5, 6)]) as server:
+            md = SyntheticMapDownloader(url=server.url, tile_store=MemoryTileStore())
+            md.fetch_tiles([(5, 6), (5, 7)])
+            self.assertEqual(md.get_tile(5, 6).getpixel((0, 0)), md.blank_color)
+            self.assertEqual(server.requests, {(5, 6): 1, (5, 7): 1})
+            md.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import unittest
+import tempfile
+import time
+import pickle
+import os
+from .. tilestore import SqliteTileStore, DirectoryTileStore, write_atomic
+
+
+class TestSqliteTileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.path = "{}/tiles.mbtiles".format(self.tdir.name)
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_put_get_many(self):
+        """Stored tiles should be returned, missing ones left out"""
+
+        store = SqliteTileStore(self.path)
+        store.put(("p", 13, 1, 2), b"a")
+        store.put(("p", 13, 2, 2), b"bb")
+        store.put(("q", 13, 1, 2), b"ccc")
+
+        keys = [("p", 13, 1, 2), ("p", 13, 2, 2), ("p", 13, 3, 2), ("q", 13, 1, 2)]
+        self.assertEqual(store.get_many(keys), {
+            ("p", 13, 1, 2): b"a",
+            ("p", 13, 2, 2): b"bb",
+            ("q", 13, 1, 2): b"ccc",
+        })
+        self.assertEqual(store.get(("p", 13, 3, 2)), None)
+
+        self.assertEqual(store.average_size("p", 13), 1.5)
+        self.assertEqual(store.average_size("p", 14), None)
+        store.close()
+
+    def test_persistent(self):
+        """Tiles should survive reopening of the store"""
+
+        store = SqliteTileStore(self.path)
+        store.put(("p", 13, 1, 2), b"a")
+        store.close()
+
+        store = SqliteTileStore(self.path)
+        self.assertEqual(store.get(("p", 13, 1, 2)), b"a")
+        store.close()
+
+    def test_pickle(self):
+        """Unpickled store should open the same file"""
+
+        store = SqliteTileStore(self.path, ttl=100)
+        store.put(("p", 13, 1, 2), b"a")
+        copy = pickle.loads(pickle.dumps(store))
+        self.assertEqual(copy.get(("p", 13, 1, 2)), b"a")
+        self.assertEqual(copy.ttl, 100)
+        copy.close()
+        store.close()
+
+    def test_missing(self):
+        """Marks of missing tiles should be kept until they expire"""
+
+        store = SqliteTileStore(self.path)
+        store.put_missing(("p", 13, 1, 2), time.time() + 100)
+        store.put_missing(("p", 13, 1, 3), time.time() - 1)
+        copy = SqliteTileStore(self.path)
+        self.assertEqual(list(copy.get_missing_many([("p", 13, 1, 2), ("p", 13, 1, 3), ("p", 13, 1, 4)])),
+                         [("p", 13, 1, 2)])
+        copy.close()
+        store.close()
+
+    def test_ttl(self):
+        """Expired tiles should not be returned"""
+
+        store = SqliteTileStore(self.path, ttl=0.05)
+        store.put(("p", 13, 1, 2), b"a")
+        self.assertEqual(store.get(("p", 13, 1, 2)), b"a")
+        time.sleep(0.1)
+        self.assertEqual(store.get(("p", 13, 1, 2)), None)
+        store.close()
+
+    def test_eviction(self):
+        """Least recently read tiles should be evicted to keep the size limit"""
+
+        store = SqliteTileStore(self.path, max_bytes=1000)
+        for x in range(3):
+            store.put(("p", 13, x, 0), bytes(300))
+            store._conn.execute("UPDATE tiles SET accessed = ? WHERE tile_column = ?", (x, x))
+        #tile 0 has been read most recently
+        store._conn.execute("UPDATE tiles SET accessed = 10 WHERE tile_column = 0")
+        store.put(("p", 13, 3, 0), bytes(300))
+
+        stored = store.get_many([("p", 13, x, 0) for x in range(4)])
+        self.assertLessEqual(sum(len(d) for d in stored.values()), 1000)
+        self.assertIn(("p", 13, 0, 0), stored)
+        self.assertIn(("p", 13, 3, 0), stored)
+        self.assertNotIn(("p", 13, 1, 0), stored)
+        store.close()
+
+
+class TestDirectoryTileStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tdir.cleanup()
+
+    def test_put_get_many(self):
+        """Tiles should be stored as files, expired ones left out"""
+
+        store = DirectoryTileStore(self.tdir.name, ttl=100)
+        store.put(("p", 13, 1, 2), b"a")
+        store.put(("p", 13, 1, 3), b"bcd")
+        self.assertEqual(store.get_many([("p", 13, 1, 2), ("p", 13, 2, 2)]), {("p", 13, 1, 2): b"a"})
+        self.assertTrue(os.path.exists(os.path.join(self.tdir.name, "p", "13", "1", "2")))
+        self.assertEqual(store.average_size("p", 13), 2)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tdir.name, "p", "13", "1"))), ["2", "3"])
+
+        os.utime(os.path.join(self.tdir.name, "p", "13", "1", "2"), (0, 0))
+        self.assertEqual(store.get(("p", 13, 1, 2)), None)
+
+        store.put_missing(("p", 13, 1, 4), time.time() + 100)
+        self.assertEqual(list(store.get_missing_many([("p", 13, 1, 3), ("p", 13, 1, 4)])), [("p", 13, 1, 4)])
+        #the mark is not a tile
+        self.assertEqual(store.average_size("p", 13), 2)
+
+        copy = pickle.loads(pickle.dumps(store))
+        with copy.lock(("p", 13, 1, 3)):
+            self.assertEqual(copy.get(("p", 13, 1, 3)), b"bcd")
+        copy.close()
+        store.close()
+
+    def test_write_atomic(self):
+        """write_atomic should replace the file and leave no temporary ones"""
+
+        filename = os.path.join(self.tdir.name, "tile.png")
+        write_atomic(filename, b"old")
+        write_atomic(filename, b"new")
+        with open(filename, "rb") as f:
+            self.assertEqual(f.read(), b"new")
+        self.assertEqual(os.listdir(self.tdir.name), ["tile.png"])
+
+
+if __name__ == '__main__':
+    unittest.main()
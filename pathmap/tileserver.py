@@ -0,0 +1,134 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import random
+import time
+from threading import Thread, Lock
+
+from . synthetic import synthetic_tile
+
+
+class _TileHandler(BaseHTTPRequestHandler):
+
+    #keep-alive, as webtiles.timepress.cz
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server.tile_server
+        try:
+            #the last two parts of the path are x, y (the rest, such as
+            #provider and zoom, is ignored)
+            x, y = [int(c) for c in self.path.strip("/").split("/")[-2:]]
+        except ValueError:
+            self._respond(404)
+            return
+
+        status = server._request(x, y)
+        if status != 200:
+            self._respond(status)
+            return
+        self._respond(200, server.tile(x, y))
+
+
+    def _respond(self, status, data=b""):
+        self.send_response(status)
+        if status == 200:
+            self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+    def log_message(self, *args):
+        pass
+
+
+class TileServer:
+    """Local HTTP server of map tiles standing in for a real map server in
+    tests and benchmarks
+
+    Serves tile(x, y) at /x/y (or at any path ending with /x/y, such as
+    /provider/zoom/x/y), in a thread. Can delay the responses and answer
+    some requests by an error.
+
+    Usable as a context manager, which starts and stops the server.
+    """
+
+    def __init__(self, tile=synthetic_tile, latency=0, error_rate=0, failures=0,
+                 error_status=503, seed=0, missing=()):
+        """
+        Arguments:
+
+        tile: function returning bytes of tile x, y
+        latency: time in seconds each response gets delayed by
+        error_rate: probability of answering a request by error_status
+        failures: number of first requests of every tile answered by
+            error_status
+        error_status: HTTP status of the errors
+        seed: seed of the random errors
+        missing: tiles (x, y) answered by 404, as beyond the edge of a map
+        """
+
+        self.tile = tile
+        self.latency = latency
+        self.error_rate = error_rate
+        self.failures = failures
+        self.error_status = error_status
+        self.missing = set(missing)
+
+        #number of requests by tiles (x, y) and in total
+        self.requests = {}
+        self.total_requests = 0
+        self.errors = 0
+
+        self._random = random.Random(seed)
+        self._lock = Lock()
+        self._server = None
+
+
+    def _request(self, x, y):
+        """Count the request of tile x, y, wait and return the HTTP status to
+        answer"""
+
+        with self._lock:
+            n = self.requests[(x, y)] = self.requests.get((x, y), 0) + 1
+            self.total_requests += 1
+            if (x, y) in self.missing:
+                return 404
+            failed = n <= self.failures or self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        return self.error_status if failed else 200
+
+
+    @property
+    def url(self):
+        """Base url of the tiles"""
+
+        return "http://127.0.0.1:{}".format(self._server.server_address[1])
+
+
+    def start(self):
+        """Start serving (on a free port, see url)"""
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _TileHandler)
+        self._server.daemon_threads = True
+        self._server.tile_server = self
+        Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, *exc):
+        self.stop()
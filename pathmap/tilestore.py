@@ -0,0 +1,544 @@
+import os
+import sqlite3
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+
+try:
+    import fcntl
+except ImportError:
+    #not on Windows, file locks then work only between threads
+    fcntl = None
+
+
+def default_store_path():
+    """Return the default location of the tile store file
+
+    $XDG_CACHE_HOME/pathmap/tiles.mbtiles, or ~/.cache/pathmap/tiles.mbtiles
+    if XDG_CACHE_HOME is not set.
+    """
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "pathmap", "tiles.mbtiles")
+
+
+def write_atomic(filename, data):
+    """Write bytes data as filename so that readers (in other processes too)
+    see either the old file or the whole new one, never a part of it"""
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class FileLockStripes:
+    """Exclusive locks of tile keys shared by all processes using the same
+    directory
+
+    Keys are hashed onto a fixed number of lock files (stripes), so that
+    the directory does not grow with the number of tiles; unrelated keys
+    sharing a stripe only wait for each other. Threads of one process
+    exclude each other by a Lock per stripe, processes by flock of its file.
+    """
+
+    def __init__(self, directory, stripes=256):
+        self.directory = directory
+        self.stripes = stripes
+        self._init_state()
+
+
+    def _init_state(self):
+        self._locks = [Lock() for _ in range(self.stripes)]
+        #open lock files by stripes
+        self._files = {}
+        self._files_lock = Lock()
+
+
+    def __getstate__(self):
+        return {"directory": self.directory, "stripes": self.stripes}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_state()
+
+
+    def _stripe(self, key):
+        return zlib.crc32(repr(key).encode("utf8")) % self.stripes
+
+
+    def _file(self, stripe):
+        with self._files_lock:
+            fd = self._files.get(stripe)
+            if fd is None:
+                os.makedirs(self.directory, exist_ok=True)
+                fd = os.open(os.path.join(self.directory, "{}.lock".format(stripe)), os.O_RDWR | os.O_CREAT, 0o666)
+                self._files[stripe] = fd
+            return fd
+
+
+    @contextmanager
+    def lock(self, key):
+        """Context manager holding the lock of key"""
+
+        stripe = self._stripe(key)
+        with self._locks[stripe]:
+            if fcntl is None:
+                yield
+                return
+            fd = self._file(stripe)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+    def close(self):
+        with self._files_lock:
+            for fd in self._files.values():
+                os.close(fd)
+            self._files = {}
+
+
+class TileStore:
+    """Base class for storages of encoded (not decoded) map tiles
+
+    Tiles are identified by keys (provider, zoom, x, y) and stored as the
+    bytes which have been downloaded.
+    """
+
+    def get(self, key):
+        """Return bytes of the tile key, or None if it is not stored"""
+
+        return self.get_many([key]).get(key)
+
+
+    def get_many(self, keys):
+        """Should return a dict {key: bytes} of those keys which are stored"""
+
+        raise NotImplementedError("Please implement this method")
+
+
+    def contains_many(self, keys):
+        """Return a set of those keys which are stored"""
+
+        return set(self.get_many(keys))
+
+
+    def put(self, key, data):
+        """Should store bytes data as the tile key"""
+
+        raise NotImplementedError("Please implement this method")
+
+
+    def get_missing_many(self, keys):
+        """Return a dict {key: until} of those keys which have been marked
+        missing (see put_missing) until a time (as time.time()) which has not
+        passed yet
+
+        The store does not keep the marks by default.
+        """
+
+        return {}
+
+
+    def put_missing(self, key, until):
+        """Remember that the server does not have tile key, so that it is
+        not requested again until time until (as time.time())"""
+
+        pass
+
+
+    def average_size(self, provider, zoom):
+        """Return the average size in bytes of stored tiles of provider and
+        zoom, or None if there are none (or the store cannot tell)"""
+
+        return None
+
+
+    def lock(self, key):
+        """Return context manager excluding everybody else who downloads
+        the tile key into the store meanwhile
+
+        The store is private to the process by default, so the in-process
+        single-flight of MapDownloader is enough and nothing is locked.
+        Stores shared by several processes lock files.
+        """
+
+        return nullcontext()
+
+
+    def close(self):
+        pass
+
+
+class MemoryTileStore(TileStore):
+    """Keeps tiles in a dict, for the lifetime of the process only"""
+
+    def __init__(self):
+        self.tiles = {}
+        self.missing = {}
+
+
+    def get_many(self, keys):
+        return {key: self.tiles[key] for key in keys if key in self.tiles}
+
+
+    def put(self, key, data):
+        self.tiles[key] = data
+
+
+    def get_missing_many(self, keys):
+        now = time.time()
+        return {key: self.missing[key] for key in keys if self.missing.get(key, now) > now}
+
+
+    def put_missing(self, key, until):
+        self.missing[key] = until
+
+
+    def average_size(self, provider, zoom):
+        sizes = [len(data) for key, data in self.tiles.items() if key[:2] == (provider, zoom)]
+        return sum(sizes) / len(sizes) if sizes else None
+
+
+class SqliteTileStore(TileStore):
+    """Keeps tiles in a single SQLite file with MBTiles-like layout
+
+    Unlike in MBTiles, the table is keyed also by provider and rows are
+    numbered the same way as by the provider (no TMS flipping).
+
+    Every tile remembers when it has been stored (used for expiring it after
+    ttl seconds) and when it has been read last (used for evicting the least
+    recently used tiles once the tiles take more than max_bytes).
+    """
+
+    #maximum number of tiles looked up by a single query (two SQL variables
+    #per tile)
+    chunk = 250
+
+    def __init__(self, path=None, ttl=30*24*3600, max_bytes=1024*2**20, lock_stripes=256):
+        """Open (or create) the store
+
+        Arguments:
+
+        path: name of the file, default_store_path() if None
+        ttl: tiles older than ttl seconds are treated as not stored; None
+            means they never expire
+        max_bytes: once the tiles take more than max_bytes, least recently
+            read tiles get evicted; None means no limit
+        lock_stripes: number of files in directory path + ".locks" locking
+            downloads of tiles (see FileLockStripes)
+        """
+
+        self.path = path or default_store_path()
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock_stripes = lock_stripes
+        self._open()
+
+
+    def _open(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = Lock()
+        self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        with self._lock:
+            #several processes may share the store
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    provider TEXT NOT NULL,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    tile_data BLOB,
+                    size INTEGER NOT NULL,
+                    fetched REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    PRIMARY KEY (provider, zoom_level, tile_column, tile_row)
+                )""")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed)")
+            #tiles which the server does not have, see put_missing
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS missing (
+                    provider TEXT NOT NULL,
+                    zoom_level INTEGER NOT NULL,
+                    tile_column INTEGER NOT NULL,
+                    tile_row INTEGER NOT NULL,
+                    until REAL NOT NULL,
+                    PRIMARY KEY (provider, zoom_level, tile_column, tile_row)
+                )""")
+            self._conn.commit()
+            self._size = self._total_size()
+
+        self._file_locks = FileLockStripes(self.path + ".locks", self.lock_stripes)
+
+
+    def __getstate__(self):
+        """Copies in other processes open the same file"""
+
+        return {"path": self.path, "ttl": self.ttl, "max_bytes": self.max_bytes,
+                "lock_stripes": self.lock_stripes}
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+
+    def _total_size(self):
+        return self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+
+
+    def _chunks(self, keys):
+        """Split keys into groups which can be looked up by a single query
+
+        Yields pairs (condition, params) to be used in WHERE clause.
+        """
+
+        groups = {}
+        for key in keys:
+            groups.setdefault(key[:2], []).append(key[2:])
+
+        for (provider, zoom), xys in groups.items():
+            for i in range(0, len(xys), self.chunk):
+                part = xys[i:i + self.chunk]
+                condition = "provider = ? AND zoom_level = ? AND (tile_column, tile_row) IN (VALUES {})".format(
+                    ", ".join(["(?, ?)"] * len(part)))
+                yield condition, [provider, zoom] + [c for xy in part for c in xy]
+
+
+    def _oldest(self, now):
+        """Return the time of storing of the oldest tile which is not expired"""
+
+        return now - self.ttl if self.ttl is not None else float("-inf")
+
+
+    def get_many(self, keys):
+        """Return a dict {key: bytes} of those keys which are stored and not
+        expired
+
+        Tiles of one provider and zoom are read by a few queries, not one per
+        tile.
+        """
+
+        now = time.time()
+
+        found = {}
+        with self._lock:
+            for condition, params in self._chunks(keys):
+                rows = self._conn.execute(
+                    "SELECT provider, zoom_level, tile_column, tile_row, tile_data FROM tiles "
+                    "WHERE fetched >= ? AND " + condition, [self._oldest(now)] + params)
+                for provider, zoom, x, y, data in rows:
+                    found[(provider, zoom, x, y)] = bytes(data)
+
+                #remember the access for LRU eviction (but do not rewrite
+                #tiles which have been read just a while ago)
+                self._conn.execute(
+                    "UPDATE tiles SET accessed = ? WHERE accessed < ? AND " + condition,
+                    [now, now - 60] + params)
+            self._conn.commit()
+
+        return found
+
+
+    def contains_many(self, keys):
+        """Return a set of those keys which are stored and not expired"""
+
+        found = set()
+        with self._lock:
+            for condition, params in self._chunks(keys):
+                rows = self._conn.execute(
+                    "SELECT provider, zoom_level, tile_column, tile_row FROM tiles "
+                    "WHERE fetched >= ? AND " + condition, [self._oldest(time.time())] + params)
+                found.update(rows)
+
+        return found
+
+
+    def put(self, key, data):
+        """Store bytes data as the tile key (replacing the older version)"""
+
+        now = time.time()
+        provider, zoom, x, y = key
+        with self._lock:
+            old = self._conn.execute(
+                "SELECT size FROM tiles WHERE provider = ? AND zoom_level = ? AND tile_column = ? AND tile_row = ?",
+                key).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (provider, zoom, x, y, data, len(data), now, now))
+            self._conn.commit()
+            self._size += len(data) - (old[0] if old else 0)
+
+            if self.max_bytes is not None and self._size > self.max_bytes:
+                self._evict()
+
+
+    def get_missing_many(self, keys):
+        found = {}
+        with self._lock:
+            for condition, params in self._chunks(keys):
+                rows = self._conn.execute(
+                    "SELECT provider, zoom_level, tile_column, tile_row, until FROM missing "
+                    "WHERE until > ? AND " + condition, [time.time()] + params)
+                for provider, zoom, x, y, until in rows:
+                    found[(provider, zoom, x, y)] = until
+        return found
+
+
+    def put_missing(self, key, until):
+        with self._lock:
+            #forget the expired marks on the way
+            self._conn.execute("DELETE FROM missing WHERE until <= ?", (time.time(),))
+            self._conn.execute("INSERT OR REPLACE INTO missing VALUES (?, ?, ?, ?, ?)", tuple(key) + (until,))
+            self._conn.commit()
+
+
+    def average_size(self, provider, zoom):
+        with self._lock:
+            return self._conn.execute(
+                "SELECT AVG(size) FROM tiles WHERE provider = ? AND zoom_level = ?",
+                (provider, zoom)).fetchone()[0]
+
+
+    def lock(self, key):
+        """Lock of key shared with other processes using the same file"""
+
+        return self._file_locks.lock(key)
+
+
+    def _evict(self):
+        """Delete least recently read tiles until they take at most 90 % of
+        max_bytes
+
+        Expects self._lock to be held.
+        """
+
+        #other processes could have changed the store
+        self._size = self._total_size()
+        to_free = self._size - int(0.9 * self.max_bytes)
+        if to_free <= 0:
+            return
+
+        rowids = []
+        freed = 0
+        for rowid, size in self._conn.execute("SELECT rowid, size FROM tiles ORDER BY accessed"):
+            if freed >= to_free:
+                break
+            rowids.append(rowid)
+            freed += size
+
+        for i in range(0, len(rowids), 2 * self.chunk):
+            part = rowids[i:i + 2 * self.chunk]
+            self._conn.execute("DELETE FROM tiles WHERE rowid IN ({})".format(", ".join(["?"] * len(part))), part)
+        self._conn.commit()
+        self._size -= freed
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        self._file_locks.close()
+
+
+class DirectoryTileStore(TileStore):
+    """Keeps tiles as files root/provider/zoom/x/y (like a tile server), so
+    that other programs can use them too
+
+    Files are written atomically (see write_atomic), so several processes
+    can share the directory. Tiles older than ttl seconds (by modification
+    time of their files) are treated as not stored. Tiles which the server
+    does not have are marked by files root/provider/zoom/x/y.missing.
+    """
+
+    def __init__(self, root, ttl=30*24*3600, lock_stripes=256):
+        """
+        Arguments:
+
+        root: the directory
+        ttl: tiles older than ttl seconds are treated as not stored; None
+            means they never expire
+        lock_stripes: number of files in root/.locks locking downloads of
+            tiles (see FileLockStripes)
+        """
+
+        self.root = root
+        self.ttl = ttl
+        self.lock_stripes = lock_stripes
+        self._file_locks = FileLockStripes(os.path.join(root, ".locks"), lock_stripes)
+
+
+    def _filename(self, key):
+        provider, zoom, x, y = key
+        return os.path.join(self.root, str(provider), str(zoom), str(x), str(y))
+
+
+    def get_many(self, keys):
+        oldest = time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+        found = {}
+        for key in keys:
+            try:
+                with open(self._filename(key), "rb") as f:
+                    if os.fstat(f.fileno()).st_mtime >= oldest:
+                        found[key] = f.read()
+            except FileNotFoundError:
+                pass
+        return found
+
+
+    def put(self, key, data):
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_atomic(filename, data)
+
+
+    def get_missing_many(self, keys):
+        now = time.time()
+        found = {}
+        for key in keys:
+            try:
+                with open(self._filename(key) + ".missing") as f:
+                    until = float(f.read())
+            except (FileNotFoundError, ValueError):
+                continue
+            if until > now:
+                found[key] = until
+        return found
+
+
+    def put_missing(self, key, until):
+        filename = self._filename(key) + ".missing"
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        write_atomic(filename, repr(until).encode("ascii"))
+
+
+    def average_size(self, provider, zoom):
+        sizes = []
+        for dirpath, dirnames, filenames in os.walk(os.path.join(self.root, str(provider), str(zoom))):
+            sizes.extend(os.path.getsize(os.path.join(dirpath, name))
+                         for name in filenames if not name.startswith(".tmp-") and not name.endswith(".missing"))
+        return sum(sizes) / len(sizes) if sizes else None
+
+
+    def lock(self, key):
+        """Lock of key shared with other processes using the same directory"""
+
+        return self._file_locks.lock(key)
+
+
+    def close(self):
+        self._file_locks.close()